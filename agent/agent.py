@@ -4,9 +4,6 @@
 # DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
 # rights in this software.
 
-# External dependencies
-import PIL.Image
-
 # Python standard library
 import argparse
 
@@ -18,6 +15,7 @@ except ImportError:
 import datetime
 import errno
 import json
+import multiprocessing.pool
 import slycat.mime_type
 import os
 import re
@@ -30,6 +28,7 @@ import uuid
 import abc
 import logging
 import ConfigParser
+import zlib
 
 session_cache = {}
 
@@ -256,8 +255,23 @@ class Agent(object):
         if os.path.isdir(path):
             raise Exception("Directory unreadable.")
 
+        # An optional offset and length retrieve part of the file.
+        offset = command.get("offset", 0)
+        length = command.get("length", -1)
+        if not isinstance(offset, (int, long)) or not isinstance(length, (int, long)) or offset < 0:
+            raise Exception("Invalid range.")
+
+        # An optional chunk size sends the content as a series of frames, so
+        # large files are never held in memory.
+        chunk_size = command.get("chunk-size", None)
+        checksum = command.get("checksum", None)
+        if chunk_size is not None and (not isinstance(chunk_size, (int, long)) or not 0 < chunk_size <= 64 * 1024 * 1024):
+            raise Exception("Invalid chunk size.")
+        if checksum not in [None, "crc32"]:
+            raise Exception("Unsupported checksum.")
+
         try:
-            content = open(path, "rb").read()
+            file = open(path, "rb")
         except IOError as e:
             if e.errno == errno.EACCES:
                 raise Exception("Access denied.")
@@ -265,12 +279,52 @@ class Agent(object):
         except Exception as e:
             raise Exception(e.message)
 
-        content_type, encoding = slycat.mime_type.guess_type(path)
-        sys.stdout.write("%s\n%s" % (json.dumps(
-            {"ok": True, "message": "File retrieved.", "path": path, "content-type": content_type,
-             "size": len(content)}),
-                                     content))
-        sys.stdout.flush()
+        with file:
+            fstat = os.fstat(file.fileno())
+            size = max(0, fstat.st_size - offset)
+            if length >= 0:
+                size = min(size, length)
+
+            content_type, encoding = slycat.mime_type.guess_type(path)
+            metadata = {"ok": True, "message": "File retrieved.", "path": path, "content-type": content_type,
+                        "size": size, "offset": offset, "file-size": fstat.st_size, "mtime": fstat.st_mtime}
+
+            if chunk_size is None:
+                try:
+                    file.seek(offset)
+                    content = file.read(size)
+                except Exception as e:
+                    raise Exception(getattr(e, "strerror", None) or e.message)
+                metadata["size"] = len(content)
+                sys.stdout.write("%s\n%s" % (json.dumps(metadata), content))
+                sys.stdout.flush()
+                return
+
+            # Each chunk is a JSON frame header followed by its content, and an
+            # empty chunk ends the file.  Writes block while the caller isn't
+            # reading (the ssh channel is flow controlled), so at most one chunk
+            # is in memory however slowly the file is consumed.
+            metadata["chunked"] = True
+            metadata["chunk-size"] = chunk_size
+            sys.stdout.write("%s\n" % json.dumps(metadata))
+            file.seek(offset)
+            remaining = size
+            while True:
+                try:
+                    content = file.read(min(chunk_size, remaining))
+                except Exception as e:
+                    # The caller has already been sent the metadata, so errors end the transfer instead.
+                    sys.stdout.write("%s\n" % json.dumps({"ok": False, "message": getattr(e, "strerror", None) or e.message}))
+                    sys.stdout.flush()
+                    return
+                remaining -= len(content)
+                frame = {"ok": True, "size": len(content)}
+                if checksum == "crc32":
+                    frame["crc32"] = zlib.crc32(content) & 0xffffffff
+                sys.stdout.write("%s\n%s" % (json.dumps(frame), content))
+                sys.stdout.flush()
+                if not content:
+                    return
 
     # Handle the 'get-image' command.
     def get_image(self, command):
@@ -308,7 +362,9 @@ class Agent(object):
         if requested_content_type not in ["image/jpeg", "image/png"]:
             raise Exception("Unsupported image type.")
 
-        # Load the requested image.
+        # Load the requested image.  PIL is only needed to resample or convert
+        # images, so the agent can run without it.
+        import PIL.Image
         try:
             image = PIL.Image.open(path)
         except IOError as e:
@@ -338,6 +394,60 @@ class Agent(object):
              "size": len(content.getvalue())}), content.getvalue()))
         sys.stdout.flush()
 
+    def handle(self, command):
+        """
+        run a parsed command, writing its response to stdout
+        :param command: json command
+        :return:
+        """
+        action = command["action"]
+        if action == "browse":
+            self.browse(command)
+        elif action == "get-file":
+            self.get_file(command)
+        elif action == "get-image":
+            self.get_image(command)
+        elif action == "create-video":
+            sys.stdout.write("%s\n" % json.dumps({"ok": False, "message": "this command is depricated and has "
+                                                                          "been removed"}))
+            sys.stdout.flush()
+        elif action == "video-status":
+            self.video_status(command)
+        elif action == "launch":
+            self.launch(command)
+        elif action == "submit-batch":
+            self.submit_batch(command)
+        elif action == "checkjob":
+            self.checkjob(command)
+        elif action == "get-job-output":
+            self.get_job_output(command)
+        elif action == "run-function":
+            self.run_function(command)
+        elif action == "cancel-job":
+            self.cancel_job(command)
+        elif action == "get-user-config":
+            self.get_user_config()
+        elif action == "set-user-config":
+            self.set_user_config(command)
+        else:
+            self.log.error("Unknown command.")
+            raise Exception("Unknown command.")
+
+    def execute(self, command):
+        """
+        run a command with a request id on a worker thread, sending its
+        response in envelopes tagged with the id
+        :param command: json command
+        :return:
+        """
+        sys.stdout.begin(command["id"])
+        try:
+            self.handle(command)
+        except Exception as e:
+            sys.stdout.write("%s\n" % json.dumps({"ok": False, "message": e.message}))
+        finally:
+            sys.stdout.end()
+
     def run(self):
         self.log.info("\n")
         self.log.info("*agent started*")
@@ -347,17 +457,24 @@ class Agent(object):
                             help="Fail immediately on startup.  Obviously, this is for testing.")
         parser.add_argument("--fail-exit", default=False, action="store_true",
                             help="Fail during exit.  Obviously, this is for testing.")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="Number of commands with request ids to run concurrently.")
         arguments = parser.parse_args()
 
         if arguments.fail_startup:
             exit(-1)
 
+        # Commands with an "id" are run by a pool of workers, and their
+        # responses come back in whatever order they finish.
+        sys.stdout = Output(sys.stdout)
+        workers = multiprocessing.pool.ThreadPool(max(1, arguments.workers))
+
         # Let the caller know we're ready to handle commands.
-        sys.stdout.write("%s\n" % json.dumps({"ok": True, "message": "Ready."}))
+        sys.stdout.write("%s\n" % json.dumps({"ok": True, "message": "Ready.", "multiplexed": True, "flow-control": True}))
         sys.stdout.flush()
 
         while True:
-            # format: {"action":"action"}
+            # format: {"action":"action"}, with an optional "id"
             # Read the next command from caller.
             command = sys.stdin.readline()
             if command == "":  # EOF means the caller went away and it's time to shut-down.
@@ -383,42 +500,97 @@ class Agent(object):
                     self.log.info("*agent stopping*\n")
                     if not arguments.fail_exit:
                         break
-                elif action == "browse":
-                    self.browse(command)
-                elif action == "get-file":
-                    self.get_file(command)
-                elif action == "get-image":
-                    self.get_image(command)
-                elif action == "create-video":
-                    sys.stdout.write("%s\n" % json.dumps({"ok": False, "message": "this command is depricated and has "
-                                                                                  "been removed"}))
-                    sys.stdout.flush()
-                elif action == "video-status":
-                    self.video_status(command)
-                elif action == "launch":
-                    self.launch(command)
-                elif action == "submit-batch":
-                    self.submit_batch(command)
-                elif action == "checkjob":
-                    self.checkjob(command)
-                elif action == "get-job-output":
-                    self.get_job_output(command)
-                elif action == "run-function":
-                    self.run_function(command)
-                elif action == "cancel-job":
-                    self.cancel_job(command)
-                elif action == "get-user-config":
-                    self.get_user_config()
-                elif action == "set-user-config":
-                    self.set_user_config(command)
+                elif action == "credit":
+                    # The caller has read part of a response, so its worker can send more.  There's no reply.
+                    sys.stdout.credit(command["id"], command.get("size"))
+                elif "id" in command:
+                    sys.stdout.open(command["id"], command.get("window"))
+                    workers.apply_async(self.execute, (command,))
                 else:
-                    self.log.error("Unknown command.")
-                    raise Exception("Unknown command.")
+                    self.handle(command)
             except Exception as e:
                 sys.stdout.write("%s\n" % json.dumps({"ok": False, "message": e.message}))
                 sys.stdout.flush()
 
 
+class Output(object):
+    """
+    Stands in for stdout, so that commands run by workers can write their
+    responses as usual.  Whatever a worker writes is sent when it flushes, in
+    an envelope: a JSON header with the command's id and the size of the
+    content, followed by the content.  The last envelope for a command is
+    marked "done".  Writes from other threads go straight to stdout.
+
+    A command may have a "window": the number of bytes its worker can send
+    before it waits for the caller to read them and send "credit".  Only that
+    worker waits, so one slow reader doesn't hold up the other responses.
+    """
+
+    def __init__(self, stdout):
+        self._stdout = stdout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._credits = {}
+        self._credit = threading.Condition()
+
+    def open(self, id, window):
+        """Set the number of bytes a command can send before it needs credit, or None for no limit."""
+        if window is not None:
+            with self._credit:
+                self._credits[id] = window
+
+    def credit(self, id, size):
+        """Let a command send size more bytes, or as much as it likes if size is None."""
+        with self._credit:
+            if id in self._credits:
+                if size is None:
+                    del self._credits[id]
+                else:
+                    self._credits[id] += size
+                self._credit.notify_all()
+
+    def begin(self, id):
+        self._local.id = id
+        self._local.buffer = []
+
+    def end(self):
+        self._send(True)
+        self._local.buffer = None
+        with self._credit:
+            self._credits.pop(self._local.id, None)
+
+    def write(self, data):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            with self._lock:
+                self._stdout.write(data)
+        else:
+            buffer.append(data)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            with self._lock:
+                self._stdout.flush()
+        else:
+            self._send(False)
+
+    def _send(self, done):
+        content = "".join(self._local.buffer)
+        self._local.buffer = []
+        if not content and not done:
+            return
+        envelope = {"id": self._local.id, "size": len(content)}
+        if done:
+            envelope["done"] = True
+        with self._credit:
+            while content and self._credits.get(self._local.id, 1) <= 0:
+                self._credit.wait()
+            if self._local.id in self._credits:
+                self._credits[self._local.id] -= len(content)
+        with self._lock:
+            self._stdout.write("%s\n%s" % (json.dumps(envelope), content))
+            self._stdout.flush()
+
 if __name__ == "__main__":
     """
     this is how we run the agent when implemented
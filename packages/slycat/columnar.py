@@ -0,0 +1,140 @@
+# Copyright 2013, Sandia Corporation. Under the terms of Contract
+# DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
+# rights in this software.
+
+"""Self-describing binary format for sequences of numpy arrays.
+
+An encoded message contains an 8 byte signature followed by one frame per
+array, so arrays can be encoded as they are read.  Each frame contains a 4
+byte little-endian header length and a JSON header (padded to an 8 byte
+boundary), followed by the frame's raw buffers, each starting on an 8 byte
+boundary.  The header gives the array's dtype, shape, and the size in bytes
+of each buffer.  Numeric arrays use a single buffer in C order.  String
+arrays use two: the length in bytes of each value, using the smallest
+unsigned integer type that fits, followed by the UTF-8 encoded data.  The
+message ends with an empty frame, so truncated messages can be detected.
+"""
+
+import itertools
+import json
+import numpy
+import slycat.email
+import struct
+import sys
+
+content_type = "application/x-slycat-arrayset"
+signature = "SLYCATA2"
+alignment = 8
+terminator = struct.pack("<I", 0) + "\0" * 4
+
+def _padding(size):
+  return -size % alignment
+
+def _strings(array):
+  values = array.ravel().tolist()
+  try:
+    data = "".join(values)
+  except TypeError:
+    data = None
+  if not isinstance(data, str):
+    # Unicode or non-string values need to be converted one at a time.
+    values = [value.encode("utf-8") if isinstance(value, unicode) else str(value) for value in values]
+    data = "".join(values)
+  lengths = numpy.fromiter(itertools.imap(len, values), dtype="uint64", count=len(values))
+  return lengths.astype(numpy.min_scalar_type(lengths.max() if len(lengths) else 0)), data
+
+def _frame(array, order):
+  array = numpy.asarray(array)
+  if array.dtype.char in ["O", "S", "U"]:
+    lengths, data = _strings(array)
+    lengths = lengths.astype(lengths.dtype.newbyteorder(order), copy=False)
+    header = {"dtype": "string", "lengths": lengths.dtype.str, "shape": list(array.shape)}
+    buffers = [lengths.tostring(), data]
+  else:
+    array = array.astype(array.dtype.newbyteorder(order), order="C", copy=False)
+    header = {"dtype": array.dtype.str, "shape": list(array.shape)}
+    buffers = [array.tostring(order="C")]
+  header["buffers"] = [len(buffer) for buffer in buffers]
+  header = json.dumps(header)
+  header += " " * _padding(4 + len(header))
+
+  yield struct.pack("<I", len(header)) + header
+  for buffer in buffers:
+    yield buffer
+    if _padding(len(buffer)):
+      yield "\0" * _padding(len(buffer))
+
+def encode(arrays, byteorder=None):
+  """Encode a sequence of arrays, returning a generator that produces the encoded message in pieces.
+
+  Each array is encoded as it is taken from `arrays`, which may be a generator.
+
+  Parameters
+  ----------
+  arrays : sequence of :class:`numpy.ndarray`, required.
+    Arrays to be encoded.
+  byteorder : "little" or "big", optional.
+    Byte order of numeric buffers, defaults to the native byte order.
+  """
+  byteorder = sys.byteorder if byteorder is None else byteorder
+  if byteorder not in ["little", "big"]:
+    slycat.email.send_error("columnar.py encode", "Byte order must be big or little.")
+    raise ValueError("Byte order must be big or little.")
+  order = "<" if byteorder == "little" else ">"
+
+  def generate():
+    yield signature
+    for array in arrays:
+      for piece in _frame(array, order):
+        yield piece
+    yield terminator
+  return generate()
+
+def decode(data):
+  """Decode a message created by :func:`encode`, returning a list of arrays.
+
+  Numeric arrays are read-only views into `data`.
+  """
+  if data[:len(signature)] != signature:
+    slycat.email.send_error("columnar.py decode", "Not an encoded arrayset.")
+    raise ValueError("Not an encoded arrayset.")
+
+  arrays = []
+  position = len(signature)
+  while True:
+    if position + 4 > len(data):
+      slycat.email.send_error("columnar.py decode", "Truncated arrayset.")
+      raise ValueError("Truncated arrayset.")
+    header_size, = struct.unpack("<I", data[position:position + 4])
+    if header_size == 0:
+      return arrays
+    header = json.loads(data[position + 4:position + 4 + header_size])
+    position += 4 + header_size
+
+    buffers = []
+    for size in header["buffers"]:
+      if position + size > len(data):
+        slycat.email.send_error("columnar.py decode", "Truncated arrayset.")
+        raise ValueError("Truncated arrayset.")
+      buffers.append((position, size))
+      position += size + _padding(size)
+
+    shape = tuple(header["shape"])
+    if header["dtype"] == "string":
+      lengths = numpy.dtype(str(header["lengths"]))
+      offsets = numpy.zeros(buffers[0][1] // lengths.itemsize + 1, dtype="int64")
+      numpy.cumsum(numpy.frombuffer(data, dtype=lengths, count=len(offsets) - 1, offset=buffers[0][0]), out=offsets[1:])
+      offsets = offsets.tolist()
+      strings = data[buffers[1][0]:buffers[1][0] + buffers[1][1]]
+      text = strings.decode("utf-8")
+      if len(text) == len(strings):
+        # Pure ASCII, so byte offsets are also character offsets.
+        values = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+      else:
+        values = [strings[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+      array = numpy.empty(len(values), dtype="object")
+      array[...] = values
+      arrays.append(array.reshape(shape))
+    else:
+      dtype = numpy.dtype(str(header["dtype"]))
+      arrays.append(numpy.frombuffer(data, dtype=dtype, count=buffers[0][1] // dtype.itemsize, offset=buffers[0][0]).reshape(shape))
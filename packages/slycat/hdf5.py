@@ -4,12 +4,14 @@ import numpy
 import os
 import slycat.darray
 import slycat.email
+import uuid
 import cherrypy
 
 class DArray(slycat.darray.Prototype):
   """Slycat darray implementation that stores data in an HDF5 file."""
-  def __init__(self, storage):
+  def __init__(self, storage, derived=None):
     self._storage = storage
+    self._derived = {} if derived is None else derived
     self._metadata = self._storage.get("metadata", None)
     if self._metadata is None:
       self._metadata = self._storage.attrs
@@ -70,61 +72,116 @@ class DArray(slycat.darray.Prototype):
       self._attributes = [dict(name=name, type=type) for name, type in zip(self._metadata["attribute-names"], self._metadata["attribute-types"])]
     return self._attributes
 
-  def _update_cache(self, attribute_index):
-    attribute_key = "attribute/%s" % attribute_index
+  @property
+  def version(self):
+    """Return a string that changes whenever the darray's data is written.
+
+    Returns
+    -------
+    version: string
+      An opaque identifier for the current contents of the darray, suitable
+      for use as part of a cache key.
+    """
+    return str(self._storage.attrs.get("data-version", ""))
+
+  @property
+  def _writable(self):
+    return self._storage.file.mode != "r"
+
+  def _statistics(self, attribute_index):
+    """Return previously-computed statistics and unique values for an attribute, or None."""
+    derived = self._derived.get((self._storage.name, "statistics", attribute_index))
+    if derived is not None:
+      return derived
+
+    attribute = self._storage["attribute/%s" % attribute_index]
     unique_key = "unique/%s" % attribute_index
+    if "unique" in attribute.attrs and unique_key in self._storage:
+      return dict(attribute.attrs), self._storage[unique_key]
+    return None
 
-    attribute = self._storage[attribute_key]
-    if "min" in attribute.attrs and "max" in attribute.attrs and "unique" in attribute.attrs and unique_key in self._storage:
-      return
+  def _update_cache(self, attribute_index):
+    """Return statistics and unique values for an attribute, computing them if they weren't stored when it was written.
 
-    attribute_min = None
-    attribute_max = None
-    attribute_unique = None
-
-    chunk_size = 1000
-    for begin in numpy.arange(0, len(attribute), chunk_size):
-      slice = attribute[begin : begin + chunk_size]
-      if attribute.dtype.char in ["O", "S", "U"]:
-        data_min = min(slice)
-        data_max = max(slice)
-        data_unique = numpy.unique(slice)
-        attribute_min = str(data_min) if attribute_min is None else str(min(data_min, attribute_min))
-        attribute_max = str(data_max) if attribute_max is None else str(max(data_max, attribute_max))
-        attribute_unique = data_unique if attribute_unique is None else numpy.unique(numpy.concatenate((data_unique, attribute_unique)))
-      else:
-        slice = slice[numpy.invert(numpy.isnan(slice))]
-        if len(slice):
-          data_min = numpy.asscalar(slice.min())
-          data_max = numpy.asscalar(slice.max())
-          data_unique = numpy.unique(slice)
-          attribute_min = data_min if attribute_min is None else min(data_min, attribute_min)
-          attribute_max = data_max if attribute_max is None else max(data_max, attribute_max)
-          attribute_unique = data_unique if attribute_unique is None else numpy.unique(numpy.concatenate((data_unique, attribute_unique)))
-
-    if attribute_min is not None:
-      attribute.attrs["min"] = attribute_min
-    if attribute_max is not None:
-      attribute.attrs["max"] = attribute_max
-    if attribute_unique is not None:
-      attribute.attrs["unique"] = len(attribute_unique)
-      self._storage.create_dataset(unique_key, data=attribute_unique, dtype=dtype(self._metadata["attribute-types"][attribute_index]))
+    Computed results are written to the file if it's writable.  Otherwise they
+    are kept in memory, where :func:`store_derived` can find them later.
+    """
+    result = self._statistics(attribute_index)
+    if result is not None:
+      return result
 
-  def get_statistics(self, attribute):
-    self._update_cache(attribute)
+    attribute = self._storage["attribute/%s" % attribute_index]
+    if _statistics_complete(attribute):
+      statistics, unique = {key: attribute.attrs[key] for key in _statistics_keys if key in attribute.attrs}, None
+    else:
+      statistics, unique = {}, None
+      chunk_size = 1000000
+      for begin in numpy.arange(0, len(attribute), chunk_size):
+        unique = _merge_statistics(statistics, unique, attribute[begin : begin + chunk_size])
+      statistics["statistics-count"] = attribute.size
+
+    # Columns with too many unique values to track incrementally get a single exact pass.
+    if statistics.get("unique-overflow", False):
+      unique = _unique(attribute[...])
+    elif unique is None:
+      unique = numpy.array([], dtype=attribute.dtype)
+    statistics["unique"] = len(unique)
+
+    if self._writable:
+      self._store_statistics(attribute_index, statistics, unique)
+      return self._statistics(attribute_index)
+    self._derived[(self._storage.name, "statistics", attribute_index)] = (statistics, unique)
+    return statistics, unique
+
+  def _accumulate_statistics(self, attribute_index, data, box):
+    """Merge statistics for a newly-written block of data into the statistics stored for the attribute."""
+    attribute = self._storage["attribute/%s" % attribute_index]
+    unique_key = "unique/%s" % attribute_index
+    statistics = {key: attribute.attrs[key] for key in _statistics_keys if key in attribute.attrs}
+    unique = self._storage[unique_key][...] if unique_key in self._storage else None
+    unique = _merge_statistics(statistics, unique, data)
+    statistics["statistics-extents"] = _add_extent(statistics.get("statistics-extents"), box)
+
+    if statistics["statistics-count"] == attribute.size and not statistics.get("unique-overflow", False):
+      if unique is None:
+        unique = numpy.array([], dtype=attribute.dtype)
+      statistics["unique"] = len(unique)
+    self._store_statistics(attribute_index, statistics, unique)
+
+  def _store_statistics(self, attribute_index, statistics, unique):
+    attribute = self._storage["attribute/%s" % attribute_index]
+    unique_key = "unique/%s" % attribute_index
+    _clear_statistics(attribute)
+    for key in _statistics_keys:
+      if key in statistics:
+        attribute.attrs[key] = statistics[key]
+    stored = self._storage[unique_key] if unique_key in self._storage else None
+    if stored is not None and (unique is None or stored.maxshape != (None,)):
+      del self._storage[unique_key]
+      stored = None
+    if unique is None:
+      return
+    if stored is None:
+      # Unique values are stored in a resizable dataset, so appends overwrite its chunks in place instead of
+      # leaving a discarded copy in the file every time.
+      self._storage.create_dataset(unique_key, data=unique, dtype=dtype(self._metadata["attribute-types"][attribute_index]), maxshape=(None,))
+    else:
+      stored.resize((len(unique),))
+      stored[...] = unique
 
-    attribute = self._storage["attribute/%s" % attribute]
+  def get_statistics(self, attribute):
+    statistics, unique = self._update_cache(attribute)
     return {
-      "min": attribute.attrs.get("min", None),
-      "max": attribute.attrs.get("max", None),
-      "unique": attribute.attrs.get("unique", None),
+      "min": statistics.get("min", None),
+      "max": statistics.get("max", None),
+      "unique": statistics.get("unique", None),
+      "nan-count": statistics.get("nan-count", None),
       }
 
   def get_unique(self, attribute, hyperslice):
-    self._update_cache(attribute)
-
+    statistics, unique = self._update_cache(attribute)
     return {
-      "values": self._storage["unique/%s" % attribute][hyperslice]
+      "values": unique[hyperslice]
       }
 
   def get_data(self, attribute):
@@ -143,15 +200,6 @@ class DArray(slycat.darray.Prototype):
       `references` the underlying data - data is not retrieved from the file
       until you access it using the `[]` operator.
     """
-    class StorageWrapper(object):
-      """Ensures that the dtype of data retrieved from the file matches what was put in."""
-      def __init__(self, storage, dtype):
-        self._storage = storage
-        self._dtype = dtype
-      def __getitem__(self, *args, **kwargs):
-        result = self._storage.__getitem__(*args, **kwargs)
-        return result.astype(self._dtype)
-
     return StorageWrapper(self._storage["attribute/%s" % attribute], self._metadata["attribute-types"][attribute])
 
   def set_data(self, attribute, hyperslice, data):
@@ -185,43 +233,340 @@ class DArray(slycat.darray.Prototype):
     attribute_storage = self._storage["attribute/%s" % attribute]
     attribute_storage[hyperslice] = data
 
-    # Flush cached sort indices.
+    self._storage.attrs["data-version"] = uuid.uuid4().hex
+
+    # Flush sort indices cached by older versions.
     index_key = "index/%s" % attribute
     if index_key in self._storage:
       del self._storage[index_key]
 
-    # Flush cached unique values.
+    # Merge statistics for the new data, as long as it doesn't overlap anything written since start_array().
+    # Otherwise, flush them so they will be recomputed from scratch when needed.
     unique_key = "unique/%s" % attribute
-    if unique_key in self._storage:
-      del self._storage[unique_key]
+    data = numpy.asarray(data)
+    box = _selection_box(hyperslice, attribute_storage.shape)
+    if "statistics-count" in attribute_storage.attrs and box is not None and data.size == numpy.prod(box[:, 1] - box[:, 0]) and not _overlaps(attribute_storage.attrs.get("statistics-extents"), box):
+      self._accumulate_statistics(attribute, data, box)
+    else:
+      if unique_key in self._storage:
+        del self._storage[unique_key]
+      _clear_statistics(attribute_storage)
+
+class StorageWrapper(object):
+  """Provides read access to the data for a darray attribute.
+
+  Ensures that the dtype of data retrieved from the file matches what was put
+  in, converting only when the stored type differs.  Indexing with integer
+  sequences or negative strides reads just the selected region of the file,
+  in any order.
+  """
+  def __init__(self, storage, type):
+    self._storage = storage
+    self._dtype = numpy.dtype(type)
+    self._convert = self._dtype != storage.dtype
+
+  @property
+  def dtype(self):
+    return self._dtype
+
+  @property
+  def shape(self):
+    return self._storage.shape
+
+  @property
+  def ndim(self):
+    return len(self._storage.shape)
+
+  def __len__(self):
+    return len(self._storage)
+
+  def __getitem__(self, key):
+    result = self._read(key)
+    if self._convert:
+      result = result.astype(self._dtype)
+    return result
+
+  def read_direct(self, destination, selection=Ellipsis):
+    """Read data into an existing array.
+
+    If the destination array is C-contiguous and matches the stored type, data
+    is copied straight from the file, without any temporary arrays.
+
+    Parameters
+    ----------
+    destination : :class:`numpy.ndarray`, required.
+      Array to be filled, with the same shape as the selection.
+    selection : integer, :class:`slice`, :class:`Ellipsis`, or tuple of the same, optional.
+      Region of the attribute to read.
+    """
+    keys = selection if isinstance(selection, tuple) else (selection,)
+    simple = all(isinstance(key, (numbers.Integral, type(Ellipsis))) or (isinstance(key, slice) and key.step in [None, 1]) for key in keys)
+    if simple and not self._convert and destination.dtype == self._storage.dtype and destination.flags.c_contiguous:
+      self._storage.read_direct(destination, selection)
+    else:
+      destination[...] = self[selection]
+
+  def read_rows(self, plan):
+    """Read the rows described by a :class:`ReadPlan` from a 1D attribute."""
+    result = plan.read(self._storage)
+    if self._convert:
+      result = result.astype(self._dtype)
+    return result
+
+  def _read(self, key):
+    keys = key if isinstance(key, tuple) else (key,)
+    fancy = [isinstance(item, (list, numpy.ndarray)) for item in keys]
+    backward = [isinstance(item, slice) and item.step is not None and item.step < 0 for item in keys]
+    if not any(fancy) and not any(backward):
+      return self._storage[key]
+
+    # HDF5 only supports a single, strictly increasing coordinate list, so fall back to reading everything for more exotic keys.
+    if sum(fancy) > 1 or any(item is None for item in keys) or any(isinstance(item, numpy.ndarray) and item.dtype == bool for item in keys):
+      return self._storage[...][key]
+
+    # Coordinate lists for 1D attributes are read in runs and points, see ReadPlan.
+    if len(self._storage.shape) == 1 and fancy == [True]:
+      return ReadPlan(keys[0], self._storage.shape[0]).read(self._storage)
+
+    # Read a region with positive strides and sorted coordinates, then reorder it in memory.
+    selection = []
+    reorder = []
+    for item, extent in zip(_expand_hyperslice(keys, self._storage.shape), self._storage.shape):
+      if isinstance(item, slice) and item.step is not None and item.step < 0:
+        start, stop, step = item.indices(extent)
+        count = len(xrange(start, stop, step))
+        if count:
+          selection.append(slice(start + (count - 1) * step, start + 1, -step))
+          reorder.append(slice(None, None, -1))
+        else:
+          selection.append(slice(0, 0))
+          reorder.append(slice(None))
+      elif isinstance(item, (list, numpy.ndarray)):
+        indices = numpy.asarray(item, dtype="int64")
+        if numpy.any(indices >= extent) or numpy.any(indices < -extent):
+          slycat.email.send_error("hdf5.py StorageWrapper", "Index out-of-range.")
+          raise IndexError("Index out-of-range.")
+        indices = numpy.where(indices < 0, indices + extent, indices)
+        unique, inverse = numpy.unique(indices, return_inverse=True)
+        if not len(unique):
+          selection.append(slice(0, 0))
+          reorder.append(inverse)
+        elif unique[-1] - unique[0] < 2 * len(unique):
+          # Dense coordinates are cheaper to read as a single contiguous block.
+          selection.append(slice(unique[0], unique[-1] + 1))
+          reorder.append(indices - unique[0])
+        else:
+          selection.append(unique.tolist())
+          reorder.append(inverse)
+      else:
+        selection.append(item)
+        if not isinstance(item, numbers.Integral):
+          reorder.append(slice(None))
+    return self._storage[tuple(selection)][tuple(reorder)]
+
+class ReadPlan(object):
+  """Plans reads of the same rows from one or more 1D attributes.
+
+  The requested rows are decomposed once into sorted, contiguous runs.  Long
+  runs are read as slices, while the remaining rows are read together with a
+  single point selection, which HDF5 handles far more efficiently than a long
+  list of small hyperslabs.  Results are scattered back into the requested
+  order, which may contain duplicates.
+
+  Parameters
+  ----------
+  rows : sequence of integers, required.
+    Rows to read, in the order they should be returned.  Negative values count
+    from the end.
+  extent : integer, required.
+    Number of rows in the attributes to be read.
+  """
+  minimum_run = 256
+  """Runs shorter than this are read as points instead of slices."""
+
+  def __init__(self, rows, extent):
+    rows = numpy.asarray(rows, dtype="int64")
+    self._shape = rows.shape
+    rows = rows.ravel()
+    if numpy.any(rows >= extent) or numpy.any(rows < -extent):
+      slycat.email.send_error("hdf5.py ReadPlan", "Index out-of-range.")
+      raise IndexError("Index out-of-range.")
+    rows = numpy.where(rows < 0, rows + extent, rows)
+    unique, self._inverse = numpy.unique(rows, return_inverse=True)
+    self._count = len(unique)
+    if numpy.array_equal(self._inverse, numpy.arange(len(rows))):
+      self._inverse = None
+
+    breaks = numpy.flatnonzero(numpy.diff(unique) != 1) + 1
+    begins = numpy.concatenate(([0], breaks)).astype("int64")
+    ends = numpy.concatenate((breaks, [len(unique)])).astype("int64")
+    long = (ends - begins) >= self.minimum_run
+    self.runs = [(int(unique[begin]), int(unique[end - 1]) + 1, int(begin)) for begin, end in zip(begins[long], ends[long])]
+    """List of (start, stop, offset) slices to be read, and their offset into the (sorted, unique) rows."""
+    short = numpy.ones(len(unique), dtype="bool")
+    for start, stop, offset in self.runs:
+      short[offset:offset + stop - start] = False
+    self._point_offsets = numpy.flatnonzero(short)
+    self.points = unique[self._point_offsets]
+    """Sorted rows to be read with a point selection."""
+
+  @property
+  def calls(self):
+    """Return the number of HDF5 reads needed to execute the plan, for each attribute."""
+    return len(self.runs) + (1 if len(self.points) else 0)
+
+  def read(self, dataset):
+    """Read the planned rows from a 1D :class:`h5py.Dataset`, returning them in the requested order."""
+    result = numpy.empty(self._count, dtype=dataset.dtype)
+    for start, stop, offset in self.runs:
+      result[offset:offset + stop - start] = dataset[start:stop]
+    if len(self.points) == len(result) and len(result):
+      result = dataset[self._point_selection(dataset)]
+    elif len(self.points):
+      result[self._point_offsets] = dataset[self._point_selection(dataset)]
+    if self._inverse is not None:
+      result = result[self._inverse]
+    return result.reshape(self._shape)
+
+  def _point_selection(self, dataset):
+    selection = h5py._hl.selections.PointSelection(dataset.shape)
+    selection.set(self.points.reshape((-1, 1)))
+    return selection
+
+class RowWriter(object):
+  """Appends blocks of rows to a 1D darray created with :meth:`ArraySet.start_rows`.
+
+  Each block is written to the file as soon as it is appended, growing the
+  array and merging its statistics, so the whole array never needs to be held
+  in memory.
 
-    # Flush cached statistics.
-    if "min" in attribute_storage.attrs:
-      del attribute_storage.attrs["min"]
-    if "max" in attribute_storage.attrs:
-      del attribute_storage.attrs["max"]
-    if "unique" in attribute_storage.attrs:
-      del attribute_storage.attrs["unique"]
+  Parameters
+  ----------
+  array : :class:`slycat.hdf5.DArray`, required.
+    Empty array with appendable attributes.
+  layout : dict, optional.
+    Storage layout policy used for attributes that change type, see :func:`storage_options`.
+  """
+  def __init__(self, array, layout=None):
+    self.array = array
+    self.layout = layout
+    self.rows = 0
+    """Number of rows appended so far."""
+
+  def append(self, data):
+    """Append a block of rows.
+
+    Parameters
+    ----------
+    data : sequence of :class:`numpy.ndarray`, required.
+      Values for each attribute of the array, all of the same length.
+    """
+    if len(data) != len(self.array.attributes):
+      slycat.email.send_error("hdf5.py RowWriter.append", "Expected data for %s attributes." % len(self.array.attributes))
+      raise ValueError("Expected data for %s attributes." % len(self.array.attributes))
+    if len(set([len(values) for values in data])) > 1:
+      slycat.email.send_error("hdf5.py RowWriter.append", "Attribute data must have the same length.")
+      raise ValueError("Attribute data must have the same length.")
+
+    begin = self.rows
+    end = begin + (len(data[0]) if len(data) else 0)
+    for attribute, values in enumerate(data):
+      self.array._storage["attribute/%s" % attribute].resize((end,))
+      self.array.set_data(attribute, slice(begin, end), values)
+    self.array._metadata["dimension-end"][0] = end
+    self.rows = end
+
+  def retype(self, attribute, type):
+    """Change the type of an attribute, without touching the others.
+
+    The attribute's storage is replaced, so rows that have already been
+    appended are empty strings or zeros until they are stored again with
+    :meth:`fill`.
+
+    Parameters
+    ----------
+    attribute : integer, required.
+      Index of the attribute to change.
+    type : string, required.
+      New attribute type.
+    """
+    storage = self.array._storage
+    stored_type = dtype(type)
+    options = storage_options([2 ** 62], stored_type, {"compression": None} if self.layout is None else self.layout)
+    del storage["attribute/%s" % attribute]
+    storage.create_dataset("attribute/%s" % attribute, (self.rows,), dtype=stored_type, maxshape=(None,), **options).attrs["statistics-count"] = 0
+    for key in ["unique/%s" % attribute, "index/%s" % attribute]:
+      if key in storage:
+        del storage[key]
+    self.array._metadata["attribute-types"][attribute] = type
+    self.array._attributes = None
+    storage.attrs["data-version"] = uuid.uuid4().hex
+
+  def fill(self, attribute, begin, values):
+    """Store values for rows that have already been appended, for one attribute.
+
+    Parameters
+    ----------
+    attribute : integer, required.
+      Index of the attribute to store.
+    begin : integer, required.
+      First row to store.
+    values : :class:`numpy.ndarray`, required.
+      Values to store.
+    """
+    if begin + len(values) > self.rows:
+      slycat.email.send_error("hdf5.py RowWriter.fill", "Rows must be appended before they can be filled.")
+      raise ValueError("Rows must be appended before they can be filled.")
+    self.array.set_data(attribute, slice(begin, begin + len(values)), values)
 
 class ArraySet(object):
-  """Wraps an instance of :class:`h5py.File` to implement a Slycat arrayset."""
-  def __init__(self, file):
+  """Wraps an instance of :class:`h5py.File` to implement a Slycat arrayset.
+
+  If the file is open read-only, statistics and unique values computed by its
+  arrays are kept in the `derived` dict, so they can be shared
+  with other readers and written later using :func:`store_derived`.
+  """
+  def __init__(self, file, derived=None):
     self._storage = file
+    self._derived = {} if derived is None else derived
 
   def __len__(self):
     return len(self._storage["array"])
 
   def __getitem__(self, key):
-    return DArray(self._storage["array/%s" % key])
+    return DArray(self._storage["array/%s" % key], self._derived)
 
   def keys(self):
     return [int(key) for key in self._storage["array"].keys()]
 
+  def get_rows(self, array_index, attributes, rows):
+    """Read the same rows from several attributes of a 1D array.
+
+    The rows are planned once (see :class:`ReadPlan`) and the plan is reused
+    for every attribute.
+
+    Parameters
+    ----------
+    array_index : integer, required.
+      Index of the array to read.
+    attributes : sequence of integers, required.
+      Attributes to read.
+    rows : sequence of integers, required.
+      Rows to read, in the order they should be returned.
+
+    Returns
+    -------
+    data : list of :class:`numpy.ndarray`, one per attribute.
+    """
+    array = self[array_index]
+    plan = ReadPlan(rows, array.shape[0])
+    return [array.get_data(attribute).read_rows(plan) for attribute in attributes]
+
   def array_count(self):
     """Note: this assumes that array indices are contiguous, which we don't explicitly enforce."""
     return len(self._storage["array"].keys())
 
-  def start_array(self, array_index, dimensions, attributes):
+  def start_array(self, array_index, dimensions, attributes, layout=None):
     """Add an uninitialized darray to the arrayset.
 
     An existing array with the same index will be overwritten.
@@ -234,15 +579,55 @@ class ArraySet(object):
       Description of the new array dimensions.
     attributes : list of dicts, required.
       Description of the new array attributes.
+    layout : dict, optional.
+      Storage layout policy for the new attributes, see :func:`storage_options`.
+      By default, attributes are stored contiguously without compression.
 
     Returns
     -------
     array : :class:`slycat.hdf5.DArray`
     """
+    return self._start_array(array_index, dimensions, attributes, layout, appendable=False)
+
+  def start_rows(self, array_index, attributes, layout=None, dimension="row"):
+    """Add an empty 1D darray to the arrayset, to be filled by appending blocks of rows.
+
+    Unlike :meth:`start_array`, the number of rows doesn't need to be known in
+    advance, so data can be stored as it is parsed.  An existing array with the
+    same index will be overwritten.
+
+    Parameters
+    ----------
+    array_index : integer, required.
+      Zero-based index of the array to create.
+    attributes : list of dicts, required.
+      Description of the new array attributes.
+    layout : dict, optional.
+      Storage layout policy for the new attributes, see :func:`storage_options`.
+      Appendable attributes must be chunked, so by default they are stored in
+      uncompressed chunks.
+    dimension : string, optional.
+      Name of the array dimension.
+
+    Returns
+    -------
+    writer : :class:`slycat.hdf5.RowWriter`
+    """
+    dimensions = [{"name": dimension, "type": "int64", "begin": 0, "end": 0}]
+    return RowWriter(self._start_array(array_index, dimensions, attributes, layout, appendable=True), layout)
+
+  def _start_array(self, array_index, dimensions, attributes, layout, appendable):
     cherrypy.log.error("building start_array for put_model_array")
     stub = slycat.darray.Stub(dimensions, attributes)
     shape = [dimension["end"] - dimension["begin"] for dimension in stub.dimensions]
     stored_types = [dtype(attribute["type"]) for attribute in stub.attributes]
+    if appendable:
+      # Chunk sizes are computed for an unlimited number of rows.
+      options = [storage_options([2 ** 62], stored_type, {"compression": None} if layout is None else layout) for stored_type in stored_types]
+      maxshape = (None,)
+    else:
+      options = [storage_options(shape, stored_type, layout) for stored_type in stored_types]
+      maxshape = None
 
     cherrypy.log.error("allocating space for start_array for put_model_array")
     try:
@@ -251,13 +636,15 @@ class ArraySet(object):
       if array_key in self._storage:
         del self._storage[array_key]
       for attribute_index, stored_type in enumerate(stored_types):
-        self._storage.create_dataset("array/%s/attribute/%s" % (array_index, attribute_index), shape, dtype=stored_type)
+        attribute = self._storage.create_dataset("array/%s/attribute/%s" % (array_index, attribute_index), shape, dtype=stored_type, maxshape=maxshape, **options[attribute_index])
+        attribute.attrs["statistics-count"] = 0
     except Exception as e:
       pass
 
     cherrypy.log.error("storing metadata for start_array for put_model_array")
     # Store array metadata ...
     array_metadata = self._storage[array_key].create_group("metadata")
+    self._storage[array_key].attrs["data-version"] = uuid.uuid4().hex
     array_metadata["attribute-names"] = numpy.array([attribute["name"] for attribute in stub.attributes], dtype=h5py.special_dtype(vlen=unicode))
     array_metadata["attribute-types"] = numpy.array([attribute["type"] for attribute in stub.attributes], dtype=h5py.special_dtype(vlen=unicode))
     array_metadata["dimension-names"] = numpy.array([dimension["name"] for dimension in stub.dimensions], dtype=h5py.special_dtype(vlen=unicode))
@@ -268,7 +655,7 @@ class ArraySet(object):
     cherrypy.log.error("returning Darray for start_array for put_model_array")
     return DArray(self._storage[array_key])
 
-  def store_array(self, array_index, array):
+  def store_array(self, array_index, array, layout=None):
     """Store a :class:`slycat.darray.Prototype` in the arrayset.
 
     An existing array with the same index will be overwritten.
@@ -279,6 +666,8 @@ class ArraySet(object):
       The index of the array to be created / overwritten.
     array : :class:`slycat.darray.Prototype`, required.
       Existing darray to be stored.
+    layout : dict, optional.
+      Storage layout policy for the new attributes, see :func:`storage_options`.
 
     Returns
     -------
@@ -290,17 +679,14 @@ class ArraySet(object):
 
     index = tuple([slice(dimension["begin"], dimension["end"]) for dimension in array.dimensions])
 
-    self.start_array(array_index, array.dimensions, array.attributes)
+    hdf5_array = self.start_array(array_index, array.dimensions, array.attributes, layout)
     for attribute_index, attribute in enumerate(array.attributes):
-      stored_type = dtype(attribute["type"])
       data = array.get_data(attribute_index)
 
       # Store the data ...
-      attribute_key = "array/%s/attribute/%s" % (array_index, attribute_index)
-      hdf5_attribute = self._storage[attribute_key]
-      hdf5_attribute[index] = data
+      hdf5_array.set_data(attribute_index, index, numpy.asarray(data[...]).astype(dtype(attribute["type"])))
 
-    return DArray(self._storage["array/%s" % array_index])
+    return hdf5_array
 
 def start_arrayset(file):
   """Create a new array set using an open hdf5 file.
@@ -320,6 +706,185 @@ def start_arrayset(file):
   file.create_group("array")
   return ArraySet(file)
 
+def storage_options(shape, stored_type, layout=None):
+  """Return :meth:`h5py.Group.create_dataset` keyword arguments implementing a storage layout policy.
+
+  Parameters
+  ----------
+  shape : sequence of integers, required.
+    Shape of the dataset to be created.
+  stored_type : :class:`numpy.dtype`, required.
+    Type of the dataset to be created.
+  layout : dict, optional.
+    Layout policy, with optional keys "chunk-size" (target chunk size in bytes,
+    default 64 KiB), "compression" (None, "gzip", or "lzf", default "lzf"),
+    "compression-level" (gzip only, default 4), and "shuffle" (default False).
+    If None, the dataset will be contiguous and uncompressed.
+
+  Returns
+  -------
+  options : dict
+  """
+  if layout is None or 0 in shape or len(shape) == 0:
+    return {}
+
+  compression = layout.get("compression", "lzf")
+  if compression not in [None, "gzip", "lzf"]:
+    slycat.email.send_error("hdf5.py storage_options", "Unsupported compression: %s" % compression)
+    raise ValueError("Unsupported compression: %s" % compression)
+
+  # Variable-length strings are stored as pointers into the file heap, so there's nothing for a filter to compress.
+  stored_type = numpy.dtype(stored_type)
+  variable_length = h5py.check_dtype(vlen=stored_type) is not None
+  item_size = 16 if variable_length else stored_type.itemsize
+
+  # Keep trailing dimensions whole, so row-major hyperslices map to as few chunks as possible.
+  remaining = max(1, layout.get("chunk-size", 64 * 1024) // item_size)
+  chunks = []
+  for extent in reversed(shape):
+    chunks.insert(0, int(max(1, min(extent, remaining))))
+    remaining = max(1, remaining // extent)
+
+  options = {"chunks": tuple(chunks)}
+  if compression is not None and not variable_length:
+    options["compression"] = compression
+    if compression == "gzip":
+      options["compression_opts"] = layout.get("compression-level", 4)
+    options["shuffle"] = layout.get("shuffle", False)
+  return options
+
+def store_derived(file, derived):
+  """Write derived data computed by a read-only :class:`ArraySet` back to its file.
+
+  Parameters
+  ----------
+  file : :class:`h5py.File`, required.
+    The same file that the derived data was computed from, open for writing.
+  derived : dict, required.
+    Derived data collected by :class:`ArraySet`.
+  """
+  for (array_key, kind, attribute), value in derived.items():
+    if array_key not in file:
+      continue
+    if kind == "statistics":
+      DArray(file[array_key])._store_statistics(attribute, *value)
+
+unique_limit = 100000
+"""Maximum number of unique values tracked while an attribute is being written."""
+
+_statistics_keys = ["min", "max", "unique", "nan-count", "statistics-count", "statistics-extents", "unique-overflow"]
+
+def _merge_statistics(statistics, unique, data):
+  """Merge a block of attribute data into running statistics, returning the updated unique values."""
+  track_unique = not statistics.get("unique-overflow", False)
+  block = _block_statistics(data, track_unique)
+
+  if block["min"] is not None:
+    statistics["min"] = block["min"] if "min" not in statistics else min(block["min"], statistics["min"])
+    statistics["max"] = block["max"] if "max" not in statistics else max(block["max"], statistics["max"])
+  statistics["nan-count"] = statistics.get("nan-count", 0) + block["nan-count"]
+  statistics["statistics-count"] = statistics.get("statistics-count", 0) + numpy.asarray(data).size
+
+  if not track_unique:
+    return None
+  if block["unique"] is not None:
+    unique = block["unique"] if unique is None else numpy.union1d(unique, block["unique"])
+    if len(unique) <= unique_limit:
+      return unique
+  statistics["unique-overflow"] = True
+  return None
+
+def _unique(data):
+  """Return the sorted unique values in a block of attribute data, ignoring NaNs."""
+  data = numpy.asarray(data).ravel()
+  if data.dtype.char not in ["O", "S", "U"]:
+    data = data[numpy.invert(numpy.isnan(data))]
+  return numpy.unique(data)
+
+def _block_statistics(data, track_unique):
+  """Compute min, max, NaN count and (up to :data:`unique_limit`) unique values for a block of attribute data."""
+  data = numpy.asarray(data).ravel()
+  result = {"min": None, "max": None, "nan-count": 0, "unique": None}
+  if data.dtype.char in ["O", "S", "U"]:
+    valid = data
+    if len(valid):
+      result["min"] = min(valid)
+      result["max"] = max(valid)
+  else:
+    nans = numpy.isnan(data) if data.dtype.kind == "f" else None
+    result["nan-count"] = 0 if nans is None else int(numpy.count_nonzero(nans))
+    valid = data[numpy.invert(nans)] if result["nan-count"] else data
+    if len(valid):
+      result["min"] = valid.min().item()
+      result["max"] = valid.max().item()
+
+  if track_unique:
+    # Avoid sorting large, high-cardinality blocks when a prefix is enough to know they'll exceed the limit.
+    if len(valid) > 2 * unique_limit and len(numpy.unique(valid[:2 * unique_limit])) > unique_limit:
+      return result
+    unique = numpy.unique(valid)
+    if len(unique) <= unique_limit:
+      result["unique"] = unique
+  return result
+
+def _statistics_complete(attribute):
+  """Return True if statistics have been accumulated for every element of an attribute."""
+  return "statistics-count" in attribute.attrs and attribute.attrs["statistics-count"] == numpy.prod(attribute.shape)
+
+def _clear_statistics(attribute):
+  for key in _statistics_keys:
+    if key in attribute.attrs:
+      del attribute.attrs[key]
+
+def _expand_hyperslice(hyperslice, shape):
+  """Return a hyperslice as a tuple with one item per dimension, replacing Ellipsis."""
+  if not isinstance(hyperslice, tuple):
+    hyperslice = (hyperslice,)
+  if any(isinstance(item, type(Ellipsis)) for item in hyperslice):
+    position = [isinstance(item, type(Ellipsis)) for item in hyperslice].index(True)
+    hyperslice = hyperslice[:position] + (slice(None),) * (len(shape) - len(hyperslice) + 1) + hyperslice[position + 1:]
+  return hyperslice + (slice(None),) * (len(shape) - len(hyperslice))
+
+def _selection_box(hyperslice, shape):
+  """Return the region selected by a hyperslice as an array of [begin, end) pairs, one per dimension.
+
+  Returns None for selections that aren't a single contiguous box, such as
+  slices with a step.
+  """
+  box = []
+  for item, extent in zip(_expand_hyperslice(hyperslice, shape), shape):
+    if isinstance(item, slice):
+      begin, end, step = item.indices(extent)
+      if step != 1:
+        return None
+      box.append((begin, max(begin, end)))
+    else:
+      begin = item + extent if item < 0 else item
+      box.append((begin, begin + 1))
+  return numpy.array(box, dtype="int64").reshape((len(shape), 2))
+
+def _overlaps(extents, box):
+  """Return True if a box overlaps any of the boxes already written to an attribute."""
+  if extents is None or numpy.prod(box[:, 1] - box[:, 0]) == 0:
+    return False
+  return bool(numpy.any(numpy.all((extents[:, :, 0] < box[:, 1]) & (box[:, 0] < extents[:, :, 1]), axis=1)))
+
+def _add_extent(extents, box):
+  """Add a box to the boxes written to an attribute.
+
+  A box that continues the last one along the first dimension (an appended
+  block of rows, for example) extends it, so sequential writes are tracked
+  with a single box.
+  """
+  if extents is None:
+    return box[numpy.newaxis]
+  last = extents[-1]
+  if last[0, 1] == box[0, 0] and numpy.array_equal(last[1:], box[1:]):
+    extents = numpy.array(extents)
+    extents[-1, 0, 1] = box[0, 1]
+    return extents
+  return numpy.concatenate((extents, box[numpy.newaxis]))
+
 ################################################################################################################################################
 # Legacy functionality - don't use these in new code.
 
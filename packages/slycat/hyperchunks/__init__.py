@@ -97,6 +97,204 @@ def arrays(hyperchunks, array_count):
         slycat.email.send_error("hyperchunks.__init__.py", "Unexpected array: %r" % arrays)
         raise ValueError("Unexpected array: %r" % arrays)
 
+def compile(expression):
+  """Compile a hyperchunk attribute expression into an evaluation plan.
+
+  Parameters
+  ----------
+  expression: attribute expression from a parsed hyperchunk.
+
+  Returns
+  -------
+  plan: :class:`slycat.hyperchunks.Plan`
+  """
+  return Plan(expression)
+
+class Plan(object):
+  """Evaluation plan for a hyperchunk attribute expression.
+
+  The expression tree is walked once, at construction time, and turned into a
+  tree of numpy operations.  Evaluating the plan against a darray reads each
+  referenced attribute at most once per cache, combines boolean results in
+  place, and - when the expression is element-wise - reads only the requested
+  hyperslice instead of the whole attribute.
+  """
+  def __init__(self, expression):
+    self._expression = expression
+    self._attributes = set()
+    self._elementwise = True
+    self._root = self._compile(expression)
+
+  @property
+  def expression(self):
+    return self._expression
+
+  @property
+  def attributes(self):
+    """Sorted list of attribute indices read by the plan."""
+    return sorted(self._attributes)
+
+  @property
+  def elementwise(self):
+    """True if each result element only depends on the same element of its inputs."""
+    return self._elementwise
+
+  def evaluate(self, array, hyperslice=None, cache=None):
+    """Evaluate the plan against a darray.
+
+    Parameters
+    ----------
+    array: :class:`slycat.darray.Prototype`, required.
+    hyperslice: tuple, optional.
+      Return just this region of the result.
+    cache: dict, optional.
+      Attribute data and intermediate results already read from `array`.
+      Share one cache between plans evaluated against the same array to read
+      each attribute only once.
+
+    Returns
+    -------
+    values: numpy.ndarray, or the constant value of a literal expression.
+    """
+    if cache is None:
+      cache = {}
+    if hyperslice is None:
+      return self._root(array, None, cache)
+    region = _region(hyperslice, array.shape) if self._elementwise else None
+    if region is None:
+      values = self._root(array, None, cache)
+      return values[hyperslice] if isinstance(values, numpy.ndarray) else values
+    return self._root(array, region, cache)
+
+  def _compile(self, expression):
+    if isinstance(expression, (int, float, basestring)):
+      return lambda array, region, cache: expression
+    elif isinstance(expression, slycat.hyperchunks.grammar.List):
+      values = expression.values
+      return lambda array, region, cache: values
+    elif isinstance(expression, slycat.hyperchunks.grammar.AttributeIndex):
+      index = expression.index
+      self._attributes.add(index)
+      return lambda array, region, cache: _read(array, index, region, cache)
+    elif isinstance(expression, slycat.hyperchunks.grammar.BinaryOperator):
+      return self._compile_operator(expression)
+    elif isinstance(expression, slycat.hyperchunks.grammar.FunctionCall):
+      return self._compile_function(expression)
+    slycat.email.send_error("hyperchunks.__init__.py", "Unknown expression: %s" % expression)
+    raise ValueError("Unknown expression: %s" % expression)
+
+  def _compile_operator(self, expression):
+    operator = expression.operator
+    operands = [self._compile(operand) for operand in expression.operands]
+
+    if operator in ["and", "or"]:
+      combine = numpy.logical_and if operator == "and" else numpy.logical_or
+      def evaluate(array, region, cache):
+        left = numpy.array(operands[0](array, region, cache), dtype="bool")
+        for operand in operands[1:]:
+          combine(left, operand(array, region, cache), out=left)
+        return left
+      return evaluate
+
+    if operator in _comparisons:
+      compare = _comparisons[operator]
+    elif operator == "in":
+      compare = lambda left, right: numpy.in1d(left, right).reshape(numpy.shape(left))
+    elif operator == "not in":
+      compare = lambda left, right: numpy.in1d(left, right, invert=True).reshape(numpy.shape(left))
+    else:
+      slycat.email.send_error("hyperchunks.__init__.py", "Unknown operator: %s" % operator)
+      raise ValueError("Unknown operator: %s" % operator)
+
+    def evaluate(array, region, cache):
+      left = operands[0](array, region, cache)
+      for operand in operands[1:]:
+        left = compare(left, operand(array, region, cache))
+      return left
+    return evaluate
+
+  def _compile_function(self, expression):
+    if expression.name == "index":
+      dimension = expression.args[0]
+      def evaluate(array, region, cache):
+        key = ("index", dimension)
+        if key not in cache:
+          if len(array.shape) == 1:
+            cache[key] = numpy.arange(array.shape[0])
+          else:
+            cache[key] = numpy.indices(array.shape)[dimension]
+        return cache[key] if region is None else cache[key][region]
+      return evaluate
+    elif expression.name == "rank":
+      values = self._compile(expression.args[0])
+      descending = len(expression.args) > 1 and expression.args[1] == "desc"
+      key = ("rank", tostring(expression))
+      self._elementwise = False
+      def evaluate(array, region, cache):
+        if key not in cache:
+          order = numpy.argsort(values(array, None, cache))
+          cache[key] = order[::-1] if descending else order
+        return cache[key]
+      return evaluate
+    slycat.email.send_error("hyperchunks.__init__.py", "Unknown function: %s" % expression.name)
+    raise ValueError("Unknown function: %s" % expression.name)
+
+def _equal(left, right):
+  if isinstance(right, float) and numpy.isnan(right):
+    return numpy.isnan(left)
+  return numpy.equal(left, right)
+
+_comparisons = {
+  "<": numpy.less,
+  ">": numpy.greater,
+  "<=": numpy.less_equal,
+  ">=": numpy.greater_equal,
+  "==": _equal,
+  "!=": numpy.not_equal,
+  }
+
+def _read(array, index, region, cache):
+  """Read attribute data, reusing anything already in the cache."""
+  if ("attribute", index, None) in cache:
+    values = cache[("attribute", index, None)]
+    return values if region is None else values[region]
+  key = ("attribute", index, None if region is None else repr(region))
+  if key not in cache:
+    cache[key] = array.get_data(index)[Ellipsis if region is None else region]
+  return cache[key]
+
+def _region(hyperslice, shape):
+  """Convert a hyperslice into explicit, non-negative extents that can be read directly from storage.
+
+  Returns None if the hyperslice can't be applied before reading the data.
+  """
+  if not isinstance(hyperslice, tuple):
+    hyperslice = (hyperslice,)
+  if any(isinstance(item, type(Ellipsis)) for item in hyperslice):
+    if len([item for item in hyperslice if isinstance(item, type(Ellipsis))]) > 1:
+      return None
+    position = [isinstance(item, type(Ellipsis)) for item in hyperslice].index(True)
+    fill = (slice(None),) * (len(shape) - len(hyperslice) + 1)
+    hyperslice = hyperslice[:position] + fill + hyperslice[position + 1:]
+  if len(hyperslice) > len(shape):
+    return None
+  region = []
+  for item, extent in zip(hyperslice, shape):
+    if isinstance(item, numbers.Integral):
+      if item < 0:
+        item += extent
+      if not 0 <= item < extent:
+        return None
+      region.append(int(item))
+    elif isinstance(item, slice):
+      start, stop, step = item.indices(extent)
+      if step < 1 or stop <= start:
+        return None
+      region.append(slice(start, stop, step))
+    else:
+      return None
+  return tuple(region)
+
 def tostring(value):
   """Convert hyperchunks to their string representation.
   """
@@ -0,0 +1,53 @@
+# Copyright 2013, Sandia Corporation. Under the terms of Contract
+# DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
+# rights in this software.
+
+"""JSON encoding for numpy arrays.
+
+Arrays are encoded as (nested) JSON arrays, with NaN values encoded as null,
+producing the same text as the standard library's encoder.  Floats are
+formatted by repr, which numpy can't do any faster, except in columns that
+only contain whole numbers, which are formatted in bulk as integers.
+"""
+
+import json
+import numpy
+
+def _whole_numbers(array, nan):
+  """Encode a 1D float array whose values are all whole numbers or NaN, returning None for any other array."""
+  numbers = array[~nan]
+  # repr() switches to exponents at 1e16, and int64 can't hold -0.0.
+  if not len(numbers) or numpy.abs(numbers).max() >= 1e16 or (numpy.floor(numbers) != numbers).any() or numpy.signbit(numbers[numbers == 0]).any():
+    return None
+  strings = map(str, numpy.where(nan, 0, array).astype("int64").tolist())
+  for index in numpy.flatnonzero(nan).tolist():
+    strings[index] = "null"
+  # Numbers can't contain "null", so its suffix can be removed wholesale.
+  return ("[" + ".0, ".join(strings) + ".0]").replace("null.0", "null")
+
+def dumps(array):
+  """Encode an array as JSON, returning a string.
+
+  Parameters
+  ----------
+  array : :class:`numpy.ndarray` or array-like, required.
+    Data to be encoded.  NaNs in floating-point arrays are encoded as null.
+  """
+  array = numpy.asarray(array)
+  if array.dtype.kind != "f":
+    return json.dumps(array.tolist())
+  nan = numpy.isnan(array)
+  if array.ndim == 1:
+    text = _whole_numbers(array, nan)
+    if text is not None:
+      return text
+  text = json.dumps(array.tolist())
+  # The JSON encoder writes NaN as the (non-standard) token NaN, which can't
+  # appear in any other number, so it can be replaced wholesale.
+  if nan.any():
+    text = text.replace("NaN", "null")
+  return text
+
+def dumps_list(arrays):
+  """Encode a sequence of arrays as a JSON array of arrays, returning a string."""
+  return "[" + ", ".join([dumps(array) for array in arrays]) + "]"
@@ -13,6 +13,7 @@ import os
 import requests
 import requests.exceptions as exceptions
 import shlex
+import slycat.columnar
 import slycat.darray
 import slycat.email
 import sys
@@ -350,6 +351,29 @@ class Connection(object):
     """
     return self.request("GET", "/models/%s" % mid, headers={"accept":"application/json"})
 
+  def get_model_arrayset_data(self, mid, aid, hyperchunks):
+    """Retrieve data from an existing model arrayset artifact.
+
+    Parameters
+    ----------
+    mid: string, required
+      The unique model identifier.
+    aid: string, required
+      The unique artifact identifier.
+    hyperchunks: string, required
+      Specifies the data to be retrieved, in :ref:`Hyperchunks` format.
+
+    Returns
+    -------
+    data: list of numpy.ndarray data chunks, one per hyperslice.
+
+    See Also
+    --------
+    :http:get:`/models/(mid)/arraysets/(aid)/data`
+    """
+    data = self.request("GET", "/models/%s/arraysets/%s/data" % (mid, aid), params={"hyperchunks": hyperchunks, "byteorder": sys.byteorder}, headers={"accept": slycat.columnar.content_type})
+    return slycat.columnar.decode(data)
+
   def get_model_arrayset_metadata(self, mid, aid, arrays=None, statistics=None, unique=None):
     """Retrieve metadata describing an existing model arrayset artifact.
 
@@ -13,11 +13,16 @@ import slycat.email
 import slycat.hdf5
 import slycat.hyperchunks
 import slycat.web.server.hdf5
+import slycat.web.server.progress
 import slycat.web.server.remote
+import slycat.web.server.sessions
+import slycat.web.server.sort_index
 from slycat.web.server.cache import Cache
 from cherrypy._cpcompat import base64_decode
 import urlparse
 import functools
+import threading
+import time
 
 config = {}
 cache_it = Cache(seconds=1000000)  # 277.777778 hours
@@ -29,79 +34,80 @@ def mix(a, b, amount):
 
 
 # @cache_it
-def evaluate(hdf5_array, expression, expression_type, expression_level=0):
-    """Evaluate a hyperchunk expression."""
+def evaluate(hdf5_array, expression, expression_type, expression_level=0, hyperslice=None, cache=None):
+    """Evaluate a hyperchunk expression.
+
+    The expression is compiled with :func:`slycat.hyperchunks.compile`; pass the
+    same `cache` dict to every call against one array to share attribute reads
+    between expressions.
+    """
     cherrypy.log.error("%sEvaluating %s expression: %s" % (
         "  " * expression_level, expression_type, slycat.hyperchunks.tostring(expression)))
-    if isinstance(expression, int):
-        return expression
-    elif isinstance(expression, float):
-        return expression
-    elif isinstance(expression, basestring):
-        return expression
-    elif isinstance(expression, slycat.hyperchunks.grammar.AttributeIndex):
-        return hdf5_array.get_data(expression.index)[...]
-    elif isinstance(expression, slycat.hyperchunks.grammar.BinaryOperator):
-        left = evaluate(hdf5_array, expression.operands[0], expression_type, expression_level + 1)
-        for operand in expression.operands[1:]:
-            right = evaluate(hdf5_array, operand, expression_type, expression_level + 1)
-            # cherrypy.log.error("left::%s \n right::%s" % (left, right))
-            if expression.operator == "<":
-                left = left < right
-            elif expression.operator == ">":
-                left = left > right
-            elif expression.operator == "<=":
-                left = left <= right
-            elif expression.operator == ">=":
-                left = left >= right
-            elif expression.operator == "==":
-                if numpy.isnan(right):
-                    left = numpy.isnan(left)
-                else:
-                    left = left == right
-            elif expression.operator == "!=":
-                left = left != right
-            elif expression.operator == "and":
-                left = numpy.logical_and(left, right)
-            elif expression.operator == "or":
-                left = numpy.logical_or(left, right)
-            elif expression.operator == "in":
-                left = numpy.in1d(left, right)
-            elif expression.operator == "not in":
-                left = numpy.in1d(left, right, invert=True)
-            else:
-                slycat.email.send_error("slycat.web.server.__init__.py evaluate",
-                                        "Unknown operator: %s" % expression.operator)
-                raise ValueError("Unknown operator: %s" % expression.operator)
-        return left
-    elif isinstance(expression, slycat.hyperchunks.grammar.FunctionCall):
-        if expression.name == "index":
-            return numpy.indices(hdf5_array.shape)[expression.args[0]]
-        elif expression.name == "rank":
-            values = evaluate(hdf5_array, expression.args[0], expression_type, expression_level + 1)
-            order = numpy.argsort(values)
-            if expression.args[1] == "desc":
-                order = order[::-1]
-            return order
-        else:
-            slycat.email.send_error("slycat.web.server.__init__.py evaluate", "Unknown function: %s" % expression.name)
-            raise ValueError("Unknown function: %s" % expression.name)
-    elif isinstance(expression, slycat.hyperchunks.grammar.List):
-        return expression.values
-    else:
-        slycat.email.send_error("slycat.web.server.__init__.py evaluate", "Unknown expression: %s" % expression)
-        raise ValueError("Unknown expression: %s" % expression)
+    return slycat.hyperchunks.compile(expression).evaluate(hdf5_array, hyperslice, cache)
 
 
 def update_model(database, model, **kwargs):
     """
   Update the model, and signal any waiting threads that it's changed.
   will only update model base on "state", "result", "started", "finished", "progress", "message"
+  progress and message updates are coalesced and written at most once per
+  "model-progress-interval", see :class:`slycat.web.server.progress.Reporter`
   """
-    for name, value in kwargs.items():
-        if name in ["state", "result", "started", "finished", "progress", "message"]:
-            model[name] = value
-    database.save(model)
+    slycat.web.server.progress.reporter.update(database, model, **kwargs)
+
+
+class ProjectListCache(object):
+    """Cache of the projects that each user can read.
+
+    Projects are looked up with the slycat/project-acl view, which has one row
+    per (user, project) ACL entry, so a user's list costs one indexed query
+    instead of a scan of every project.  Cached lists are discarded whenever
+    this server writes a project (see :meth:`invalidate`), and after `timeout`
+    seconds in case projects are written by another process.
+    """
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._projects = {}
+        self._generation = 0
+
+    @property
+    def timeout(self):
+        """Seconds that a cached list is used before it's looked up again."""
+        if self._timeout is None:
+            self._timeout = cherrypy.tree.apps[""].config["slycat-web-server"].get("project-list-cache-timeout", 300)
+        return self._timeout
+
+    def get(self, database, user=None):
+        """Return the projects that a user can read, newest first, or every project if user is None."""
+        with self._lock:
+            generation = self._generation
+            entry = self._projects.get(user)
+        if entry is not None and time.time() - entry[0] < self.timeout:
+            return entry[1]
+
+        if user is None:
+            projects = list(database.scan("slycat/projects"))
+        else:
+            # There is one row per role, so a project can appear more than once.
+            projects = dict((project["_id"], project) for project in
+                            database.scan("slycat/project-acl", startkey=user, endkey=user)).values()
+        projects = sorted(projects, key=lambda x: x["created"], reverse=True)
+
+        # Don't cache a list that was looked up while a project was being written.
+        with self._lock:
+            if generation == self._generation:
+                self._projects[user] = (time.time(), projects)
+        return projects
+
+    def invalidate(self):
+        """Discard every cached list, called whenever a project is created, modified, or deleted."""
+        with self._lock:
+            self._projects = {}
+            self._generation += 1
+
+
+project_lists = ProjectListCache()
 
 
 @cache_it
@@ -138,76 +144,74 @@ def get_model_arrayset_metadata(database, model, aid, arrays=None, statistics=No
 
     # Handle legacy behavior.
     if arrays is None and statistics is None and unique is None:
-        with slycat.web.server.hdf5.lock:
-            with slycat.web.server.hdf5.open(model["artifact:%s" % aid], "r+") as file:
-                hdf5_arrayset = slycat.hdf5.ArraySet(file)
-                results = []
-                for array in sorted(hdf5_arrayset.keys()):
-                    hdf5_array = hdf5_arrayset[array]
-                    results.append({
-                        "array": int(array),
-                        "index": int(array),
-                        "dimensions": hdf5_array.dimensions,
-                        "attributes": hdf5_array.attributes,
-                        "shape": tuple([dimension["end"] - dimension["begin"] for dimension in hdf5_array.dimensions]),
-                    })
-                return results
-
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(model["artifact:%s" % aid],
-                                         "r+") as file:  # We have to open the file with writing enabled in case the statistics cache needs to be updated.
+        with slycat.web.server.hdf5.pool.reader(model["artifact:%s" % aid]) as file:
             hdf5_arrayset = slycat.hdf5.ArraySet(file)
-            results = {}
-            if arrays is not None:
-                results["arrays"] = []
-                for array in slycat.hyperchunks.arrays(arrays, hdf5_arrayset.array_count()):
-                    hdf5_array = hdf5_arrayset[array.index]
-                    results["arrays"].append({
-                        "index": array.index,
-                        "dimensions": hdf5_array.dimensions,
-                        "attributes": hdf5_array.attributes,
-                        "shape": tuple([dimension["end"] - dimension["begin"] for dimension in hdf5_array.dimensions]),
-                    })
-            if statistics is not None:
-                results["statistics"] = []
-                for array in slycat.hyperchunks.arrays(statistics, hdf5_arrayset.array_count()):
-                    hdf5_array = hdf5_arrayset[array.index]
-                    for attribute in array.attributes(len(hdf5_array.attributes)):
-                        statistics = {}
-                        statistics["array"] = array.index
-                        if isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
-                            statistics["attribute"] = attribute.expression.index
-                            statistics.update(hdf5_array.get_statistics(attribute.expression.index))
-                        else:
-                            values = evaluate(hdf5_array, attribute.expression, "statistics")
-                            statistics["min"] = values.min()
-                            statistics["max"] = values.max()
-                            statistics["unique"] = len(numpy.unique(values))
-                        results["statistics"].append(statistics)
-
-            if unique is not None:
-                results["unique"] = []
-                for array in slycat.hyperchunks.arrays(unique, hdf5_arrayset.array_count()):
-                    hdf5_array = hdf5_arrayset[array.index]
-                    for attribute in array.attributes(len(hdf5_array.attributes)):
-                        unique = {}
-                        unique["array"] = array.index
-                        unique["values"] = []
-                        if isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
-                            for hyperslice in attribute.hyperslices():
-                                unique["attribute"] = attribute.expression.index
-                                unique["values"].append(
-                                    hdf5_array.get_unique(attribute.expression.index, hyperslice)["values"])
-                        else:
-                            values = evaluate(hdf5_array, attribute.expression, "uniques")
-                            for hyperslice in attribute.hyperslices():
-                                unique["values"].append(numpy.unique(values)[hyperslice])
-                        if isinstance(unique["values"][0], list):
-                            unique["values"] = [a.tolist() for a in unique["values"]]
-                        results["unique"].append(unique)
-
+            results = []
+            for array in sorted(hdf5_arrayset.keys()):
+                hdf5_array = hdf5_arrayset[array]
+                results.append({
+                    "array": int(array),
+                    "index": int(array),
+                    "dimensions": hdf5_array.dimensions,
+                    "attributes": hdf5_array.attributes,
+                    "shape": tuple([dimension["end"] - dimension["begin"] for dimension in hdf5_array.dimensions]),
+                })
             return results
 
+    with slycat.web.server.hdf5.pool.arrayset(model["artifact:%s" % aid]) as hdf5_arrayset:
+        results = {}
+        if arrays is not None:
+            results["arrays"] = []
+            for array in slycat.hyperchunks.arrays(arrays, hdf5_arrayset.array_count()):
+                hdf5_array = hdf5_arrayset[array.index]
+                results["arrays"].append({
+                    "index": array.index,
+                    "dimensions": hdf5_array.dimensions,
+                    "attributes": hdf5_array.attributes,
+                    "shape": tuple([dimension["end"] - dimension["begin"] for dimension in hdf5_array.dimensions]),
+                })
+        if statistics is not None:
+            results["statistics"] = []
+            for array in slycat.hyperchunks.arrays(statistics, hdf5_arrayset.array_count()):
+                hdf5_array = hdf5_arrayset[array.index]
+                cache = {}
+                for attribute in array.attributes(len(hdf5_array.attributes)):
+                    statistics = {}
+                    statistics["array"] = array.index
+                    if isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
+                        statistics["attribute"] = attribute.expression.index
+                        statistics.update(hdf5_array.get_statistics(attribute.expression.index))
+                    else:
+                        values = evaluate(hdf5_array, attribute.expression, "statistics", cache=cache)
+                        statistics["min"] = values.min()
+                        statistics["max"] = values.max()
+                        statistics["unique"] = len(numpy.unique(values))
+                    results["statistics"].append(statistics)
+
+        if unique is not None:
+            results["unique"] = []
+            for array in slycat.hyperchunks.arrays(unique, hdf5_arrayset.array_count()):
+                hdf5_array = hdf5_arrayset[array.index]
+                cache = {}
+                for attribute in array.attributes(len(hdf5_array.attributes)):
+                    unique = {}
+                    unique["array"] = array.index
+                    unique["values"] = []
+                    if isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
+                        for hyperslice in attribute.hyperslices():
+                            unique["attribute"] = attribute.expression.index
+                            unique["values"].append(
+                                hdf5_array.get_unique(attribute.expression.index, hyperslice)["values"])
+                    else:
+                        values = numpy.unique(evaluate(hdf5_array, attribute.expression, "uniques", cache=cache))
+                        for hyperslice in attribute.hyperslices():
+                            unique["values"].append(values[hyperslice])
+                    if isinstance(unique["values"][0], list):
+                        unique["values"] = [a.tolist() for a in unique["values"]]
+                    results["unique"].append(unique)
+
+        return results
+
 
 @cache_it
 def get_model_arrayset_data(database, model, aid, hyperchunks):
@@ -227,25 +231,55 @@ def get_model_arrayset_data(database, model, aid, hyperchunks):
   See Also
   --------
   :http:get:`/models/(mid)/arraysets/(aid)/data`
+  :func:`iter_model_arrayset_data`
+  """
+    return list(iter_model_arrayset_data(database, model, aid, hyperchunks))
+
+
+def iter_model_arrayset_data(database, model, aid, hyperchunks):
+    """
+  Read data from an arrayset artifact, one attribute at a time, without caching.
+  The arrayset is only locked while each attribute is read, so callers can
+  stream hyperslices to a client without holding up writers.
+  Parameters
+  ----------
+  database: database object, required
+  model: model object, required
+  aid: string, required
+    Unique (to the model) arrayset artifact id.
+  hyperchunks: string or hyperchunks parse tree, required
+    Specifies the data to be retrieved, in :ref:`Hyperchunks` format.
+  Returns
+  -------
+  data: generator of numpy.ndarray data chunks.
   """
     if isinstance(hyperchunks, basestring):
         hyperchunks = slycat.hyperchunks.parse(hyperchunks)
-    return_list = []
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(model["artifact:%s" % aid], "r+") as file:
-            hdf5_arrayset = slycat.hdf5.ArraySet(file)
-            for array in slycat.hyperchunks.arrays(hyperchunks, hdf5_arrayset.array_count()):
-                hdf5_array = hdf5_arrayset[array.index]
+    artifact = model["artifact:%s" % aid]
+    with slycat.web.server.hdf5.pool.reader(artifact) as file:
+        arrays = list(slycat.hyperchunks.arrays(hyperchunks, slycat.hdf5.ArraySet(file).array_count()))
+    for array in arrays:
+        # Only reads made to evaluate the order are shared between attributes, so each attribute's
+        # data can be released once it has been indexed, as before.
+        order_cache = {}
+        with slycat.web.server.hdf5.pool.reader(artifact) as file:
+            hdf5_array = slycat.hdf5.ArraySet(file)[array.index]
+            attributes = list(array.attributes(len(hdf5_array.attributes)))
+            if array.order is not None:
+                order = evaluate(hdf5_array, array.order, "order", cache=order_cache)
+        for attribute in attributes:
+            cache = dict(order_cache)
+            with slycat.web.server.hdf5.pool.reader(artifact) as file:
+                hdf5_array = slycat.hdf5.ArraySet(file)[array.index]
                 if array.order is not None:
-                    order = evaluate(hdf5_array, array.order, "order")
-                for attribute in array.attributes(len(hdf5_array.attributes)):
-                    values = evaluate(hdf5_array, attribute.expression, "attribute")
-                    for hyperslice in attribute.hyperslices():
-                        if array.order is not None:
-                            return_list.append(values[order][hyperslice])
-                        else:
-                            return_list.append(values[hyperslice])
-    return return_list
+                    values = evaluate(hdf5_array, attribute.expression, "attribute", cache=cache)[order]
+                    hyperslices = [values[hyperslice] for hyperslice in attribute.hyperslices()]
+                else:
+                    # Without an order, only the requested hyperslices need to be read from the file.
+                    plan = slycat.hyperchunks.compile(attribute.expression)
+                    hyperslices = [plan.evaluate(hdf5_array, hyperslice, cache) for hyperslice in attribute.hyperslices()]
+            for hyperslice in hyperslices:
+                yield hyperslice
 
 
 def get_model_parameter(database, model, aid):
@@ -256,26 +290,40 @@ def get_model_parameter(database, model, aid):
     return model["artifact:" + aid]
 
 
-def put_model_arrayset(database, model, aid, input=False):
+def create_arrayset():
+    """
+  Create an empty array set in the data store, without attaching it to a model.  This
+  allows array sets to be written by other processes, then attached with put_model_arrayset().
+  :return: storage id of the new array set
+  """
+    storage = uuid.uuid4().hex
+    with slycat.web.server.hdf5.create(storage) as file:
+        slycat.hdf5.start_arrayset(file)
+    return storage
+
+
+def put_model_arrayset(database, model, aid, input=False, storage=None):
     """
   Start a new model array set artifact.
   :param database: the database with our model
   :param model: the model
   :param aid: artifact id
   :param input:
+  :param storage: storage id of an array set returned by create_arrayset(), to attach
+    it to the model instead of starting an empty array set
   :return:
   """
     slycat.web.server.update_model(database, model, message="Starting array set %s." % (aid))
-    storage = uuid.uuid4().hex
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.create(storage) as file:
-            arrayset = slycat.hdf5.start_arrayset(file)
-            database.save({"_id": storage, "type": "hdf5"})
-            model["artifact:%s" % aid] = storage
-            model["artifact-types"][aid] = "hdf5"
-            if input:
-                model["input-artifacts"] = list(set(model["input-artifacts"] + [aid]))
-            database.save(model)
+    if storage is None:
+        storage = create_arrayset()
+    else:
+        slycat.web.server.sort_index.store.schedule(storage)
+    database.save({"_id": storage, "type": "hdf5"})
+    model["artifact:%s" % aid] = storage
+    model["artifact-types"][aid] = "hdf5"
+    if input:
+        model["input-artifacts"] = list(set(model["input-artifacts"] + [aid]))
+    slycat.web.server.update_model(database, model)
 
 
 def put_model_array(database, model, aid, array_index, attributes, dimensions):
@@ -292,9 +340,8 @@ def put_model_array(database, model, aid, array_index, attributes, dimensions):
   """
     slycat.web.server.update_model(database, model, message="Starting array set %s array %s." % (aid, array_index))
     storage = model["artifact:%s" % aid]
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(storage, "r+") as file:
-            slycat.hdf5.ArraySet(file).start_array(array_index, dimensions, attributes)
+    with slycat.web.server.hdf5.pool.writer(storage) as file:
+        slycat.hdf5.ArraySet(file).start_array(array_index, dimensions, attributes, slycat.web.server.hdf5.layout())
 
 
 def put_model_arrayset_data(database, model, aid, hyperchunks, data):
@@ -324,24 +371,24 @@ def put_model_arrayset_data(database, model, aid, hyperchunks, data):
 
     slycat.web.server.update_model(database, model, message="Storing data to array set %s." % (aid))
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(model["artifact:%s" % aid], "r+") as file:
-            hdf5_arrayset = slycat.hdf5.ArraySet(file)
-            for array in slycat.hyperchunks.arrays(hyperchunks, hdf5_arrayset.array_count()):
-                hdf5_array = hdf5_arrayset[array.index]
-                for attribute in array.attributes(len(hdf5_array.attributes)):
-                    if not isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
-                        slycat.email.send_error("slycat.web.server.__init__.py put_model_arrayset_data",
-                                                "Cannot write to computed attribute.")
-                        raise ValueError("Cannot write to computed attribute.")
-
-                    stored_type = slycat.hdf5.dtype(hdf5_array.attributes[attribute.expression.index]["type"])
-                    for hyperslice in attribute.hyperslices():
-                        data_hyperslice = next(data)
-                        if isinstance(data_hyperslice, list):
-                            data_hyperslice = numpy.array(data_hyperslice, dtype=stored_type)
-                        hdf5_array.set_data(attribute.expression.index, hyperslice, data_hyperslice)
-            file.close()
+    with slycat.web.server.hdf5.pool.writer(model["artifact:%s" % aid]) as file:
+        hdf5_arrayset = slycat.hdf5.ArraySet(file)
+        for array in slycat.hyperchunks.arrays(hyperchunks, hdf5_arrayset.array_count()):
+            hdf5_array = hdf5_arrayset[array.index]
+            for attribute in array.attributes(len(hdf5_array.attributes)):
+                if not isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
+                    slycat.email.send_error("slycat.web.server.__init__.py put_model_arrayset_data",
+                                            "Cannot write to computed attribute.")
+                    raise ValueError("Cannot write to computed attribute.")
+
+                stored_type = slycat.hdf5.dtype(hdf5_array.attributes[attribute.expression.index]["type"])
+                for hyperslice in attribute.hyperslices():
+                    data_hyperslice = next(data)
+                    if isinstance(data_hyperslice, list):
+                        data_hyperslice = numpy.array(data_hyperslice, dtype=stored_type)
+                    hdf5_array.set_data(attribute.expression.index, hyperslice, data_hyperslice)
+        file.close()
+    slycat.web.server.sort_index.store.schedule(model["artifact:%s" % aid])
 
 
 def put_model_file(database, model, aid, value, content_type, input=False):
@@ -352,7 +399,7 @@ def put_model_file(database, model, aid, value, content_type, input=False):
     model["artifact-types"][aid] = "file"
     if input:
         model["input-artifacts"] = list(set(model["input-artifacts"] + [aid]))
-    database.save(model)
+    slycat.web.server.update_model(database, model)
     return model
 
 
@@ -379,10 +426,10 @@ def put_model_inputs(database, model, source, deep_copy=False):
             if deep_copy:
                 new_value = uuid.uuid4().hex
                 os.makedirs(os.path.dirname(slycat.web.server.hdf5.path(new_value)))
-                with slycat.web.server.hdf5.lock:
+                with slycat.web.server.hdf5.pool.lock(original_value).read():
                     shutil.copy(slycat.web.server.hdf5.path(original_value), slycat.web.server.hdf5.path(new_value))
-                    model["artifact:%s" % aid] = new_value
-                    database.save({"_id": new_value, "type": "hdf5"})
+                model["artifact:%s" % aid] = new_value
+                database.save({"_id": new_value, "type": "hdf5"})
             else:
                 model["artifact:%s" % aid] = original_value
         elif original_type == "file":
@@ -401,7 +448,7 @@ def put_model_inputs(database, model, source, deep_copy=False):
 
     model["_rev"] = database[model["_id"]][
         "_rev"]  # This is a workaround for the fact that put_attachment() doesn't update the revision number for us.
-    database.save(model)
+    slycat.web.server.update_model(database, model)
 
 
 def put_model_parameter(database, model, aid, value, input=False):
@@ -409,7 +456,7 @@ def put_model_parameter(database, model, aid, value, input=False):
     model["artifact-types"][aid] = "json"
     if input:
         model["input-artifacts"] = list(set(model["input-artifacts"] + [aid]))
-    database.save(model)
+    slycat.web.server.update_model(database, model)
 
 
 def delete_model_parameter(database, model, aid):
@@ -423,7 +470,7 @@ def delete_model_parameter(database, model, aid):
     #TODO: add a lock around this call
     del model["artifact:%s" % aid]
     del model["artifact-types"][aid]
-    database.save(model)
+    slycat.web.server.update_model(database, model)
 
 
 def create_session(hostname, username, password):
@@ -523,26 +570,26 @@ def ssh_connect(hostname=None, username=None, password=None):
     else:
         import requests
         import tempfile
-        num_bits = 2056
-        # create the private key
-        pvt_key = paramiko.RSAKey.generate(num_bits)
-        # create the public key
-        pub_key = "ssh-rsa " + pvt_key.get_base64()  # SSO specific format
-        # pub_key = "ssh-rsa " + pvt_key.get_base64()
-        # + " " + principal + "\n"  # General Format, principal is <username>@<hostname>
-        cherrypy.log.error("ssh_connect cert method, POST to sso-auth-server for user: %s" % cherrypy.request.login)
-        r = requests.post(slycat.web.server.config["slycat-web-server"]["sso-auth-server"]["url"],
-                          cert=(slycat.web.server.config["slycat-web-server"]["ssl-certificate"]["cert-path"],
-                                slycat.web.server.config["slycat-web-server"]["ssl-certificate"]["key-path"]),
-                          data='{"principal": "' + cherrypy.request.login + '", "pubkey": "' + pub_key + '"}',
-                          headers={"Content-Type": "application/json"},
-                          verify=False)
-
-        cherrypy.log.error("ssh_connect cert method, POST result: %s" % str(r))
+        import slycat.web.server.ssh_pool
+
+        def sign(pub_key):
+            # SSO specific format, the general format would be pub_key + " " + principal + "\n", where principal is <username>@<hostname>
+            cherrypy.log.error("ssh_connect cert method, POST to sso-auth-server for user: %s" % cherrypy.request.login)
+            r = requests.post(slycat.web.server.config["slycat-web-server"]["sso-auth-server"]["url"],
+                              cert=(slycat.web.server.config["slycat-web-server"]["ssl-certificate"]["cert-path"],
+                                    slycat.web.server.config["slycat-web-server"]["ssl-certificate"]["key-path"]),
+                              data='{"principal": "' + cherrypy.request.login + '", "pubkey": "' + pub_key + '"}',
+                              headers={"Content-Type": "application/json"},
+                              verify=False)
+            cherrypy.log.error("ssh_connect cert method, POST result: %s" % str(r))
+            return str(r.json()["certificate"])
+
+        # Generating and signing a key is expensive, so reuse them until the certificate expires.
+        pvt_key, certificate = slycat.web.server.ssh_pool.certificates.get(cherrypy.request.login, sign)
         # create a cert file obj
         # cert_file_object = tempfile.TemporaryFile().write(str(r.json()["certificate"])).seek(0) #this line crashes
         cert_file_object = tempfile.TemporaryFile()
-        cert_file_object.write(str(r.json()["certificate"]))
+        cert_file_object.write(certificate)
         cert_file_object.seek(0)
         # create a key file obj
         key_file_object = tempfile.TemporaryFile()
@@ -560,6 +607,7 @@ def ssh_connect(hostname=None, username=None, password=None):
         except paramiko.AuthenticationException as e:
             cherrypy.log.error("ssh_connect cert method, authentication failed for %s@%s: %s" % (cherrypy.request.login, hostname, str(e)))
             cherrypy.log.error("ssh_connect cert method, called ssh.connect traceback: %s" % traceback.print_exc())
+            slycat.web.server.ssh_pool.certificates.discard(cherrypy.request.login)
             raise cherrypy.HTTPError("403 Remote authentication failed.")
         ssh.get_transport().set_keepalive(5)
         cert_file_object.close()
@@ -638,10 +686,7 @@ def clean_up_old_session():
         try:
             # cherrypy.log.error("found old session trying to delete it ")
             sid = cherrypy.request.cookie["slycatauth"].value
-            couchdb = slycat.web.server.database.couchdb.connect()
-            session = couchdb.get("session", sid)
-            if session is not None:
-                couchdb.delete(session)
+            slycat.web.server.sessions.table.delete(sid)
         except:
             # if an exception was throw there is nothing to be done
             pass
@@ -653,7 +698,7 @@ def check_user(session_user, apache_user, couchdb, sid, session):
     session if they are not equal
     :param session_user: user_name in the couchdb use session
     :param apache_user: user sent in the apache header "authuser"
-    :param couchdb: hook to couch
+    :param couchdb: unused, sessions are deleted from :data:`slycat.web.server.sessions.table`
     :param sid: session id
     :param session: session object from couch
     :return:
@@ -661,7 +706,7 @@ def check_user(session_user, apache_user, couchdb, sid, session):
     if session_user != apache_user:
         cherrypy.log.error("session_user::%s is not equal to apache_user::%s in standard auth"
                            "deleting session and throwing 403 error to the browser" % (session_user, apache_user))
-        couchdb.delete(session)
+        slycat.web.server.sessions.table.delete(sid)
         # expire the old cookie
         cherrypy.response.cookie["slycatauth"] = sid
         cherrypy.response.cookie["slycatauth"]['expires'] = 0
@@ -685,8 +730,7 @@ def create_single_sign_on_session(remote_ip, auth_user):
     cherrypy.log.error("++ create_single_sign_on_session creating session for %s" % auth_user)
     sid = uuid.uuid4().hex
     session = {"created": datetime.datetime.utcnow(), "creator": auth_user}
-    database = slycat.web.server.database.couchdb.connect()
-    database.save(
+    slycat.web.server.sessions.table.save(
         {"_id": sid, "type": "session", "created": session["created"].isoformat(), "creator": session["creator"],
          'groups': groups, 'ip': remote_ip, "sessions": []})
 
@@ -2,6 +2,7 @@
 # DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
 # rights in this software.
 import os
+import collections
 import hashlib
 import cPickle
 import time
@@ -95,9 +96,18 @@ class CachedObjectWrapper(object):
 class Cache(object):
   """
   decorator class used to cache
+
+  Cached items are kept in a size-bounded, least-recently-used in-memory
+  cache backed by a size-bounded, least-recently-used file system cache.
+  Item expirations and sizes are recorded in a small index file, so cache hits
+  never rewrite the cached payloads.
   """
-  _lock = threading.Lock()
-  def __init__(self, fs_cache_path=None, **kwargs):
+  _index_name = ".index"
+  _lock_shards = 16
+  _default_memory_limit = 256 * 1024 * 1024
+  _default_disk_limit = 4 * 1024 * 1024 * 1024
+
+  def __init__(self, fs_cache_path=None, memory_limit=None, disk_limit=None, **kwargs):
     """
     takes a filepath and and the following time stamps
        - years (31,556,900 seconds per year)
@@ -109,6 +119,8 @@ class Cache(object):
        - seconds
        - None
     :param path: path as a string to the
+    :param memory_limit: maximum size in bytes of the in memory cache
+    :param disk_limit: maximum size in bytes of the file system cache
     :param kwargs: time stamp
     """
     if kwargs:
@@ -121,8 +133,24 @@ class Cache(object):
     else:
       # no expiration time
       self._init_expire_time = None
-    # set up an in memory cache
-    self._loaded = {}
+
+    self._memory_limit = memory_limit
+    self._disk_limit = disk_limit
+
+    # guards the in memory cache, the index, and the usage counters
+    self._lock = threading.RLock()
+    # serializes file system operations on individual cache items
+    self._locks = [threading.Lock() for shard in range(self._lock_shards)]
+
+    # set up an in memory cache, in least-recently-used order
+    self._loaded = collections.OrderedDict()
+    self._loaded_sizes = {}
+    self._memory_usage = 0
+
+    # file system index of digest -> [expiration, size], in least-recently-used order
+    self._index = None
+    self._index_dirty = False
+    self._disk_usage = 0
 
     # set path for file system
     if fs_cache_path:
@@ -140,10 +168,49 @@ class Cache(object):
     """
     if not self._fs_cache_path:
       import slycat.web.server
-      cherrypy.log.error("[CACHE] %s is the cache location" % (slycat.web.server.config["slycat-web-server"]["cache-store"]))
-      self._fs_cache_path = os.path.abspath(slycat.web.server.config["slycat-web-server"]["cache-store"])
+      configuration = slycat.web.server.config["slycat-web-server"]
+      cherrypy.log.error("[CACHE] %s is the cache location" % (configuration["cache-store"]))
+      self._fs_cache_path = os.path.abspath(configuration["cache-store"])
       if not os.path.exists(self._fs_cache_path):
         os.makedirs(self._fs_cache_path)
+      if self._memory_limit is None:
+        self._memory_limit = configuration.get("cache-memory-limit", None)
+      if self._disk_limit is None:
+        self._disk_limit = configuration.get("cache-disk-limit", None)
+    if self._index is None:
+      self._load_index()
+
+  @property
+  def memory_limit(self):
+    """
+    maximum size in bytes of the in memory cache
+    :return: integer
+    """
+    return self._default_memory_limit if self._memory_limit is None else self._memory_limit
+
+  @property
+  def disk_limit(self):
+    """
+    maximum size in bytes of the file system cache
+    :return: integer
+    """
+    return self._default_disk_limit if self._disk_limit is None else self._disk_limit
+
+  @property
+  def memory_usage(self):
+    """
+    size in bytes of the (pickled) items held in memory
+    :return: integer
+    """
+    return self._memory_usage
+
+  @property
+  def disk_usage(self):
+    """
+    size in bytes of the items stored in the file system cache
+    :return: integer
+    """
+    return self._disk_usage
 
   def __getitem__(self, key):
     """
@@ -153,28 +220,15 @@ class Cache(object):
     """
     self.check_fs_path()
 
-    if key in self:
-      digest = self.digest_hash(key)
-      value = self._loaded[digest].value
-
-      path = os.path.join(self._fs_cache_path, digest)
-      # check if item exist
-      if (digest in self._loaded) or os.path.exists(path):
-        self.expire(digest)
-      cached_contents = CachedObjectWrapper(value, expiration=self.cached_item_expire_time())
-      self.write(cached_contents, path)
-      self._loaded[digest] = cached_contents
-
-
-    else:
-      msg = "key not found in cache: '%s'" % key
+    contents = self._get(self.digest_hash(key), refresh=True)
+    if contents is None:
+      msg = "key not found in cache: '%s'" % (key,)
       raise KeyError(msg)
-    return value
+    return contents.value
 
   def __setitem__(self, key, value):
     """
-    set the key:value in the cache. checks if it already in
-    the cache and throws CacheError if found
+    set the key:value in the cache, replacing any existing value
     :param key: hashed representation of the function
     :param value: stored result from the function
     :return: not used
@@ -183,12 +237,20 @@ class Cache(object):
 
     digest_hash = self.digest_hash(key)
     path = os.path.join(self._fs_cache_path, digest_hash)
-    #check if item exist
-    if (digest_hash in self._loaded) or os.path.exists(path):
-      self.expire(digest_hash)
     cached_contents = CachedObjectWrapper(value, expiration=self.cached_item_expire_time())
-    self.write(cached_contents, path)
-    self._loaded[digest_hash] = cached_contents
+    payload = cPickle.dumps(cached_contents, protocol=cPickle.HIGHEST_PROTOCOL)
+
+    with self._shard(digest_hash):
+      self._write_payload(payload, path)
+      with self._lock:
+        self._unindex(digest_hash)
+        self._index[digest_hash] = [cached_contents.expiration, len(payload)]
+        self._disk_usage += len(payload)
+        self._index_dirty = True
+        self._remember(digest_hash, cached_contents, len(payload))
+
+    self._evict()
+    self._save_index()
 
   def __delitem__(self, digest_hash):
     """
@@ -200,12 +262,12 @@ class Cache(object):
     """
     self.check_fs_path()
 
-    # digest_hash = self.digest_hash(key)
-    if digest_hash in self._loaded:
-      del self._loaded[digest_hash]
-    else:
-      msg = "[CACHE] Cannot delete object at %s not loaded in memory" % str(digest_hash)
-      raise CacheError, msg
+    with self._lock:
+      if digest_hash in self._loaded:
+        self._forget(digest_hash)
+      else:
+        msg = "[CACHE] Cannot delete object at %s not loaded in memory" % str(digest_hash)
+        raise CacheError, msg
 
   def __contains__(self, item):
     """
@@ -216,24 +278,7 @@ class Cache(object):
     """
     self.check_fs_path()
 
-    digest = self.digest_hash(item)
-    # get the item from the cache
-    if digest in self._loaded:
-      value = self._loaded[digest]
-    #item was not in cache check file system
-    else:
-      try:
-        value = self._load(digest, item)
-      except CacheError:
-        # item was not in the cache or the file system
-        return False
-    # check if it has expired
-    if value.expired():
-      cherrypy.log.error("[CACHE] value is expired")
-      #contents were expired so we should delete them and return false
-      self.expire(digest)
-      return False
-    return True
+    return self._get(self.digest_hash(item)) is not None
 
   def __call__(self, f):
     """
@@ -251,12 +296,14 @@ class Cache(object):
 
     def _f(*args, **kwargs):
       key = (fid, args, kwargs)
+      self.check_fs_path()
 
       # cherrypy.log.error("\nargs: %s    \nkwargs %s  \n%s \n%s" % (str(args),kwargs,fid,self.digest_hash(key)))
       #check if we have cached the result
-      if key in self:
+      contents = self._get(self.digest_hash(key), refresh=True)
+      if contents is not None:
         cherrypy.log.error("[CACHE] Found in cache")
-        result = self[key]
+        result = contents.value
       #we have not cached the result so lets get it
       else:
         cherrypy.log.error("[CACHE] NOT found in cache")
@@ -265,17 +312,122 @@ class Cache(object):
       return result
     return _f
 
+  def _get(self, digest, refresh=False):
+    """
+    Returns the :class:`CachedObjectWrapper` for `digest`, loading it from
+    the file system if necessary, or None if the item is missing or expired.
+    When `refresh` is true the item's expiration is pushed back, which
+    only touches the index - never the payload.
+    """
+    with self._lock:
+      entry = self._index.get(digest, None)
+      if entry is None:
+        return None
+      expired = entry[0] is not None and entry[0] < time.time()
+    if expired:
+      cherrypy.log.error("[CACHE] value is expired")
+      #contents were expired so we should delete them and return None
+      self.expire(digest)
+      return None
+
+    with self._shard(digest):
+      with self._lock:
+        contents = self._loaded.pop(digest, None)
+        if contents is not None:
+          self._loaded[digest] = contents
+      if contents is None:
+        try:
+          contents = self._load(digest, digest)
+        except CacheError:
+          contents = None
+    if contents is None:
+      self.expire(digest)
+      return None
+
+    with self._lock:
+      entry = self._index.pop(digest, None)
+      if entry is not None:
+        if refresh:
+          entry[0] = self.cached_item_expire_time()
+          contents.expiration = entry[0]
+          self._index_dirty = True
+        self._index[digest] = entry
+    return contents
+
+  def _shard(self, digest):
+    """
+    Returns the lock that serializes file system access for `digest`.
+    """
+    return self._locks[hash(digest) % len(self._locks)]
+
+  def _remember(self, digest, contents, size):
+    """
+    Adds an item to the in memory cache, evicting least-recently-used
+    items to stay under the memory limit.  Callers must hold the cache lock.
+    """
+    self._forget(digest)
+    if size > self.memory_limit:
+      return
+    self._loaded[digest] = contents
+    self._loaded_sizes[digest] = size
+    self._memory_usage += size
+    while self._memory_usage > self.memory_limit:
+      self._forget(next(iter(self._loaded)))
+
+  def _forget(self, digest):
+    """
+    Removes an item from the in memory cache.  Callers must hold the cache lock.
+    """
+    if digest in self._loaded:
+      del self._loaded[digest]
+      self._memory_usage -= self._loaded_sizes.pop(digest)
+
+  def _unindex(self, digest):
+    """
+    Removes an item from the file system index.  Callers must hold the cache lock.
+    """
+    entry = self._index.pop(digest, None)
+    if entry is not None:
+      self._disk_usage -= entry[1]
+      self._index_dirty = True
+    return entry
+
+  def _evict(self):
+    """
+    Removes least-recently-used items from the file system until it is
+    under the disk limit.
+    """
+    with self._lock:
+      evicted = []
+      for digest in self._index:
+        if self._disk_usage <= self.disk_limit:
+          break
+        evicted.append(digest)
+        self._disk_usage -= self._index[digest][1]
+      for digest in evicted:
+        del self._index[digest]
+        self._forget(digest)
+      if evicted:
+        self._index_dirty = True
+    for digest in evicted:
+      cherrypy.log.error("[CACHE] evicting %s from the file system cache" % digest)
+      with self._shard(digest):
+        with self._lock:
+          replaced = digest in self._index
+        if not replaced:
+          self._remove(digest)
+
   def expire(self, digest_hash):
     """
     Permanently removes the, both in the memory and in the filesystem.
     """
-    if digest_hash in self.fs_keys:
+    self.check_fs_path()
+
+    with self._shard(digest_hash):
+      with self._lock:
+        self._unindex(digest_hash)
+        self._forget(digest_hash)
       self._remove(digest_hash)
-    if digest_hash in self.v_keys:
-      try:
-        del self[digest_hash]
-      except CacheError as e:
-        print cherrypy.log.error("[CACHE] error deleteing item %s"%e.message)
 
   def _remove(self, digest):
     """
@@ -291,9 +443,6 @@ class Cache(object):
       except:
         msg = "[CACHE] No object for key `%s` stored." % str(path)
         cherrypy.log.error(msg)
-    else:
-      msg = "[CACHE] No object for key `%s` stored." % str(path)
-      cherrypy.log.error(msg)
 
   def unload(self, k):
     """
@@ -303,8 +452,8 @@ class Cache(object):
     :return:
     """
     digest = self.digest_hash(k)
-    if digest in self._loaded:
-      del(self._loaded[digest])
+    with self._lock:
+      self._forget(digest)
 
   def load(self, key):
     """
@@ -323,15 +472,68 @@ class Cache(object):
     so don't use it as part of the API.
     """
     path = os.path.join(self._fs_cache_path , digest)
-    if os.path.exists(path):
-      # cherrypy.log.error("[CACHE] %s fs path cache found" % (path))
+    try:
+      size = os.path.getsize(path)
       contents = self.read(path)
-    else:
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
       msg = "[CACHE] Object for key `%s` does not exist." % (k,)
       raise CacheError, msg
-    self._loaded[digest] = contents
+    with self._lock:
+      self._remember(digest, contents, size)
     return contents
 
+  def _load_index(self):
+    """
+    Loads the file system index, adding any cached items that are missing
+    from it (e.g. items written by an older server), and dropping entries
+    whose items no longer exist.
+    """
+    with self._lock:
+      if self._index is not None:
+        return
+      index = collections.OrderedDict()
+      path = os.path.join(self._fs_cache_path, self._index_name)
+      if os.path.exists(path):
+        try:
+          with open(path, "rb") as index_file:
+            for digest, expiration, size in cPickle.load(index_file):
+              index[digest] = [expiration, size]
+        except Exception as e:
+          cherrypy.log.error("[CACHE] rebuilding unreadable index: %s" % e)
+          index.clear()
+
+      stored = set(self.fs_keys)
+      for digest in list(index.keys()):
+        if digest not in stored:
+          del index[digest]
+      for digest in stored - set(index.keys()):
+        try:
+          contents = self.read(os.path.join(self._fs_cache_path, digest))
+          index[digest] = [contents.expiration, os.path.getsize(os.path.join(self._fs_cache_path, digest))]
+        except Exception:
+          self._remove(digest)
+
+      self._index = index
+      self._disk_usage = sum([size for expiration, size in index.values()])
+      self._index_dirty = True
+    self._evict()
+    self._save_index()
+
+  def _save_index(self):
+    """
+    Writes the file system index, if it has changed.
+    """
+    with self._lock:
+      if not self._index_dirty:
+        return
+      entries = [(digest, expiration, size) for digest, (expiration, size) in self._index.items()]
+      self._index_dirty = False
+    path = os.path.join(self._fs_cache_path, self._index_name)
+    temp_path = "%s.%s" % (path, threading.current_thread().ident)
+    with open(temp_path, "wb") as index_file:
+      cPickle.dump(entries, index_file, protocol=cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+
   def cached_item_expire_time(self):
     """
     Returns an expiry for the cache in seconds as if the start
@@ -363,7 +565,7 @@ class Cache(object):
     in the cache on the filesystem.
     :return: list of names of cached files
     """
-    return os.listdir(self._fs_cache_path)
+    return [name for name in os.listdir(self._fs_cache_path) if not name.startswith(".")]
 
   def clean(self):
     """
@@ -375,37 +577,43 @@ class Cache(object):
     cherrypy.log.error("[CACHE] starting the cleaning session for the file system cache")
     self.check_fs_path()
 
-    for f in os.listdir(self._fs_cache_path):
-      path = os.path.join(self._fs_cache_path, f)
-      contents = self.read(path)
-      if contents.expired():
-        cherrypy.log.error("[CACHE] expired content found for %s deleting it" % f)
-        self.expire(f)
-    # for key in self.v_keys:
-    #   # TODO: add logic to keep v_cache_dict clean: if self._loaded[f].epiration - :
-    #     pass
+    now = time.time()
+    with self._lock:
+      expired = [digest for digest, (expiration, size) in self._index.items() if expiration is not None and expiration < now]
+    for digest in expired:
+      cherrypy.log.error("[CACHE] expired content found for %s deleting it" % digest)
+      self.expire(digest)
+    self._save_index()
 
   def clear(self):
     """
     clear cache items from virtual memory.
     :return: not used
     """
-    self._loaded.clear()
+    with self._lock:
+      self._loaded.clear()
+      self._loaded_sizes.clear()
+      self._memory_usage = 0
 
   def purge(self):
     """
     empties the cache from fs and v memory
     :return: not used
     """
-    for f in os.listdir(self._fs_cache_path):
-      path = os.path.join(self._fs_cache_path, f)
-      os.remove(path)
-    self.clear()
+    self.check_fs_path()
+    with self._lock:
+      for f in os.listdir(self._fs_cache_path):
+        path = os.path.join(self._fs_cache_path, f)
+        os.remove(path)
+      self._index.clear()
+      self._disk_usage = 0
+      self._index_dirty = True
+      self.clear()
 
   @property
   def lock(self):
     """
-    threading.Lock() used to control crud operations to the cache.
+    threading.RLock() used to control crud operations to the cache.
     :return:
     """
     return self._lock
@@ -434,18 +642,22 @@ class Cache(object):
     Helper function that simply pickle loads the first object
     from the file named by `filename`.
     """
-    with self.lock:
-      with open(filename, 'rb') as loaded_file:
-        loaded_obj = cPickle.load(loaded_file)
+    with open(filename, 'rb') as loaded_file:
+      loaded_obj = cPickle.load(loaded_file)
     return loaded_obj
 
   def write(self, obj, filename):
     """
     writes and object to the selected file path
     """
-    with self.lock:
-      with open(filename, 'wb') as cache_file:
-        cPickle.dump(obj, cache_file, protocol=cPickle.HIGHEST_PROTOCOL)
+    self._write_payload(cPickle.dumps(obj, protocol=cPickle.HIGHEST_PROTOCOL), filename)
+
+  def _write_payload(self, payload, filename):
+    """
+    writes an already-pickled object to the selected file path
+    """
+    with open(filename, 'wb') as cache_file:
+      cache_file.write(payload)
 
   @staticmethod
   def years_to_seconds(years):
@@ -7,6 +7,7 @@ import datetime
 import Queue
 import slycat.web.server.database.couchdb
 import slycat.web.server.hdf5
+import slycat.web.server.sessions
 import slycat.web.server
 import threading
 import time
@@ -21,10 +22,7 @@ def _array_cleanup_worker():
       try:
         database = slycat.web.server.database.couchdb.connect()
         cherrypy.log.error("Array cleanup worker running.")
-        for file in database.view("slycat/hdf5-file-counts", group=True):
-          if file.value == 0:
-            slycat.web.server.hdf5.delete(file.key)
-            database.delete(database[file.key])
+        _delete_unused_arrays(database)
         cherrypy.log.error("Array cleanup worker finished.")
         break
       except Exception as e:
@@ -34,20 +32,39 @@ def _array_cleanup_worker():
 _array_cleanup_worker.thread = threading.Thread(name="array-cleanup", target=_array_cleanup_worker)
 _array_cleanup_worker.thread.daemon = True
 
+def _delete_unused_arrays(database):
+  """Delete the documents for unused HDF5 files in bulk, and queue the files for deletion."""
+  unused = [file.key for file in database.view("slycat/hdf5-file-counts", group=True) if file.value == 0]
+  if not unused:
+    return
+  documents = [{"_id": row.id, "_rev": row.value["rev"]} for row in database.view("_all_docs", keys=unused) if row.value is not None]
+  for array in database.delete_all(documents):
+    delete_array(array)
+
+def _array_deletion_worker():
+  cherrypy.log.error("Started array deletion worker.")
+  while True:
+    array = delete_array.queue.get()
+    try:
+      slycat.web.server.hdf5.delete(array)
+    except Exception as e:
+      cherrypy.log.error("Array deletion worker couldn't delete %s: %s" % (array, e))
+
+_array_deletion_worker.thread = threading.Thread(name="array-deletion", target=_array_deletion_worker)
+_array_deletion_worker.thread.daemon = True
+
 def _login_session_cleanup_worker():
   cherrypy.log.error("Started login session cleanup worker.")
   while True:
     try:
       database = slycat.web.server.database.couchdb.connect()
-      cherrypy.log.error("Login session cleanup worker running.")
-      cutoff = (datetime.datetime.utcnow() - cherrypy.request.app.config["slycat"]["session-timeout"]).isoformat()
-      for session in database.view("slycat/sessions", include_docs=True):
-        if session.doc["created"] < cutoff:
-          database.delete(session.doc)
-      cherrypy.log.error("Login session cleanup worker finished.")
-      time.sleep(datetime.timedelta(minutes=15).total_seconds())
+      written = slycat.web.server.sessions.table.flush(database)
+      expired = slycat.web.server.sessions.table.expire(database)
+      if written or expired:
+        cherrypy.log.error("Login session cleanup worker recorded activity for %s sessions and deleted %s expired sessions." % (written, expired))
+      time.sleep(datetime.timedelta(minutes=1).total_seconds())
     except Exception as e:
-      cherrypy.log.error("Login session cleanup worker waiting for couchdb. %s" % e.message)
+      cherrypy.log.error("Login session cleanup worker waiting for couchdb. %s" % e)
       time.sleep(2)
 _login_session_cleanup_worker.thread = threading.Thread(name="session-cleanup", target=_login_session_cleanup_worker)
 _login_session_cleanup_worker.thread.daemon = True
@@ -67,6 +84,7 @@ _cache_cleanup_worker.thread.daemon = True
 def start():
   """Called to start all of the cleanup worker threads."""
   _array_cleanup_worker.thread.start()
+  _array_deletion_worker.thread.start()
   _login_session_cleanup_worker.thread.start()
   _cache_cleanup_worker.thread.start()
 
@@ -76,3 +94,8 @@ def arrays():
 arrays.queue = Queue.Queue()
 arrays.queue.put("cleanup")
 
+def delete_array(array):
+  """Queue an HDF5 file for removal from the data store, once its document has been deleted."""
+  delete_array.queue.put(array)
+delete_array.queue = Queue.Queue()
+
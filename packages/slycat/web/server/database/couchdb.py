@@ -12,6 +12,7 @@ from __future__ import absolute_import
 
 import cherrypy
 import couchdb.client
+import couchdb.http
 import threading
 import time
 import uuid
@@ -31,6 +32,50 @@ class Database:
   def delete(self, *arguments, **keywords):
     return self._database.delete(*arguments, **keywords)
 
+  def delete_all(self, documents, chunk_size=1000):
+    """Delete many documents using as few requests as possible.
+
+    Documents are deleted in order, with one _bulk_docs request per chunk.  If a
+    request fails (because it's too large, for example), the chunk is split in
+    half and retried, down to a single document.  Documents that can't be
+    deleted because they've been modified are logged and skipped.
+
+    Parameters
+    ----------
+    documents : sequence of dicts, required.
+      Documents to delete.  Only the "_id" and "_rev" fields are used.
+    chunk_size : integer, optional.
+      Maximum number of documents deleted by a single request.
+
+    Returns
+    -------
+    deleted : list of ids of the documents that were deleted.
+    """
+    documents = list(documents)
+    deleted = []
+    for begin in range(0, len(documents), chunk_size):
+      deleted += self._delete_chunk(documents[begin:begin + chunk_size])
+    return deleted
+
+  def _delete_chunk(self, documents):
+    stubs = [{"_id": document["_id"], "_rev": document["_rev"], "_deleted": True} for document in documents]
+    try:
+      results = self._database.update(stubs)
+    except (couchdb.http.ServerError, IOError) as e:
+      if len(documents) == 1:
+        raise
+      cherrypy.log.error("Bulk delete of %s documents failed, retrying in smaller chunks: %s" % (len(documents), e))
+      middle = len(documents) // 2
+      return self._delete_chunk(documents[:middle]) + self._delete_chunk(documents[middle:])
+
+    deleted = []
+    for success, id, result in results:
+      if success:
+        deleted.append(id)
+      else:
+        cherrypy.log.error("Couldn't delete document %s: %s" % (id, result))
+    return deleted
+
   def get_attachment(self, *arguments, **keywords):
     return self._database.get_attachment(*arguments, **keywords)
 
@@ -44,6 +89,9 @@ class Database:
       slycat.email.send_error("slycat.web.server.database.couchdb.py save", "%s %s" % (e.message[0], e.message[1][1]))
       raise cherrypy.HTTPError("%s %s" % (e.message[0], e.message[1][1]))
 
+  def update(self, *arguments, **keywords):
+    return self._database.update(*arguments, **keywords)
+
   def view(self, *arguments, **keywords):
     return self._database.view(*arguments, **keywords)
 
@@ -62,6 +110,10 @@ class Database:
       raise cherrypy.HTTPError(404)
     return document
 
+  def ping(self):
+    """Check that the database is reachable, raising an exception if it isn't."""
+    self._database.resource.head()
+
   def write_file(self, document, content, content_type):
     fid = uuid.uuid4().hex
     self.put_attachment(document, content, filename=fid, content_type=content_type)
@@ -74,13 +126,104 @@ class Database:
     """
     return "<slycat.web.server.database.couchdb.Database instance>"
 
+class ConnectionPool(object):
+  """Thread-safe pool of keep-alive :class:`Database` wrappers.
+
+  Each pooled database has its own :class:`couchdb.http.Session`, which keeps
+  HTTP connections to the server alive between requests.  Sessions are
+  thread-safe, so databases are handed out round-robin and callers never need
+  to return them.  A database that hasn't been checked recently is checked
+  before it's handed out, and replaced if the server can't be reached with it.
+
+  Parameters
+  ----------
+  host : string, optional.
+    CouchDB server URL, defaults to the "couchdb-host" configuration value.
+  name : string, optional.
+    Database name, defaults to the "couchdb-database" configuration value.
+  size : integer, optional.
+    Maximum number of pooled databases, defaults to the "couchdb-pool-size"
+    configuration value, or 4.
+  check_interval : number, optional.
+    Seconds between health checks of a pooled database, defaults to the
+    "couchdb-pool-check-interval" configuration value, or 30.
+  """
+  def __init__(self, host=None, name=None, size=None, check_interval=None):
+    self._host = host
+    self._name = name
+    self._size = size
+    self._check_interval = check_interval
+    self._lock = threading.Lock()
+    self._entries = []
+    self._creating = 0
+    self._next = 0
+
+  def get(self):
+    """Return a pooled :class:`Database`."""
+    with self._lock:
+      if self._host is None or self._name is None or self._size is None or self._check_interval is None:
+        configuration = cherrypy.tree.apps[""].config["slycat"]
+        self._host = configuration["couchdb-host"] if self._host is None else self._host
+        self._name = configuration["couchdb-database"] if self._name is None else self._name
+        self._size = configuration.get("couchdb-pool-size", 4) if self._size is None else self._size
+        self._check_interval = configuration.get("couchdb-pool-check-interval", 30) if self._check_interval is None else self._check_interval
+
+      # Connecting takes a round trip to the server, so new databases are created outside the lock.
+      # Until one is ready, callers create their own rather than wait.
+      create = len(self._entries) + self._creating < self._size or not self._entries
+      if create:
+        self._creating += 1
+      else:
+        entry = self._entries[self._next % len(self._entries)]
+        self._next += 1
+        checked = entry[1]
+        if time.time() - checked < self._check_interval:
+          return entry[0]
+        entry[1] = time.time()
+
+    if create:
+      try:
+        database = self._create()
+      except:
+        with self._lock:
+          self._creating -= 1
+        raise
+      with self._lock:
+        self._creating -= 1
+        if len(self._entries) < self._size:
+          self._entries.append([database, time.time()])
+      return database
+
+    try:
+      entry[0].ping()
+    except Exception as e:
+      cherrypy.log.error("Replacing pooled CouchDB connection after failed health check: %s" % e)
+      entry[1] = 0
+      database = self._create()
+      with self._lock:
+        entry[0] = database
+        entry[1] = time.time()
+    return entry[0]
+
+  def clear(self):
+    """Discard every pooled database."""
+    with self._lock:
+      self._entries = []
+      self._next = 0
+
+  def _create(self):
+    server = couchdb.client.Server(url=self._host, session=couchdb.http.Session())
+    return Database(server[self._name])
+
+pool = ConnectionPool()
+
 def connect():
   """Connect to a CouchDB database.
 
+  Databases are shared by every thread, see :class:`ConnectionPool`.
+
   Returns
   -------
   database : :class:`slycat.web.server.database.couchdb.Database`
   """
-  server = couchdb.client.Server(url=cherrypy.tree.apps[""].config["slycat"]["couchdb-host"])
-  database = Database(server[cherrypy.tree.apps[""].config["slycat"]["couchdb-database"]])
-  return database
+  return pool.get()
@@ -293,6 +293,10 @@ def start(root_path, config_file):
   # wsgi: this just saves this dict in the slycat obj, no cherrypy stuff here
   slycat.web.server.config = configuration
 
+  # Start the parser worker processes before the engine starts any threads.
+  cherrypy.engine.subscribe("start", slycat.web.server.plugin.start_workers)
+  cherrypy.engine.subscribe("stop", slycat.web.server.plugin.stop_workers)
+
   # Start all of our cleanup workers.
   cherrypy.engine.subscribe("start", slycat.web.server.cleanup.start, priority=80)
 
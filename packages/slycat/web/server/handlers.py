@@ -16,9 +16,11 @@ import time
 import Queue
 import cPickle
 import re
+import slycat.columnar
 import slycat.email
 import slycat.hdf5
 import slycat.hyperchunks
+import slycat.jsonarray
 import slycat.uri
 import slycat.web.server
 import slycat.web.server.authentication
@@ -28,6 +30,8 @@ import slycat.web.server.hdf5
 import slycat.web.server.plugin
 import slycat.web.server.remote
 import slycat.web.server.resource
+import slycat.web.server.sessions
+import slycat.web.server.sort_index
 import slycat.web.server.streaming
 import slycat.web.server.template
 import slycat.web.server.upload
@@ -126,8 +130,7 @@ def get_sid(hostname):
     """
     sid = None
     try:
-        database = slycat.web.server.database.couchdb.connect()
-        session = database.get("session", cherrypy.request.cookie["slycatauth"].value)
+        session = slycat.web.server.sessions.table.get(cherrypy.request.cookie["slycatauth"].value)
         for host_session in session["sessions"]:
             if host_session["hostname"] == hostname:
                 sid = host_session["sid"]
@@ -213,12 +216,8 @@ def get_projects_list(_=None):
     :return: 
     """
     database = slycat.web.server.database.couchdb.connect()
-    projects = [project for project in database.scan("slycat/projects") if
-                slycat.web.server.authentication.is_project_reader(
-                    project) or slycat.web.server.authentication.is_project_writer(
-                    project) or slycat.web.server.authentication.is_project_administrator(
-                    project) or slycat.web.server.authentication.is_server_administrator()]
-    projects = sorted(projects, key=lambda x: x["created"], reverse=True)
+    user = None if slycat.web.server.authentication.is_server_administrator() else cherrypy.request.login
+    projects = slycat.web.server.project_lists.get(database, user)
     return {"revision": 0, "projects": projects}
 
 
@@ -239,6 +238,7 @@ def post_projects():
         "description": cherrypy.request.json.get("description", ""),
         "name": cherrypy.request.json["name"]
     })
+    slycat.web.server.project_lists.invalidate()
     cherrypy.response.headers["location"] = "%s/projects/%s" % (cherrypy.request.base, pid)
     cherrypy.response.status = "201 Project created."
     return {"id": pid}
@@ -320,6 +320,7 @@ def put_project(pid):
         project["description"] = cherrypy.request.json["description"]
 
     database.save(project)
+    slycat.web.server.project_lists.invalidate()
     cherrypy.response.status = "200 Project updated."
 
 
@@ -328,15 +329,15 @@ def delete_project(pid):
     project = couchdb.get("project", pid)
     slycat.web.server.authentication.require_project_administrator(project)
 
-    for cache_object in couchdb.scan("slycat/project-cache-objects", startkey=pid, endkey=pid):
-        couchdb.delete(cache_object)
-    for reference in couchdb.scan("slycat/project-references", startkey=pid, endkey=pid):
-        couchdb.delete(reference)
-    for bookmark in couchdb.scan("slycat/project-bookmarks", startkey=pid, endkey=pid):
-        couchdb.delete(bookmark)
-    for model in couchdb.scan("slycat/project-models", startkey=pid, endkey=pid):
-        couchdb.delete(model)
-    couchdb.delete(project)
+    # Delete everything in bulk, with the project itself last, so a partial
+    # failure leaves a project that can still be deleted.  Unused HDF5 files
+    # are removed later, in the background.
+    documents = []
+    for view in ["project-cache-objects", "project-references", "project-bookmarks", "project-models"]:
+        documents += couchdb.scan("slycat/%s" % view, startkey=pid, endkey=pid)
+    documents.append(project)
+    couchdb.delete_all(documents)
+    slycat.web.server.project_lists.invalidate()
     slycat.web.server.cleanup.arrays()
 
     cherrypy.response.status = "204 Project deleted."
@@ -690,7 +691,7 @@ def put_model(mid):
             save_model = True
 
     if save_model:
-        database.save(model)
+        slycat.web.server.update_model(database, model)
 
 
 def post_model_finish(mid):
@@ -941,12 +942,13 @@ def logout():
             cherrypy.response.cookie["slycattimeout"] = "timeout"
             cherrypy.response.cookie["slycattimeout"]['expires'] = 0
 
-            couchdb = slycat.web.server.database.couchdb.connect()
-            session = couchdb.get("session", sid)
-            if session is not None:
-                cherrypy.response.status = "200 session deleted." + str(couchdb.delete(session))
-            else:
-                cherrypy.response.status = "400 Bad Request no session to delete."
+            # Make sure the session exists before deleting it; the table raises 404 if it doesn't.
+            try:
+                slycat.web.server.sessions.table.get(sid)
+            except cherrypy.HTTPError:
+                raise cherrypy.HTTPError("400 Bad Request no session to delete.")
+            slycat.web.server.sessions.table.delete(sid)
+            cherrypy.response.status = "200 session deleted."
         else:
             cherrypy.response.status = "403 Forbidden"
     except Exception as e:
@@ -1055,54 +1057,55 @@ def put_model_arrayset_data(mid, aid, hyperchunks, data, byteorder=None):
         data = json.load(data.file)
         data_iterator = iter(data)
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(model["artifact:%s" % aid], "r+") as file:
-            hdf5_arrayset = slycat.hdf5.ArraySet(file)
-            for array in slycat.hyperchunks.arrays(hyperchunks, hdf5_arrayset.array_count()):
-                hdf5_array = hdf5_arrayset[array.index]
-                for attribute in array.attributes(len(hdf5_array.attributes)):
-                    if not isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
-                        raise cherrypy.HTTPError("400 Cannot assign data to computed attributes.")
-                    for hyperslice in attribute.hyperslices():
-                        cherrypy.log.error(
-                            "Writing %s/%s/%s/%s" % (aid, array.index, attribute.expression.index, hyperslice))
-
-                        # We have to convert our hyperslice into a shape with explicit extents so we can compute
-                        # how many bytes to extract from the input data.
-                        if hyperslice == (Ellipsis,):
-                            data_shape = [dimension["end"] - dimension["begin"] for dimension in hdf5_array.dimensions]
-                        else:
-                            data_shape = []
-                            for hyperslice_dimension, array_dimension in zip(hyperslice, hdf5_array.dimensions):
-                                if isinstance(hyperslice_dimension, numbers.Integral):
-                                    data_shape.append(1)
-                                elif isinstance(hyperslice_dimension, type(Ellipsis)):
-                                    data_shape.append(array_dimension["end"] - array_dimension["begin"])
-                                elif isinstance(hyperslice_dimension, slice):
-                                    # TODO: Handle step
-                                    start, stop, step = hyperslice_dimension.indices(
-                                        array_dimension["end"] - array_dimension["begin"])
-                                    data_shape.append(stop - start)
-                                else:
-                                    slycat.email.send_error("slycat.web.server.handlers.py put_model_arrayset_data",
-                                                            "Unexpected hyperslice: %s" % hyperslice_dimension)
-                                    raise ValueError("Unexpected hyperslice: %s" % hyperslice_dimension)
-
-                        # Convert data to an array ...
-                        data_type = slycat.hdf5.dtype(hdf5_array.attributes[attribute.expression.index]["type"])
-                        data_size = numpy.prod(data_shape)
-
-                        if byteorder is None:
-                            hyperslice_data = numpy.array(data_iterator.next(), dtype=data_type).reshape(data_shape)
-                        elif byteorder == sys.byteorder:
-                            hyperslice_data = numpy.fromfile(data.file, dtype=data_type, count=data_size).reshape(
-                                data_shape)
-                        else:
-                            slycat.email.send_error("slycat.web.server.handlers.py put_model_arrayset_data",
-                                                    "Not implemented error.")
-                            raise NotImplementedError()
-
-                        hdf5_array.set_data(attribute.expression.index, hyperslice, hyperslice_data)
+    with slycat.web.server.hdf5.pool.writer(model["artifact:%s" % aid]) as file:
+        hdf5_arrayset = slycat.hdf5.ArraySet(file)
+        for array in slycat.hyperchunks.arrays(hyperchunks, hdf5_arrayset.array_count()):
+            hdf5_array = hdf5_arrayset[array.index]
+            for attribute in array.attributes(len(hdf5_array.attributes)):
+                if not isinstance(attribute.expression, slycat.hyperchunks.grammar.AttributeIndex):
+                    raise cherrypy.HTTPError("400 Cannot assign data to computed attributes.")
+                for hyperslice in attribute.hyperslices():
+                    cherrypy.log.error(
+                        "Writing %s/%s/%s/%s" % (aid, array.index, attribute.expression.index, hyperslice))
+
+                    # We have to convert our hyperslice into a shape with explicit extents so we can compute
+                    # how many bytes to extract from the input data.
+                    if hyperslice == (Ellipsis,):
+                        data_shape = [dimension["end"] - dimension["begin"] for dimension in hdf5_array.dimensions]
+                    else:
+                        data_shape = []
+                        for hyperslice_dimension, array_dimension in zip(hyperslice, hdf5_array.dimensions):
+                            if isinstance(hyperslice_dimension, numbers.Integral):
+                                data_shape.append(1)
+                            elif isinstance(hyperslice_dimension, type(Ellipsis)):
+                                data_shape.append(array_dimension["end"] - array_dimension["begin"])
+                            elif isinstance(hyperslice_dimension, slice):
+                                # TODO: Handle step
+                                start, stop, step = hyperslice_dimension.indices(
+                                    array_dimension["end"] - array_dimension["begin"])
+                                data_shape.append(stop - start)
+                            else:
+                                slycat.email.send_error("slycat.web.server.handlers.py put_model_arrayset_data",
+                                                        "Unexpected hyperslice: %s" % hyperslice_dimension)
+                                raise ValueError("Unexpected hyperslice: %s" % hyperslice_dimension)
+
+                    # Convert data to an array ...
+                    data_type = slycat.hdf5.dtype(hdf5_array.attributes[attribute.expression.index]["type"])
+                    data_size = numpy.prod(data_shape)
+
+                    if byteorder is None:
+                        hyperslice_data = numpy.array(data_iterator.next(), dtype=data_type).reshape(data_shape)
+                    elif byteorder == sys.byteorder:
+                        hyperslice_data = numpy.fromfile(data.file, dtype=data_type, count=data_size).reshape(
+                            data_shape)
+                    else:
+                        slycat.email.send_error("slycat.web.server.handlers.py put_model_arrayset_data",
+                                                "Not implemented error.")
+                        raise NotImplementedError()
+
+                    hdf5_array.set_data(attribute.expression.index, hyperslice, hyperslice_data)
+
+    slycat.web.server.sort_index.store.schedule(model["artifact:%s" % aid])
 
 
 def delete_model(mid):
@@ -1167,8 +1170,7 @@ def delete_project_cache(pid):
     project = couchdb.get("project", pid)
     slycat.web.server.authentication.require_project_administrator(project)
 
-    for cache_object in couchdb.scan("slycat/project-cache-objects", startkey=pid, endkey=pid):
-        couchdb.delete(cache_object)
+    couchdb.delete_all(couchdb.scan("slycat/project-cache-objects", startkey=pid, endkey=pid))
 
     cherrypy.response.status = "204 Cache objects deleted."
 
@@ -1208,30 +1210,29 @@ def get_model_array_attribute_chunk(mid, aid, array, attribute, **arguments):
     if artifact_type not in ["hdf5"]:
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(artifact) as file:
-            hdf5_arrayset = slycat.hdf5.ArraySet(file)
-            hdf5_array = hdf5_arrayset[array]
+    with slycat.web.server.hdf5.pool.reader(artifact) as file:
+        hdf5_arrayset = slycat.hdf5.ArraySet(file)
+        hdf5_array = hdf5_arrayset[array]
 
-            if not (0 <= attribute and attribute < len(hdf5_array.attributes)):
-                raise cherrypy.HTTPError("400 Attribute argument out-of-range.")
-            if len(ranges) != hdf5_array.ndim:
-                raise cherrypy.HTTPError("400 Ranges argument doesn't contain the correct number of dimensions.")
+        if not (0 <= attribute and attribute < len(hdf5_array.attributes)):
+            raise cherrypy.HTTPError("400 Attribute argument out-of-range.")
+        if len(ranges) != hdf5_array.ndim:
+            raise cherrypy.HTTPError("400 Ranges argument doesn't contain the correct number of dimensions.")
 
-            ranges = [(max(dimension["begin"], range[0]), min(dimension["end"], range[1])) for dimension, range in
-                      zip(hdf5_array.dimensions, ranges)]
-            index = tuple([slice(begin, end) for begin, end in ranges])
+        ranges = [(max(dimension["begin"], range[0]), min(dimension["end"], range[1])) for dimension, range in
+                  zip(hdf5_array.dimensions, ranges)]
+        index = tuple([slice(begin, end) for begin, end in ranges])
 
-            attribute_type = hdf5_array.attributes[attribute]["type"]
-            data = hdf5_array.get_data(attribute)[index]
+        attribute_type = hdf5_array.attributes[attribute]["type"]
+        data = hdf5_array.get_data(attribute)[index]
 
-            if byteorder is None:
-                return json.dumps(data.tolist())
+        if byteorder is None:
+            return slycat.jsonarray.dumps(data)
+        else:
+            if sys.byteorder != byteorder:
+                return data.byteswap().tostring(order="C")
             else:
-                if sys.byteorder != byteorder:
-                    return data.byteswap().tostring(order="C")
-                else:
-                    return data.tostring(order="C")
+                return data.tostring(order="C")
 
 
 @cherrypy.tools.json_out(on=True)
@@ -1308,9 +1309,9 @@ def get_model_arrayset_data(mid, aid, hyperchunks, byteorder=None):
             slycat.email.send_error("slycat.web.server.handlers.py get_model_arrayset_data",
                                     "cherrypy.HTTPError 400 optional byteorder argument must be big or little.")
             raise cherrypy.HTTPError("400 optional byteorder argument must be big or little.")
-        accept = cherrypy.lib.cptools.accept(["application/octet-stream"])
+        accept = cherrypy.lib.cptools.accept(["application/octet-stream", slycat.columnar.content_type])
     else:
-        accept = cherrypy.lib.cptools.accept(["application/json"])
+        accept = cherrypy.lib.cptools.accept(["application/json", slycat.columnar.content_type])
     cherrypy.response.headers["content-type"] = accept
 
     database = slycat.web.server.database.couchdb.connect()
@@ -1328,17 +1329,14 @@ def get_model_arrayset_data(mid, aid, hyperchunks, byteorder=None):
                                 "cherrypy.HTTPError 400 %s is not an array artifact." % aid)
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    def mask_nans(array):
-        """Convert an array containing nans into a masked array."""
-        try:
-            return numpy.ma.masked_where(numpy.isnan(array), array)
-        except:
-            return array
-
     def content():
-        if byteorder is None:
-            yield json.dumps([mask_nans(hyperslice).tolist() for hyperslice in
-                              slycat.web.server.get_model_arrayset_data(database, model, aid, hyperchunks)])
+        if accept == slycat.columnar.content_type:
+            for piece in slycat.columnar.encode(
+                    slycat.web.server.iter_model_arrayset_data(database, model, aid, hyperchunks), byteorder):
+                yield piece
+        elif byteorder is None:
+            yield slycat.jsonarray.dumps_list(
+                slycat.web.server.get_model_arrayset_data(database, model, aid, hyperchunks))
         else:
             for hyperslice in slycat.web.server.get_model_arrayset_data(database, model, aid, hyperchunks):
                 if sys.byteorder != byteorder:
@@ -1392,9 +1390,9 @@ def post_model_arrayset_data(mid, aid):
             slycat.email.send_error("slycat.web.server.handlers.py get_model_arrayset_data",
                                     "cherrypy.HTTPError 400 optional byteorder argument must be big or little.")
             raise cherrypy.HTTPError("400 optional byteorder argument must be big or little.")
-        accept = cherrypy.lib.cptools.accept(["application/octet-stream"])
+        accept = cherrypy.lib.cptools.accept(["application/octet-stream", slycat.columnar.content_type])
     else:
-        accept = cherrypy.lib.cptools.accept(["application/json"])
+        accept = cherrypy.lib.cptools.accept(["application/json", slycat.columnar.content_type])
     cherrypy.response.headers["content-type"] = accept
 
     database = slycat.web.server.database.couchdb.connect()
@@ -1412,19 +1410,16 @@ def post_model_arrayset_data(mid, aid):
                                 "cherrypy.HTTPError 400 %s is not an array artifact." % aid)
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    def mask_nans(array):
-        """Convert an array containing nans into a masked array."""
-        try:
-            return numpy.ma.masked_where(numpy.isnan(array), array)
-        except:
-            return array
-
     def content():
         if "include_nans" in cherrypy.request.json:
             include_nans = cherrypy.request.json["include_nans"]
-        if byteorder is None:
-            yield json.dumps([mask_nans(hyperslice).tolist() for hyperslice in
-                              slycat.web.server.get_model_arrayset_data(database, model, aid, hyperchunks)])
+        if accept == slycat.columnar.content_type:
+            for piece in slycat.columnar.encode(
+                    slycat.web.server.iter_model_arrayset_data(database, model, aid, hyperchunks), byteorder):
+                yield piece
+        elif byteorder is None:
+            yield slycat.jsonarray.dumps_list(
+                slycat.web.server.get_model_arrayset_data(database, model, aid, hyperchunks))
         else:
             for hyperslice in slycat.web.server.get_model_arrayset_data(database, model, aid, hyperchunks):
                 if sys.byteorder != byteorder:
@@ -1508,10 +1503,14 @@ def validate_table_sort(sort):
                                         "cherrypy.HTTPError 400 sort-order must be 'ascending' or 'descending'")
                 raise cherrypy.HTTPError("400 Sort-order must be 'ascending' or 'descending'.")
 
-        if len(sort) != 1:
+        if len(sort) > slycat.web.server.sort_index.maximum_columns:
             slycat.email.send_error("slycat.web.server.handlers.py validate_table_sort",
-                                    "cherrypy.HTTPError 400 currently, only one column can be sorted.")
-            raise cherrypy.HTTPError("400 Currently, only one column can be sorted.")
+                                    "cherrypy.HTTPError 400 at most %s columns can be sorted." % slycat.web.server.sort_index.maximum_columns)
+            raise cherrypy.HTTPError("400 At most %s columns can be sorted." % slycat.web.server.sort_index.maximum_columns)
+        if len(set([column for column, order in sort])) != len(sort):
+            slycat.email.send_error("slycat.web.server.handlers.py validate_table_sort",
+                                    "cherrypy.HTTPError 400 sort columns must be unique.")
+            raise cherrypy.HTTPError("400 Sort columns must be unique.")
 
     return sort
 
@@ -1529,30 +1528,26 @@ def validate_table_byteorder(byteorder):
     return byteorder
 
 
-def get_table_sort_index(file, metadata, array_index, sort, index):
-    sort_index = numpy.arange(metadata["row-count"])
-    if sort is not None:
-        sort_column, sort_order = sort[0]
-        if index is not None and sort_column == metadata["column-count"] - 1:
-            pass  # At this point, the sort index is already set from above
-        else:
-            index_key = "array/%s/index/%s" % (array_index, sort_column)
-            if index_key not in file:
-                # cherrypy.log.error("Caching array index for file %s array %s attribute %s" % (file.filename, array_index, sort_column))
-                sort_index = numpy.argsort(slycat.hdf5.ArraySet(file)[array_index].get_data(sort_column)[...],
-                                           kind="mergesort")
-                file[index_key] = sort_index
-            else:
-                # cherrypy.log.error("Loading cached sort index.")
-                sort_index = file[index_key][...]
-        if sort_order == "descending":
-            sort_index = sort_index[::-1]
-    return sort_index
+def get_table_rows(artifact, arrayset, metadata, array_index, sort, index, positions):
+    """Return the table rows at the given positions in sorted order, using the persistent sort index store."""
+    if sort is None:
+        return positions
+    if index is not None and len(sort) == 1 and sort[0][0] == metadata["column-count"] - 1:
+        return metadata["row-count"] - 1 - positions if sort[0][1] == "descending" else positions
+    return slycat.web.server.sort_index.store.rows(artifact, arrayset[array_index], array_index, sort, positions)
+
+
+def get_table_positions(artifact, arrayset, metadata, array_index, sort, index, rows):
+    """Return the positions of the given table rows in sorted order, using the persistent sort index store."""
+    if sort is None:
+        return rows
+    if index is not None and len(sort) == 1 and sort[0][0] == metadata["column-count"] - 1:
+        return metadata["row-count"] - 1 - rows if sort[0][1] == "descending" else rows
+    return slycat.web.server.sort_index.store.positions(artifact, arrayset[array_index], array_index, sort, rows)
 
 
-def get_table_metadata(file, array_index, index):
+def get_table_metadata(arrayset, array_index, index):
     """Return table-oriented metadata for a 1D array, plus an optional index column."""
-    arrayset = slycat.hdf5.ArraySet(file)
     array = arrayset[array_index]
 
     if array.ndim != 1:
@@ -1601,14 +1596,11 @@ def get_model_table_metadata(mid, aid, array, index=None):
                                 "cherrypy.HTTPError 400 %s is not an array artifact." % aid)
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(artifact,
-                                         "r+") as file:  # We have to open the file with writing enabled because the statistics cache may need to be updated.
-            metadata = get_table_metadata(file, array, index)
-        return metadata
+    with slycat.web.server.hdf5.pool.arrayset(artifact) as arrayset:
+        metadata = get_table_metadata(arrayset, array, index)
+    return metadata
 
 
-@cherrypy.tools.json_out(on=True)
 def get_model_table_chunk(mid, aid, array, rows=None, columns=None, index=None, sort=None):
     rows = validate_table_rows(rows)
     columns = validate_table_columns(columns)
@@ -1630,49 +1622,37 @@ def get_model_table_chunk(mid, aid, array, rows=None, columns=None, index=None,
                                 "cherrypy.HTTPError 400 %s is not an array artifact." % aid)
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(artifact, mode="r+") as file:
-            metadata = get_table_metadata(file, array, index)
-
-            # Constrain end <= count along both dimensions
-            rows = rows[rows < metadata["row-count"]]
-            if numpy.any(columns >= metadata["column-count"]):
-                slycat.email.send_error("slycat.web.server.handlers.py get_model_table_chunk",
-                                        "cherrypy.HTTPError 400 column out-of-range.")
-                raise cherrypy.HTTPError("400 Column out-of-range.")
-            if sort is not None:
-                for column, order in sort:
-                    if column >= metadata["column-count"]:
-                        slycat.email.send_error("slycat.web.server.handlers.py get_model_table_chunk",
-                                                "400 sort column out-of-range.")
-                        raise cherrypy.HTTPError("400 Sort column out-of-range.")
-
-            # Retrieve the data
-            data = []
-            sort_index = get_table_sort_index(file, metadata, array, sort, index)
-            slice = sort_index[rows]
-            slice_index = numpy.argsort(slice, kind="mergesort")
-            slice_reverse_index = numpy.argsort(slice_index, kind="mergesort")
-            for column in columns:
-                type = metadata["column-types"][column]
-                if index is not None and column == metadata["column-count"] - 1:
-                    values = slice.tolist()
-                else:
-                    values = slycat.hdf5.ArraySet(file)[array].get_data(column)[slice[slice_index].tolist()][
-                        slice_reverse_index].tolist()
-                    if type in ["float32", "float64"]:
-                        values = [None if numpy.isnan(value) else value for value in values]
-                data.append(values)
-
-            result = {
-                "rows": rows.tolist(),
-                "columns": columns.tolist(),
-                "column-names": [metadata["column-names"][column] for column in columns],
-                "data": data,
-                "sort": sort
-            }
-
-    return result
+    with slycat.web.server.hdf5.pool.arrayset(artifact) as arrayset:
+        metadata = get_table_metadata(arrayset, array, index)
+
+        # Constrain end <= count along both dimensions
+        rows = rows[rows < metadata["row-count"]]
+        if numpy.any(columns >= metadata["column-count"]):
+            slycat.email.send_error("slycat.web.server.handlers.py get_model_table_chunk",
+                                    "cherrypy.HTTPError 400 column out-of-range.")
+            raise cherrypy.HTTPError("400 Column out-of-range.")
+        if sort is not None:
+            for column, order in sort:
+                if column >= metadata["column-count"]:
+                    slycat.email.send_error("slycat.web.server.handlers.py get_model_table_chunk",
+                                            "400 sort column out-of-range.")
+                    raise cherrypy.HTTPError("400 Sort column out-of-range.")
+
+        # Retrieve the data, reading the same rows from every column with one plan, and
+        # encoding each column as JSON (with NaNs as null) in bulk.
+        slice = get_table_rows(artifact, arrayset, metadata, array, sort, index, rows)
+        attributes = [column for column in columns if index is None or column != metadata["column-count"] - 1]
+        values = dict(zip(attributes, arrayset.get_rows(array, attributes, slice)))
+        data = [slycat.jsonarray.dumps(values.get(column, slice)) for column in columns]
+
+    cherrypy.response.headers["content-type"] = "application/json"
+    return "{%s}" % ", ".join([
+        '"rows": %s' % slycat.jsonarray.dumps(rows),
+        '"columns": %s' % slycat.jsonarray.dumps(columns),
+        '"column-names": %s' % json.dumps([metadata["column-names"][column] for column in columns]),
+        '"data": [%s]' % ", ".join(data),
+        '"sort": %s' % json.dumps(sort),
+    ])
 
 
 def get_model_table_sorted_indices(mid, aid, array, rows=None, index=None, sort=None, byteorder=None):
@@ -1696,30 +1676,28 @@ def get_model_table_sorted_indices(mid, aid, array, rows=None, index=None, sort=
                                 "cherrypy.HTTPError 400 %s is not an array artifact." % aid)
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(artifact, mode="r+") as file:
-            metadata = get_table_metadata(file, array, index)
+    with slycat.web.server.hdf5.pool.arrayset(artifact) as arrayset:
+        metadata = get_table_metadata(arrayset, array, index)
 
-            # Constrain end <= count along both dimensions
-            rows = rows[rows < metadata["row-count"]]
-            if sort is not None:
-                for column, order in sort:
-                    if column >= metadata["column-count"]:
-                        slycat.email.send_error("slycat.web.server.handlers.py get_model_table_sorted_indices",
-                                                "cherrypy.HTTPError 400 sort column out-of-range.")
-                        raise cherrypy.HTTPError("400 Sort column out-of-range.")
+        # Constrain end <= count along both dimensions
+        rows = rows[rows < metadata["row-count"]]
+        if sort is not None:
+            for column, order in sort:
+                if column >= metadata["column-count"]:
+                    slycat.email.send_error("slycat.web.server.handlers.py get_model_table_sorted_indices",
+                                            "cherrypy.HTTPError 400 sort column out-of-range.")
+                    raise cherrypy.HTTPError("400 Sort column out-of-range.")
 
-            # Retrieve the data ...
-            sort_index = get_table_sort_index(file, metadata, array, sort, index)
-            slice = numpy.argsort(sort_index, kind="mergesort")[rows].astype("int32")
+        # Retrieve the data ...
+        slice = get_table_positions(artifact, arrayset, metadata, array, sort, index, rows).astype("int32")
 
-        if byteorder is None:
-            return json.dumps(slice.tolist())
+    if byteorder is None:
+        return json.dumps(slice.tolist())
+    else:
+        if sys.byteorder != byteorder:
+            return slice.byteswap().tostring(order="C")
         else:
-            if sys.byteorder != byteorder:
-                return slice.byteswap().tostring(order="C")
-            else:
-                return slice.tostring(order="C")
+            return slice.tostring(order="C")
 
 
 def get_model_table_unsorted_indices(mid, aid, array, rows=None, index=None, sort=None, byteorder=None):
@@ -1743,30 +1721,28 @@ def get_model_table_unsorted_indices(mid, aid, array, rows=None, index=None, sor
                                 "cherrypy.HTTPError 400 %s is not an array artifact." % aid)
         raise cherrypy.HTTPError("400 %s is not an array artifact." % aid)
 
-    with slycat.web.server.hdf5.lock:
-        with slycat.web.server.hdf5.open(artifact, mode="r+") as file:
-            metadata = get_table_metadata(file, array, index)
+    with slycat.web.server.hdf5.pool.arrayset(artifact) as arrayset:
+        metadata = get_table_metadata(arrayset, array, index)
 
-            # Constrain end <= count along both dimensions
-            rows = rows[rows < metadata["row-count"]]
-            if sort is not None:
-                for column, order in sort:
-                    if column >= metadata["column-count"]:
-                        slycat.email.send_error("slycat.web.server.handlers.py get_model_table_unsorted_indices",
-                                                "cherrypy.HTTPError 400 sort column out-of-range.")
-                        raise cherrypy.HTTPError("400 Sort column out-of-range.")
+        # Constrain end <= count along both dimensions
+        rows = rows[rows < metadata["row-count"]]
+        if sort is not None:
+            for column, order in sort:
+                if column >= metadata["column-count"]:
+                    slycat.email.send_error("slycat.web.server.handlers.py get_model_table_unsorted_indices",
+                                            "cherrypy.HTTPError 400 sort column out-of-range.")
+                    raise cherrypy.HTTPError("400 Sort column out-of-range.")
 
-            # Generate a database query
-            sort_index = get_table_sort_index(file, metadata, array, sort, index)
-            slice = sort_index[rows].astype("int32")
+        # Generate a database query
+        slice = get_table_rows(artifact, arrayset, metadata, array, sort, index, rows).astype("int32")
 
-        if byteorder is None:
-            return json.dumps(slice.tolist())
+    if byteorder is None:
+        return json.dumps(slice.tolist())
+    else:
+        if sys.byteorder != byteorder:
+            return slice.byteswap().tostring(order="C")
         else:
-            if sys.byteorder != byteorder:
-                return slice.byteswap().tostring(order="C")
-            else:
-                return slice.tostring(order="C")
+            return slice.tostring(order="C")
 
 
 def get_model_file(mid, aid):
@@ -1951,8 +1927,7 @@ def post_remotes():
     {sessions:[{{"sid": sid,"hostname": hostname, "username": username}},...]}
     '''
     try:
-        database = slycat.web.server.database.couchdb.connect()
-        session = database.get("session", cherrypy.request.cookie["slycatauth"].value)
+        session = slycat.web.server.sessions.table.get(cherrypy.request.cookie["slycatauth"].value)
         hostname_not_found = True
         for i in xrange(len(session["sessions"])):
             if session["sessions"][i]["hostname"] == hostname:
@@ -1961,7 +1936,7 @@ def post_remotes():
                 hostname_not_found = False
         if hostname_not_found:
             session["sessions"].append({"sid": sid, "hostname": hostname, "username": username})
-        database.save(session)
+        slycat.web.server.sessions.table.save(session)
     except Exception as e:
         cherrypy.log.error("login could not save session for remotes %s" % e)
     return {"sid": sid, "status": True, "msg": ""}
@@ -1978,8 +1953,7 @@ def get_remotes(hostname):
     status = False
     msg = "hostname session not found"
     try:
-        database = slycat.web.server.database.couchdb.connect()
-        session = database.get("session", cherrypy.request.cookie["slycatauth"].value)
+        session = slycat.web.server.sessions.table.get(cherrypy.request.cookie["slycatauth"].value)
         for h_session in session["sessions"]:
             if h_session["hostname"] == hostname:
                 if slycat.web.server.remote.check_session(h_session["sid"]):
@@ -1987,7 +1961,7 @@ def get_remotes(hostname):
                     msg = "hostname session was found"
                 else:
                     session["sessions"][:] = [tup for tup in session["sessions"] if tup["hostname"] != hostname]
-                    database.save(session)
+                    slycat.web.server.sessions.table.save(session)
     except Exception as e:
         cherrypy.log.error("status could not save session for remotes %s" % e)
     return {"status": status, "msg": msg}
@@ -2146,7 +2120,10 @@ def get_remote_file(hostname, path, **kwargs):
     """
     sid = get_sid(hostname)
     with slycat.web.server.remote.get_session(sid) as session:
-        return session.get_file(path, **kwargs)
+        return session.stream_file(path, **kwargs)
+
+
+get_remote_file._cp_config = {"response.stream": True}
 
 
 def get_remote_image(hostname, path, **kwargs):
@@ -2237,6 +2214,9 @@ def get_remote_video(hostname, vsid):
         return session.get_video(vsid)
 
 
+get_remote_video._cp_config = {"response.stream": True}
+
+
 def post_events(event):
     # We don't actually have to do anything here, since the request is already logged.
     cherrypy.response.status = "204 Event logged."
@@ -3,11 +3,15 @@
 # rights in this software.
 
 import cherrypy
+import collections
+import contextlib
 import h5py
 import os
+import Queue
 import slycat.hdf5
 import threading
 import types
+import weakref
 
 def path(array):
   """Convert an array identifier to a data store filesystem path."""
@@ -16,6 +20,13 @@ def path(array):
   return slycat.hdf5.path(array, path.root)
 path.root = None
 
+def layout():
+  """Return the storage layout policy for new arrays, see :func:`slycat.hdf5.storage_options`."""
+  if layout.policy is None:
+    layout.policy = cherrypy.tree.apps[""].config["slycat-web-server"].get("hdf5-layout", {"compression": "lzf", "shuffle": False, "chunk-size": 64 * 1024})
+  return layout.policy
+layout.policy = None
+
 def create(array):
   "Create a new array in the data store, ready for writing."""
   array_path = path(array)
@@ -31,17 +42,246 @@ def open(array, mode="r"):
 
 def delete(array):
   """Remove an array from the data store."""
-  array_path = path(array)
-  if os.path.exists(array_path):
-    cherrypy.log.error("Deleting file {}".format(array_path))
-    os.remove(array_path)
-
-class null_lock(object):
-  """Do-nothing replacement for a thread lock, useful for debugging threading problems with h5py."""
-  def __enter__(self):
-    pass
-  def __exit__(self, exc_type, exc_value, traceback):
-    pass
-
-#lock = null_lock()
-lock = threading.RLock()
+  with pool.lock(array).write():
+    pool.invalidate(array)
+    array_path = path(array)
+    if os.path.exists(array_path):
+      cherrypy.log.error("Deleting file {}".format(array_path))
+      os.remove(array_path)
+
+class ReaderWriterLock(object):
+  """Lock that admits any number of concurrent readers, or a single writer.
+
+  Writers are given preference: once a writer is waiting, new readers block
+  until it has finished.  Readers may re-enter the lock, and the writer may
+  re-enter it (as a reader or a writer) from the thread that holds it.
+  """
+  def __init__(self):
+    self._condition = threading.Condition(threading.Lock())
+    self._readers = collections.Counter()
+    self._writer = None
+    self._writer_depth = 0
+    self._waiting_writers = 0
+
+  def acquire_read(self):
+    with self._condition:
+      thread = threading.current_thread()
+      if self._writer == thread:
+        self._writer_depth += 1
+        return
+      if not self._readers[thread]:
+        while self._writer is not None or self._waiting_writers:
+          self._condition.wait()
+      self._readers[thread] += 1
+
+  def release_read(self):
+    with self._condition:
+      thread = threading.current_thread()
+      if self._writer == thread:
+        self._writer_depth -= 1
+        return
+      self._readers[thread] -= 1
+      if not self._readers[thread]:
+        del self._readers[thread]
+        if not self._readers:
+          self._condition.notify_all()
+
+  def acquire_write(self):
+    with self._condition:
+      if self._writer == threading.current_thread():
+        self._writer_depth += 1
+        return
+      self._waiting_writers += 1
+      while self._writer is not None or self._readers:
+        self._condition.wait()
+      self._waiting_writers -= 1
+      self._writer = threading.current_thread()
+      self._writer_depth = 1
+
+  def release_write(self):
+    with self._condition:
+      self._writer_depth -= 1
+      if self._writer_depth == 0:
+        self._writer = None
+        self._condition.notify_all()
+
+  @contextlib.contextmanager
+  def read(self):
+    self.acquire_read()
+    try:
+      yield
+    finally:
+      self.release_read()
+
+  @contextlib.contextmanager
+  def write(self):
+    self.acquire_write()
+    try:
+      yield
+    finally:
+      self.release_write()
+
+class FilePool(object):
+  """Bounded LRU pool of read-only file handles, keyed by array identifier.
+
+  Every array gets its own :class:`ReaderWriterLock`, so reads of different
+  arrays - and concurrent reads of the same array - proceed in parallel, while
+  writes get exclusive access.  Pooled handles are closed before a writer
+  opens the file, and when the array is deleted.
+
+  Statistics and unique values computed by readers are shared in memory with
+  other readers of the same array, and written back to the file
+  by a background thread, so read paths never need write access.
+  """
+  def __init__(self, size=None):
+    self._size = size
+    self._mutex = threading.Lock()
+    self._files = collections.OrderedDict()
+    self._users = collections.defaultdict(int)
+    self._locks = weakref.WeakValueDictionary()
+    self._derived = {}
+    self._queue = Queue.Queue()
+    self._queued = set()
+    self._thread = None
+
+  @property
+  def size(self):
+    """Maximum number of idle handles kept open."""
+    if self._size is None:
+      try:
+        self._size = cherrypy.tree.apps[""].config["slycat-web-server"].get("hdf5-file-pool-size", 32)
+      except:
+        return 32
+    return self._size
+
+  def lock(self, array):
+    """Return the reader / writer lock for an array."""
+    with self._mutex:
+      lock = self._locks.get(array)
+      if lock is None:
+        lock = self._locks[array] = ReaderWriterLock()
+      return lock
+
+  @contextlib.contextmanager
+  def reader(self, array):
+    """Context manager that provides shared, read-only access to an array."""
+    with self.lock(array).read():
+      file = self._checkout(array)
+      try:
+        yield file
+      finally:
+        self._checkin(array)
+
+  @contextlib.contextmanager
+  def arrayset(self, array):
+    """Context manager that provides shared, read-only access to an array as a :class:`slycat.hdf5.ArraySet`."""
+    with self.reader(array) as file:
+      with self._mutex:
+        derived = self._derived.setdefault(array, {})
+      yield slycat.hdf5.ArraySet(file, derived)
+      if derived:
+        self._defer(array, derived)
+
+  @contextlib.contextmanager
+  def writer(self, array, mode="r+"):
+    """Context manager that provides exclusive, writable access to an array."""
+    with self.lock(array).write():
+      self.invalidate(array)
+      with open(array, mode) as file:
+        yield file
+
+  def invalidate(self, array):
+    """Close the pooled handle for an array, if any.  Callers must hold the array's write lock."""
+    with self._mutex:
+      file = self._files.pop(array, None)
+      self._derived.pop(array, None)
+    if file is not None:
+      file.close()
+
+  def clear(self):
+    """Close every idle handle in the pool."""
+    with self._mutex:
+      idle = [array for array in self._files if not self._users[array]]
+      files = [self._files.pop(array) for array in idle]
+    for file in files:
+      file.close()
+
+  def flush(self):
+    """Wait until all derived data computed by readers has been written."""
+    self._queue.join()
+
+  def __len__(self):
+    return len(self._files)
+
+  def _defer(self, array, derived):
+    with self._mutex:
+      if array in self._queued:
+        return
+      self._queued.add(array)
+      if self._thread is None:
+        self._thread = threading.Thread(name="hdf5 derived data writer", target=self._write_derived)
+        self._thread.daemon = True
+        self._thread.start()
+    self._queue.put((array, derived))
+
+  def _write_derived(self):
+    while True:
+      array, derived = self._queue.get()
+      try:
+        with self.lock(array).write():
+          with self._mutex:
+            self._queued.discard(array)
+            current = self._derived.get(array) is derived
+          # If the array was written or deleted since the data was derived, it's stale.
+          if current and os.path.exists(path(array)):
+            self.invalidate(array)
+            with open(array, "r+") as file:
+              slycat.hdf5.store_derived(file, derived)
+      except Exception as e:
+        cherrypy.log.error("Storing derived data for %s failed: %s" % (array, e))
+      finally:
+        self._queue.task_done()
+
+  def _checkout(self, array):
+    with self._mutex:
+      file = self._files.pop(array, None)
+      if file is not None:
+        self._files[array] = file
+        self._users[array] += 1
+        return file
+
+    # Open the file without holding the pool mutex, so a slow open doesn't stall readers of other arrays.
+    opened = open(array, "r")
+    with self._mutex:
+      file = self._files.pop(array, None)
+      if file is None:
+        file, opened = opened, None
+      self._files[array] = file
+      self._users[array] += 1
+      evicted = self._evict()
+    if opened is not None:
+      evicted.append(opened)
+    for handle in evicted:
+      handle.close()
+    return file
+
+  def _checkin(self, array):
+    with self._mutex:
+      self._users[array] -= 1
+      if not self._users[array]:
+        del self._users[array]
+      evicted = self._evict()
+    for handle in evicted:
+      handle.close()
+
+  def _evict(self):
+    """Remove least-recently-used idle handles beyond the pool size.  Callers must hold the pool mutex."""
+    evicted = []
+    for array in list(self._files.keys()):
+      if len(self._files) <= self.size:
+        break
+      if not self._users.get(array):
+        evicted.append(self._files.pop(array))
+    return evicted
+
+pool = FilePool()
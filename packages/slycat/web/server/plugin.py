@@ -3,12 +3,120 @@
 # rights in this software.
 
 import cherrypy
+import datetime
 import hashlib
 import imp
+import multiprocessing
 import os
+import StringIO
+import threading
+import time
 import traceback
 import slycat.email
 
+def parser_processes():
+  """Return the maximum number of worker processes used to prepare the files passed to a parser."""
+  if parser_processes.count is None:
+    parser_processes.count = cherrypy.tree.apps[""].config["slycat-web-server"].get("parser-processes", None) or multiprocessing.cpu_count()
+  return parser_processes.count
+parser_processes.count = None
+
+def parser_timeout():
+  """Return how long the worker processes may take to prepare the files passed to a parser."""
+  if parser_timeout.timeout is None:
+    parser_timeout.timeout = cherrypy.tree.apps[""].config["slycat-web-server"].get("parser-timeout", None) or datetime.timedelta(hours=1)
+  return parser_timeout.timeout
+parser_timeout.timeout = None
+
+def start_workers():
+  """Start the pool of worker processes used to prepare uploaded files.
+
+  Called when the engine starts, before it starts any threads: forking a
+  process while another thread holds a lock (in HDF5, for example) would leave
+  the lock held forever in the child.  Without the pool, files are prepared
+  one at a time.
+  """
+  processes = parser_processes()
+  if start_workers.pool is None and processes > 1:
+    cherrypy.log.error("Starting %s parser worker processes." % processes)
+    start_workers.pool = multiprocessing.Pool(processes)
+start_workers.pool = None
+# After daemonizing (65), and before the monitor threads (70) and servers (75).
+start_workers.priority = 67
+
+def stop_workers():
+  """Stop the pool of worker processes used to prepare uploaded files."""
+  if start_workers.pool is not None:
+    start_workers.pool.terminate()
+    start_workers.pool.join()
+    start_workers.pool = None
+
+def _convert_file(file, stream):
+  """Return a file as a file-like object if stream is True, otherwise as a string."""
+  if stream:
+    return StringIO.StringIO(file) if isinstance(file, basestring) else file
+  return file if isinstance(file, basestring) else file.read()
+
+def _prepare_file(prepare, stream, input, file, kwargs):
+  return prepare(input, _convert_file(file, stream), **kwargs)
+
+def _discard(storages):
+  import slycat.web.server.hdf5
+  for storage in storages:
+    slycat.web.server.hdf5.delete(storage)
+
+def _prepare_files(prepare, stream, input, files, kwargs):
+  """Prepare each file in the worker processes, returning the results in file order.
+
+  If any file fails, or the files aren't all prepared within the parser
+  timeout, the array sets prepared for the others are deleted (including any
+  that are finished later), and the error is raised.
+  """
+  results = []
+  pool = start_workers.pool
+  if pool is None or len(files) < 2:
+    try:
+      for file in files:
+        results.append(_prepare_file(prepare, stream, input, file, kwargs))
+    except:
+      _discard(results)
+      raise
+    return results
+
+  # Called by the pool as each file is prepared.
+  lock = threading.Lock()
+  abandoned = []
+  def deliver(storage):
+    with lock:
+      if abandoned:
+        _discard([storage])
+      else:
+        results.append(storage)
+
+  timeout = parser_timeout()
+  deadline = time.time() + timeout.total_seconds()
+  pending = [pool.apply_async(_prepare_file, (prepare, stream, input, file, kwargs), callback=deliver) for file in files]
+  try:
+    try:
+      return [result.get(max(0, deadline - time.time())) for result in pending]
+    except multiprocessing.TimeoutError:
+      raise Exception("Files weren't prepared within %s." % timeout)
+  except:
+    with lock:
+      abandoned.append(True)
+      _discard(results)
+    raise
+
+def _adapt_parser(parse, stream, prepare):
+  """Wrap a parser so it can be called with strings or file-like objects, and receives the kind it asked for."""
+  def implementation(database, model, input, files, aids, **kwargs):
+    if prepare is not None:
+      files = _prepare_files(prepare, stream, input, files, kwargs)
+    else:
+      files = [_convert_file(file, stream) for file in files]
+    return parse(database, model, input, files, aids, **kwargs)
+  return implementation
+
 class Manager(object):
   """Manages server plugin modules."""
   def __init__(self):
@@ -260,7 +368,7 @@ class Manager(object):
     self.pages[type] = {"html": html}
     cherrypy.log.error("Registered page '%s'." % type)
 
-  def register_parser(self, type, label, categories, parse):
+  def register_parser(self, type, label, categories, parse, stream=False, prepare=None):
     """Register a new parser type.
 
     Parameters
@@ -272,15 +380,28 @@ class Manager(object):
     categories: list, required
       List of string categories describing the type of data this parser produces, for example "table".
     parse: callable, required
-      Called with a database, model, input flag, list of file objects, list of
-      artifact names, and optional keyword arguments.  Must parse the file and
-      insert its data into the model as artifacts, returning True if
-      successful, otherwise False.
+      Called with a database, model, input flag, list of file contents
+      (strings), list of artifact names, and optional keyword arguments.
+      Must parse the file and insert its data into the model as artifacts,
+      returning True if successful, otherwise False.
+    stream: bool, optional
+      If True, the parser is called with read-only file-like objects instead
+      of strings, so it can consume large files incrementally instead of
+      holding them in memory.
+    prepare: callable, optional
+      Called for each file with the input flag, the file, and optional
+      keyword arguments.  Must store the file's data in a new array set
+      created with :func:`slycat.web.server.create_arrayset`, returning its
+      storage id.  When there are several files, they are prepared in
+      parallel, in separate processes.  The parse callable is then called
+      with the storage ids, in file order, instead of the files, and must
+      attach them to the model with
+      :func:`slycat.web.server.put_model_arrayset`.
     """
     if type in self.parsers:
       slycat.email.send_error("slycat.web.server.plugin.py register_parser", "Parser type '%s' has already been regiitered.")
       raise Exception("Parser type '%s' has already been registered." % type)
-    self.parsers[type] = {"label": label, "categories": categories, "parse": parse}
+    self.parsers[type] = {"label": label, "categories": categories, "stream": stream, "parse": _adapt_parser(parse, stream, prepare)}
     cherrypy.log.error("Registered parser '%s'." % type)
 
   def register_password_check(self, type, check):
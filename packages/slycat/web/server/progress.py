@@ -0,0 +1,186 @@
+# Copyright 2013, Sandia Corporation. Under the terms of Contract
+# DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
+# rights in this software.
+
+"""Throttled, coalesced model progress updates.
+
+Compute threads report progress and messages far more often than anyone can
+read them, and every report used to save the whole model document, causing
+revision churn and conflicts with other writers.  A :class:`Reporter`
+coalesces progress and message updates for each model, writing them at most
+once per interval, while state changes are written immediately.
+"""
+
+import cherrypy
+import couchdb.http
+import threading
+import time
+
+fields = ["state", "result", "started", "finished", "progress", "message"]
+"""Model fields that can be updated with :meth:`Reporter.update`."""
+
+class Reporter(object):
+  """Writes model progress updates to the database.
+
+  Deferred updates are written by a background thread to the current revision
+  of the model in the database, never to the caller's copy.  The reporter
+  remembers the revisions it wrote, so that a caller whose copy is only out of
+  date because of them can still save it through :meth:`update`.  Code that
+  saves models should use :meth:`update` (see
+  :func:`slycat.web.server.update_model`), rather than saving them directly.
+
+  Parameters
+  ----------
+  interval : number, optional.
+    Minimum seconds between progress or message writes for a model, defaults
+    to the "model-progress-interval" configuration value, or 1.0.
+  """
+  attempts = 5
+  """Number of times a conflicting write is retried."""
+
+  def __init__(self, interval=None):
+    self._interval = interval
+    self._lock = threading.Lock()
+    self._wakeup = threading.Condition(self._lock)
+    # Writes for each model are serialized, so the revisions the reporter wrote form a chain.
+    self._model_locks = [threading.Lock() for i in range(64)]
+    self._written = {}
+    self._pending = {}
+    # For each model: the revisions that deferred writes started from, the revision they
+    # ended with, and the fields they wrote.
+    self._revisions = {}
+    self._thread = None
+
+  @property
+  def interval(self):
+    if self._interval is None:
+      self._interval = cherrypy.tree.apps[""].config["slycat-web-server"].get("model-progress-interval", 1.0)
+    return self._interval
+
+  def update(self, database, model, **kwargs):
+    """Update a model, writing it now or after the interval has passed.
+
+    Fields other than those in :data:`fields` are ignored.  The model is
+    always updated in place.  Changes to any field except "progress" and
+    "message", and calls without fields (which just save the model), are
+    written immediately, along with any changes still waiting to be written.
+    Other changes are written immediately if the model hasn't been written
+    within the interval, and otherwise by a background thread once it has,
+    along with any later changes, even if they're made to another copy of the
+    model.
+    """
+    updates = dict((name, value) for name, value in kwargs.items() if name in fields)
+    for name, value in updates.items():
+      model[name] = value
+
+    mid = model["_id"]
+    now = time.time()
+    deferrable = updates and not set(updates) - set(["progress", "message"])
+    merge = bool(updates)
+    with self._lock:
+      # Changes still waiting to be written are written along with this one.
+      pending = self._pending.pop(mid, None)
+      if pending is not None:
+        for name, value in pending[2].items():
+          if name not in updates:
+            updates[name] = model[name] = value
+      if deferrable and now - self._written.get(mid, 0) < self.interval:
+        self._pending[mid] = (self._written[mid] + self.interval, database, dict(updates))
+        if self._thread is None:
+          self._thread = threading.Thread(name="model progress writer", target=self._write_pending)
+          self._thread.daemon = True
+          self._thread.start()
+        self._wakeup.notify()
+        return
+      if model.get("state") == "finished":
+        self._written.pop(mid, None)
+      else:
+        self._written[mid] = now
+    self._write(database, model, updates, merge)
+
+  def _write(self, database, model, updates, merge):
+    """Save a caller's copy of a model.
+
+    If the only writes since the caller's revision were deferred updates, the
+    copy is saved over them, keeping the fields they wrote unless the caller
+    is updating them too.  Otherwise, if the model was modified elsewhere, the
+    updated fields are merged into the current revision, unless there are no
+    updated fields to merge.
+    """
+    mid = model["_id"]
+    with self._model_locks[hash(mid) % len(self._model_locks)]:
+      document = dict(model)
+      for attempt in range(self.attempts):
+        try:
+          database.save(document)
+          break
+        except couchdb.http.ResourceConflict:
+          if attempt == self.attempts - 1:
+            raise
+          current = database.get("model", mid)
+          deferred = self._deferred(mid, model.get("_rev"), current["_rev"])
+          if deferred is not None:
+            document = dict(model)
+            document.update(deferred)
+            document.update(updates)
+            document["_rev"] = current["_rev"]
+          elif merge:
+            document = current
+            document.update(updates)
+          else:
+            raise
+      with self._lock:
+        self._revisions.pop(mid, None)
+      # The caller's copy gets the new revision, and whatever was merged or written by deferred updates.
+      model.update(document)
+
+  def _deferred(self, mid, revision, current):
+    """Return the fields written by deferred updates since a revision, or None if anything else has written the model since then."""
+    with self._lock:
+      if mid not in self._revisions:
+        return None
+      bases, latest, written = self._revisions[mid]
+      if revision not in bases or latest != current:
+        return None
+      return dict(written)
+
+  def _write_deferred(self, database, mid, updates):
+    """Write deferred updates to the current revision of a model."""
+    with self._model_locks[hash(mid) % len(self._model_locks)]:
+      for attempt in range(self.attempts):
+        document = database.get("model", mid)
+        base = document["_rev"]
+        document.update(updates)
+        try:
+          database.save(document)
+          break
+        except couchdb.http.ResourceConflict:
+          if attempt == self.attempts - 1:
+            raise
+      with self._lock:
+        entry = self._revisions.get(mid)
+        if entry is not None and entry[1] == base:
+          entry[0].add(base)
+          entry[1] = document["_rev"]
+          entry[2].update(updates)
+        else:
+          self._revisions[mid] = [set([base]), document["_rev"], dict(updates)]
+
+  def _write_pending(self):
+    while True:
+      with self._lock:
+        while not self._pending:
+          self._wakeup.wait()
+        mid, (deadline, database, updates) = min(self._pending.items(), key=lambda item: item[1][0])
+        now = time.time()
+        if deadline > now:
+          self._wakeup.wait(deadline - now)
+          continue
+        del self._pending[mid]
+        self._written[mid] = now
+      try:
+        self._write_deferred(database, mid, updates)
+      except Exception as e:
+        cherrypy.log.error("Couldn't write progress for model %s: %s" % (mid, e))
+
+reporter = Reporter()
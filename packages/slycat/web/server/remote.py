@@ -28,7 +28,9 @@ Each session is bound to the IP address of the client that created it - only
 the same client IP address is allowed to access the session.
 """
 
+import collections
 import datetime
+import itertools
 import json
 import os
 import stat
@@ -36,6 +38,7 @@ import sys
 import threading
 import time
 import uuid
+import zlib
 import cherrypy
 import paramiko
 
@@ -43,6 +46,7 @@ import slycat.email
 import slycat.mime_type
 import slycat.web.server.authentication
 import slycat.web.server.database
+import slycat.web.server.ssh_pool
 import slycat.web.server.streaming
 import slycat.web.server
 
@@ -87,9 +91,12 @@ class Session(object):
   >>> with slycat.web.server.remote.get_session(sid) as session:
   ...   print session.username
 
+  If the agent runs commands concurrently, threads waiting for its responses
+  release the session in the meantime, so other requests aren't held up by
+  slow commands.
   """
 
-    def __init__(self, client, username, hostname, ssh, sftp, agent=None):
+    def __init__(self, client, username, hostname, ssh, sftp, agent=None, chunk_size=None, multiplexed=False, flow_control=False):
         now = datetime.datetime.utcnow()
         self._client = client
         self._username = username
@@ -99,10 +106,17 @@ class Session(object):
         self._agent = agent
         self._created = now
         self._accessed = now
-        self._lock = threading.Lock()
+        self._chunk_size = chunk_size
+        self._lock = threading.Condition(threading.RLock())
+        # Set while a file is being streamed from an agent that runs one command
+        # at a time, which can outlast the request handler.
+        self._streaming = False
+        self._demultiplexer = _Demultiplexer(self._lock, agent[0], agent[1], flow_control) if agent is not None and multiplexed else None
 
     def __enter__(self):
         self._lock.__enter__()
+        while self._streaming:
+            self._lock.wait()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -159,13 +173,10 @@ class Session(object):
           A dictionary with the following keys: filename, jid, errors
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             payload = {"action": "submit-batch", "command": filename}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py submit_batch",
@@ -197,13 +208,10 @@ class Session(object):
           A dictionary with the following keys: jid, status, errors
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             payload = {"action": "checkjob", "command": jid}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py checkjob",
@@ -248,13 +256,10 @@ class Session(object):
           A dictionary with the following keys: jid, output, errors
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             payload = {"action": "cancel-job", "command": jid}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py cancel_job",
@@ -285,13 +290,10 @@ class Session(object):
           A dictionary with the following keys: jid, output, errors
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             payload = {"action": "get-job-output", "command": {"jid": jid, "path": path}}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py get_job_output",
@@ -314,13 +316,10 @@ class Session(object):
           A dictionary with the configuration values
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             payload = {"action": "get-user-config"}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py get_user_config",
@@ -342,13 +341,10 @@ class Session(object):
         response : dict
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             payload = {"action": "set-user-config", "command": {"config": config}}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py set_user_config",
@@ -508,7 +504,6 @@ class Session(object):
             else:
                 return create_distance_matrix(fn_id, params)
 
-        stdin, stdout, stderr = self._agent
         payload = {
             "action": "run-function",
             "command": {
@@ -525,10 +520,8 @@ class Session(object):
             }
         }
         cherrypy.log.error("writing msg: %s" % json.dumps(payload))
-        stdin.write("%s\n" % json.dumps(payload))
-        stdin.flush()
-
-        response = json.loads(stdout.readline())
+        with self._agent_command(payload) as stdout:
+            response = json.loads(stdout.readline())
         cherrypy.log.error("response msg: %s" % response)
         if not response["ok"]:
             cherrypy.response.headers["x-slycat-message"] = response["message"]
@@ -561,14 +554,11 @@ class Session(object):
           A dictionary with the following keys: command, output, errors
         """
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
 
             payload = {"action": "launch", "command": command}
 
-            stdin.write("%s\n" % json.dumps(payload))
-            stdin.flush()
-
-            response = json.loads(stdout.readline())
+            with self._agent_command(payload) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 slycat.email.send_error("slycat.web.server.remote.py launch",
@@ -593,7 +583,6 @@ class Session(object):
     def browse(self, path, file_reject, file_allow, directory_reject, directory_allow):
         # Use the agent to browse.
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
             command = {"action": "browse", "path": path}
             if file_reject is not None:
                 command["file-reject"] = file_reject
@@ -604,9 +593,8 @@ class Session(object):
             if directory_allow is not None:
                 command["directory-allow"] = directory_allow
 
-            stdin.write("%s\n" % json.dumps(command))
-            stdin.flush()
-            response = json.loads(stdout.readline())
+            with self._agent_command(command) as stdout:
+                response = json.loads(stdout.readline())
             if not response["ok"]:
                 cherrypy.response.headers["x-slycat-message"] = response["message"]
                 raise cherrypy.HTTPError(400)
@@ -655,6 +643,18 @@ class Session(object):
             raise cherrypy.HTTPError(400)
 
     def get_file(self, path, **kwargs):
+        return self._get_file(path, False, kwargs)
+
+    def stream_file(self, path, **kwargs):
+        """Retrieve a file like :meth:`get_file`, but return whole files retrieved by the agent as an iterable of chunks.
+
+        The chunks are read from the agent as the iterable is consumed, so the
+        file is never held in memory, and other requests can't use the session
+        until the iterable has been exhausted or closed.
+        """
+        return self._get_file(path, True, kwargs)
+
+    def _get_file(self, path, stream, kwargs):
         cache = kwargs.get("cache", None)
         project = kwargs.get("project", None)
         key = kwargs.get("key", None)
@@ -674,71 +674,37 @@ class Session(object):
                                         "cherrypy.HTTPError 400 must specify cache key.")
                 raise cherrypy.HTTPError("400 Must specify cache key.")
 
+        ranged = "range" in cherrypy.request.headers and cache is None
+
         # Use the agent to retrieve a file.
         if self._agent is not None:
-            stdin, stdout, stderr = self._agent
-            stdin.write("%s\n" % json.dumps({"action": "get-file", "path": path}))
-            stdin.flush()
-            metadata = json.loads(stdout.readline())
-
-            if metadata["message"] == "Path must be absolute.":
-                cherrypy.response.headers["x-slycat-message"] = "Remote path %s:%s is not absolute." % (
-                    self.hostname, path)
-                slycat.email.send_error("slycat.web.server.remote.py get_file",
-                                        "cherrypy.HTTPError 400 remote path %s:%s is not absolute." % (
-                                            self.hostname, path))
-                raise cherrypy.HTTPError("400 Path not absolute.")
-            elif metadata["message"] == "No read permission.":
-                cherrypy.response.headers["x-slycat-message"] = "You do not have permission to retrieve %s:%s" % (
-                    self.hostname, path)
-                cherrypy.response.headers[
-                    "x-slycat-hint"] = "Check the filesystem on %s to verify that your user has" \
-                                       " access to %s, and don't forget to set appropriate permissions" \
-                                       " on all the parent directories!" % (
-                                           self.hostname, path)
-                slycat.email.send_error("slycat.web.server.remote.py get_file",
-                                        "cherrypy.HTTPError 400 you do not have permission to "
-                                        "retrieve %s:%s. Check the filesystem on %s to verify that"
-                                        " your user has access to %s, and don't forget to set appropriate "
-                                        "permissions on all the parent directories." % (
-                                            self.hostname, path, self.hostname, path))
-                raise cherrypy.HTTPError("400 Access denied.")
-            elif metadata["message"] == "Path not found.":
-                cherrypy.response.headers["x-slycat-message"] = "The remote file %s:%s does not exist." % (
-                    self.hostname, path)
-                slycat.email.send_error("slycat.web.server.remote.py get_file",
-                                        "cherrypy.HTTPError 400 the remote file %s:%s does not exist." % (
-                                            self.hostname, path))
-                raise cherrypy.HTTPError("400 File not found.")
-            elif metadata["message"] == "Directory unreadable.":
-                cherrypy.response.headers["x-slycat-message"] = "Remote path %s:%s is a directory." % (
-                    self.hostname, path)
-                slycat.email.send_error("slycat.web.server.remote.py get_file",
-                                        "cherrypy.HTTPError 400 can't read directory %s:%s." % (self.hostname, path))
-                raise cherrypy.HTTPError("400 Can't read directory.")
-            elif metadata["message"] == "Access denied.":
-                cherrypy.response.headers["x-slycat-message"] = "You do not have permission to retrieve %s:%s" % (
-                    self.hostname, path)
-                cherrypy.response.headers[
-                    "x-slycat-hint"] = "Check the filesystem on %s to verify that your user has access" \
-                                       " to %s, and don't forget to set appropriate permissions on all" \
-                                       " the parent directories!" % (
-                                           self.hostname, path)
-                slycat.email.send_error("slycat.web.server.remote.py get_file",
-                                        "cherrypy.HTTPError 400 you do not have permission to"
-                                        " retrieve %s:%s. Check the filesystem on %s to verify "
-                                        "that your user has access to %s, and don't forget to set"
-                                        " appropriate permissions on all the parent directories." % (
-                                            self.hostname, path, self.hostname, path))
-                raise cherrypy.HTTPError("400 Access denied.")
-
+            if ranged:
+                # Only read the requested ranges, unless the agent doesn't support them and sends the whole file.
+                with self._agent_command({"action": "get-file", "path": path, "offset": 0, "length": 0}) as stdout:
+                    metadata = json.loads(stdout.readline())
+                    self._check_file_metadata(path, metadata)
+                    if "file-size" not in metadata:
+                        content = slycat.web.server.streaming.serve(stdout, metadata["size"], metadata["content-type"])
+                        return content if stream else "".join(content)
+                    stdout.read(metadata["size"])
+                key = (self.username, self.hostname, path, metadata["file-size"], metadata["mtime"])
+                read = self._locked(lambda offset, length: self._agent_get_file(path, offset, length)[1])
+                content = slycat.web.server.streaming.serve_ranges(
+                    slycat.web.server.streaming.cache.reader(key, metadata["file-size"], read),
+                    metadata["file-size"], metadata["content-type"])
+                return content if stream else "".join(content)
+
+            metadata, chunks = self._agent_stream_file(path)
             content_type = metadata["content-type"]
-            content = stdout.read(metadata["size"])
+            cherrypy.response.headers["content-type"] = content_type
+
+            if stream and cache is None:
+                cherrypy.response.headers["content-length"] = metadata["size"]
+                return chunks
 
+            content = "".join(chunks)
             if cache == "project":
                 cache_object(project, key, content_type, content)
-
-            cherrypy.response.headers["content-type"] = content_type
             return content
 
         # Use sftp to retrieve a file.
@@ -753,6 +719,16 @@ class Session(object):
             content_type, encoding = slycat.mime_type.guess_type(path)
             if content_type is None:
                 content_type = "application/octet-stream"
+
+            if ranged:
+                attributes = self._sftp.stat(path)
+                key = (self.username, self.hostname, path, attributes.st_size, attributes.st_mtime)
+                read = self._locked(lambda offset, length: self._sftp_read(path, offset, length))
+                content = slycat.web.server.streaming.serve_ranges(
+                    slycat.web.server.streaming.cache.reader(key, attributes.st_size, read),
+                    attributes.st_size, content_type)
+                return content if stream else "".join(content)
+
             content = self._sftp.file(path).read()
 
             if cache == "project":
@@ -761,6 +737,8 @@ class Session(object):
             cherrypy.response.headers["content-type"] = content_type
             return content
 
+        except cherrypy.HTTPError:
+            raise
         except Exception as e:
             cherrypy.log.error("Exception reading remote file %s: %s %s" % (path, type(e), str(e)))
 
@@ -803,6 +781,129 @@ class Session(object):
                                     "cherrypy.HTTPError 400 remote access failed: %s" % str(e))
             raise cherrypy.HTTPError("400 Remote access failed.")
 
+    def _locked(self, read):
+        """Wrap a function that reads part of a file, so it holds the session lock.
+
+        Ranged responses are read as they're sent, after the request handler has
+        released the session.
+        """
+        def implementation(offset, length):
+            with self:
+                return read(offset, length)
+        return implementation
+
+    def _sftp_read(self, path, offset, length):
+        with self._sftp.open(path, "rb") as file:
+            file.seek(offset)
+            return file.read(length)
+
+    def _agent_get_file(self, path, offset=None, length=None):
+        """Retrieve a file, or part of one, with the agent, returning its metadata and content."""
+        command = {"action": "get-file", "path": path}
+        if offset is not None:
+            command["offset"] = offset
+            command["length"] = length
+        with self._agent_command(command) as stdout:
+            metadata = json.loads(stdout.readline())
+            self._check_file_metadata(path, metadata)
+            return metadata, stdout.read(metadata["size"])
+
+    def _agent_stream_file(self, path):
+        """Retrieve a file with the agent in chunks, returning its metadata and an iterable of chunks.
+
+        The caller must hold the session lock, and exhaust or close the iterable.
+        """
+        command = {"action": "get-file", "path": path, "chunk-size": self.chunk_size, "checksum": "crc32"}
+        stdout = self._agent_command(command)
+        try:
+            metadata = json.loads(stdout.readline())
+            self._check_file_metadata(path, metadata)
+            # Agents that predate chunked transfers send the whole file at once.
+            if not metadata.get("chunked", False):
+                with stdout:
+                    return metadata, [stdout.read(metadata["size"])]
+        except:
+            stdout.close()
+            raise
+        return metadata, _AgentChunks(self, path, metadata["size"], stdout)
+
+    def _agent_command(self, command):
+        """Send a command to the agent, returning a file-like object to read its response from.
+
+        The response must be closed once it has been read, which a with statement takes care of.
+        """
+        if self._demultiplexer is not None:
+            return self._demultiplexer.send(command)
+        stdin, stdout, stderr = self._agent
+        stdin.write("%s\n" % json.dumps(command))
+        stdin.flush()
+        return _Response(stdout)
+
+    @property
+    def chunk_size(self):
+        """Return the size of the chunks in which files are retrieved from the agent, in bytes."""
+        if self._chunk_size is None:
+            self._chunk_size = cherrypy.tree.apps[""].config["slycat-web-server"].get("remote-file-chunk-size", 1024 * 1024)
+        return self._chunk_size
+
+    def _check_file_metadata(self, path, metadata):
+        """Raise an HTTP error if the agent couldn't retrieve a file."""
+        if metadata["message"] == "Path must be absolute.":
+            cherrypy.response.headers["x-slycat-message"] = "Remote path %s:%s is not absolute." % (
+                self.hostname, path)
+            slycat.email.send_error("slycat.web.server.remote.py get_file",
+                                    "cherrypy.HTTPError 400 remote path %s:%s is not absolute." % (
+                                        self.hostname, path))
+            raise cherrypy.HTTPError("400 Path not absolute.")
+        elif metadata["message"] == "No read permission.":
+            cherrypy.response.headers["x-slycat-message"] = "You do not have permission to retrieve %s:%s" % (
+                self.hostname, path)
+            cherrypy.response.headers[
+                "x-slycat-hint"] = "Check the filesystem on %s to verify that your user has" \
+                                   " access to %s, and don't forget to set appropriate permissions" \
+                                   " on all the parent directories!" % (
+                                       self.hostname, path)
+            slycat.email.send_error("slycat.web.server.remote.py get_file",
+                                    "cherrypy.HTTPError 400 you do not have permission to "
+                                    "retrieve %s:%s. Check the filesystem on %s to verify that"
+                                    " your user has access to %s, and don't forget to set appropriate "
+                                    "permissions on all the parent directories." % (
+                                        self.hostname, path, self.hostname, path))
+            raise cherrypy.HTTPError("400 Access denied.")
+        elif metadata["message"] == "Path not found.":
+            cherrypy.response.headers["x-slycat-message"] = "The remote file %s:%s does not exist." % (
+                self.hostname, path)
+            slycat.email.send_error("slycat.web.server.remote.py get_file",
+                                    "cherrypy.HTTPError 400 the remote file %s:%s does not exist." % (
+                                        self.hostname, path))
+            raise cherrypy.HTTPError("400 File not found.")
+        elif metadata["message"] == "Directory unreadable.":
+            cherrypy.response.headers["x-slycat-message"] = "Remote path %s:%s is a directory." % (
+                self.hostname, path)
+            slycat.email.send_error("slycat.web.server.remote.py get_file",
+                                    "cherrypy.HTTPError 400 can't read directory %s:%s." % (self.hostname, path))
+            raise cherrypy.HTTPError("400 Can't read directory.")
+        elif metadata["message"] == "Access denied.":
+            cherrypy.response.headers["x-slycat-message"] = "You do not have permission to retrieve %s:%s" % (
+                self.hostname, path)
+            cherrypy.response.headers[
+                "x-slycat-hint"] = "Check the filesystem on %s to verify that your user has access" \
+                                   " to %s, and don't forget to set appropriate permissions on all" \
+                                   " the parent directories!" % (
+                                       self.hostname, path)
+            slycat.email.send_error("slycat.web.server.remote.py get_file",
+                                    "cherrypy.HTTPError 400 you do not have permission to"
+                                    " retrieve %s:%s. Check the filesystem on %s to verify "
+                                    "that your user has access to %s, and don't forget to set"
+                                    " appropriate permissions on all the parent directories." % (
+                                        self.hostname, path, self.hostname, path))
+            raise cherrypy.HTTPError("400 Access denied.")
+        elif not metadata["ok"]:
+            cherrypy.response.headers["x-slycat-message"] = "Remote access failed: %s" % metadata["message"]
+            slycat.email.send_error("slycat.web.server.remote.py get_file",
+                                    "cherrypy.HTTPError 400 remote access failed: %s" % metadata["message"])
+            raise cherrypy.HTTPError("400 Remote access failed.")
+
     def get_image(self, path, **kwargs):
         content_type = kwargs.get("content-type", None)
         max_size = kwargs.get("max-size", None)
@@ -837,7 +938,6 @@ class Session(object):
             raise cherrypy.HTTPError("400 Agent required.")
 
         # Use the agent to retrieve an image.
-        stdin, stdout, stderr = self._agent
 
         command = {"action": "get-image", "path": path}
         if content_type is not None:
@@ -849,9 +949,9 @@ class Session(object):
         if max_height is not None:
             command["max-height"] = max_height
 
-        stdin.write("%s\n" % json.dumps(command))
-        stdin.flush()
-        metadata = json.loads(stdout.readline())
+        with self._agent_command(command) as stdout:
+            metadata = json.loads(stdout.readline())
+            content = stdout.read(metadata.get("size", 0))
 
         if metadata["message"] == "Path must be absolute.":
             cherrypy.response.headers["x-slycat-message"] = "Remote path %s:%s is not absolute." % (self.hostname, path)
@@ -888,7 +988,6 @@ class Session(object):
             raise cherrypy.HTTPError("400 Access denied.")
 
         content_type = metadata["content-type"]
-        content = stdout.read(metadata["size"])
 
         if cache == "project":
             cache_object(project, key, content_type, content)
@@ -906,11 +1005,8 @@ class Session(object):
             raise cherrypy.HTTPError("400 Agent required.")
 
         # Get the video status from the agent.
-        stdin, stdout, stderr = self._agent
-
-        stdin.write("%s\n" % json.dumps({"action": "video-status", "sid": vsid}))
-        stdin.flush()
-        metadata = json.loads(stdout.readline())
+        with self._agent_command({"action": "video-status", "sid": vsid}) as stdout:
+            metadata = json.loads(stdout.readline())
 
         cherrypy.response.headers["x-slycat-message"] = metadata["message"]
 
@@ -929,13 +1025,311 @@ class Session(object):
             raise cherrypy.HTTPError("400 Agent required.")
 
         # Get the video from the agent.
-        stdin, stdout, stderr = self._agent
+        def get_video(offset=None, length=None):
+            command = {"action": "get-video", "sid": vsid}
+            if offset is not None:
+                command["offset"] = offset
+                command["length"] = length
+            return self._agent_command(command)
+
+        if "range" not in cherrypy.request.headers:
+            with get_video() as stdout:
+                metadata = json.loads(stdout.readline())
+                return slycat.web.server.streaming.serve(stdout, metadata["size"], metadata["content-type"])
+
+        # Only read the requested ranges, unless the agent doesn't support them and sends the whole video.
+        with get_video(0, 0) as stdout:
+            metadata = json.loads(stdout.readline())
+            if "file-size" not in metadata:
+                return slycat.web.server.streaming.serve(stdout, metadata["size"], metadata["content-type"])
+            stdout.read(metadata["size"])
+
+        def read(offset, length):
+            with get_video(offset, length) as stdout:
+                return stdout.read(json.loads(stdout.readline())["size"])
+        read = self._locked(read)
+        key = (self.username, self.hostname, "video", vsid, metadata["file-size"])
+        return slycat.web.server.streaming.serve_ranges(
+            slycat.web.server.streaming.cache.reader(key, metadata["file-size"], read),
+            metadata["file-size"], metadata["content-type"])
+
+
+class _AgentChunks(object):
+    """Iterates over the chunks of a file sent by the agent, checking their sizes and checksums.
+
+    If the agent runs one command at a time, other requests are kept from using
+    the session until the file has been read completely, and if the iterator is
+    closed early (the client went away), the rest of the file is read and
+    discarded, so the agent is ready for the next command.
+    """
 
-        stdin.write("%s\n" % json.dumps({"action": "get-video", "sid": vsid}))
-        stdin.flush()
-        metadata = json.loads(stdout.readline())
-        sys.stderr.write("\n%s\n" % metadata)
-        return slycat.web.server.streaming.serve(stdout, metadata["size"], metadata["content-type"])
+    def __init__(self, session, path, size, stdout):
+        self._session = session
+        self._path = path
+        self._remaining = size
+        self._stdout = stdout
+        self._done = False
+        self._finished = False
+        self._serial = session._demultiplexer is None
+        if self._serial:
+            session._streaming = True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration()
+        try:
+            chunk = self._read()
+        except Exception:
+            self.close()
+            raise
+        if not chunk:
+            self._finish()
+            raise StopIteration()
+        return chunk
+
+    def _read(self):
+        stdout = self._stdout
+        try:
+            frame = json.loads(stdout.readline())
+        except Exception:
+            self._done = True
+            raise Exception("Agent connection closed reading %s:%s." % (self._session.hostname, self._path))
+        if not frame["ok"]:
+            self._done = True
+            raise Exception("Remote access failed reading %s:%s: %s" % (self._session.hostname, self._path, frame["message"]))
+        chunk = stdout.read(frame["size"])
+        self._remaining -= len(chunk)
+        if len(chunk) != frame["size"]:
+            self._done = True
+            raise Exception("Agent connection closed reading %s:%s." % (self._session.hostname, self._path))
+        if not chunk:
+            self._done = True
+            if self._remaining:
+                raise Exception("Remote file %s:%s was truncated." % (self._session.hostname, self._path))
+        if "crc32" in frame and zlib.crc32(chunk) & 0xffffffff != frame["crc32"]:
+            raise Exception("Checksum mismatch reading %s:%s." % (self._session.hostname, self._path))
+        return chunk
+
+    def close(self):
+        try:
+            while self._serial and not self._done:
+                try:
+                    self._read()
+                except Exception as e:
+                    cherrypy.log.error("Discarding remote file chunk: %s" % str(e))
+        finally:
+            self._finish()
+
+    def _finish(self):
+        self._done = True
+        if self._finished:
+            return
+        self._finished = True
+        self._stdout.close()
+        if self._serial:
+            with self._session._lock:
+                self._session._streaming = False
+                self._session._lock.notify_all()
+
+    __del__ = close
+
+
+class _Response(object):
+    """The response to a command, from an agent that runs one command at a time."""
+
+    def __init__(self, stdout):
+        self._stdout = stdout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def readline(self):
+        return self._stdout.readline()
+
+    def read(self, size):
+        return self._stdout.read(size)
+
+    def close(self):
+        pass
+
+
+class _MultiplexedResponse(_Response):
+    """The response to a command, read as it's delivered by the :class:`_Demultiplexer`.
+
+    Threads waiting for more of the response release the session lock in the
+    meantime.  Once the response is closed, whatever is left of it is
+    discarded.
+
+    With flow control, the agent sends at most `window` bytes that haven't been
+    read yet, and the response sends it credit as they're read.
+    """
+
+    def __init__(self, lock, demultiplexer=None, id=None, window=None):
+        self._lock = lock
+        self._demultiplexer = demultiplexer
+        self._id = id
+        self._window = window
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._unacknowledged = 0
+        self._done = False
+        self._closed = False
+
+    def _consume(self, size):
+        # Must be called with the lock held.  Credit is sent once half the window has been read.
+        self._buffered -= size
+        if self._window is not None and not self._done:
+            self._unacknowledged += size
+            if self._unacknowledged >= self._window // 2:
+                self._demultiplexer.credit(self._id, self._unacknowledged)
+                self._unacknowledged = 0
+
+    def _wait(self):
+        # Must be called with the lock held.  Returns False at the end of the response.
+        while not self._chunks and not self._done:
+            self._lock.wait()
+        return len(self._chunks) > 0
+
+    def readline(self):
+        parts = []
+        with self._lock:
+            while self._wait():
+                chunk = self._chunks.popleft()
+                end = chunk.find("\n") + 1
+                if end:
+                    if end < len(chunk):
+                        self._chunks.appendleft(chunk[end:])
+                    chunk = chunk[:end]
+                self._consume(len(chunk))
+                parts.append(chunk)
+                if end:
+                    break
+            self._lock.notify_all()
+        return "".join(parts)
+
+    def read(self, size):
+        parts = []
+        with self._lock:
+            while size > 0 and self._wait():
+                chunk = self._chunks.popleft()
+                if len(chunk) > size:
+                    self._chunks.appendleft(chunk[size:])
+                    chunk = chunk[:size]
+                self._consume(len(chunk))
+                size -= len(chunk)
+                parts.append(chunk)
+            self._lock.notify_all()
+        return "".join(parts)
+
+    def close(self):
+        with self._lock:
+            if self._window is not None and not self._done and not self._closed:
+                # Nobody will read the rest, so let the agent finish sending it.
+                self._demultiplexer.credit(self._id, None)
+            self._closed = True
+            self._chunks.clear()
+            self._buffered = 0
+            self._lock.notify_all()
+
+
+class _Demultiplexer(object):
+    """Sends commands with request ids to an agent that runs them concurrently, routing its responses back to their callers.
+
+    The agent sends each response in one or more envelopes tagged with the
+    request id, in whatever order the commands finish.  A background thread
+    reads the envelopes and queues their content on the matching
+    :class:`_MultiplexedResponse`.
+
+    To bound memory, each response queues at most :attr:`buffer_size` bytes.
+    With flow control, each command is sent with that much credit, and the
+    agent's worker waits for more, so a slow reader only holds up its own
+    response.  Agents without flow control can't be paused per command, so
+    the thread waits instead, which holds up the other responses until the
+    caller catches up.
+    """
+    buffer_size = 16 * 1024 * 1024
+
+    def __init__(self, lock, stdin, stdout, flow_control=False):
+        self._lock = lock
+        self._stdin = stdin
+        self._stdout = stdout
+        self._flow_control = flow_control
+        self._ids = itertools.count()
+        self._responses = {}
+        self._closed = False
+        thread = threading.Thread(name="Remote agent demultiplexer", target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, command):
+        """Send a command, returning its :class:`_MultiplexedResponse`."""
+        with self._lock:
+            id = next(self._ids)
+            if self._flow_control:
+                response = _MultiplexedResponse(self._lock, self, id, self.buffer_size)
+                command = dict(command, window=self.buffer_size)
+            else:
+                response = _MultiplexedResponse(self._lock)
+            if self._closed:
+                response._done = True
+                return response
+            self._responses[id] = response
+            try:
+                self._stdin.write("%s\n" % json.dumps(dict(command, id=id)))
+                self._stdin.flush()
+            except:
+                del self._responses[id]
+                raise
+            return response
+
+    def credit(self, id, size):
+        """Let the agent send size more bytes of a response, or the rest of it if size is None.
+
+        The caller must hold the lock.
+        """
+        try:
+            self._stdin.write("%s\n" % json.dumps({"action": "credit", "id": id, "size": size}))
+            self._stdin.flush()
+        except Exception as e:
+            # The agent went away, and the reader thread will end its responses.
+            cherrypy.log.error("Sending credit to remote agent failed: %s %s" % (type(e), str(e)))
+
+    def _run(self):
+        try:
+            while True:
+                line = self._stdout.readline()
+                if not line:
+                    break
+                envelope = json.loads(line)
+                content = self._stdout.read(envelope["size"])
+                with self._lock:
+                    response = self._responses.get(envelope["id"])
+                    while not self._flow_control and response is not None and response._buffered >= self.buffer_size and not response._closed:
+                        self._lock.wait()
+                    if response is not None:
+                        if content and not response._closed:
+                            response._chunks.append(content)
+                            response._buffered += len(content)
+                        if envelope.get("done", False):
+                            response._done = True
+                            del self._responses[envelope["id"]]
+                    self._lock.notify_all()
+        except Exception as e:
+            cherrypy.log.error("Remote agent demultiplexer failed: %s %s" % (type(e), str(e)))
+        finally:
+            # The agent went away, so end the responses still being waited for.
+            with self._lock:
+                self._closed = True
+                for response in self._responses.values():
+                    response._done = True
+                self._responses.clear()
+                self._lock.notify_all()
 
 
 def create_session(hostname, username, password, agent):
@@ -961,8 +1355,9 @@ def create_session(hostname, username, password, agent):
     _start_session_cleanup_worker()
     client = cherrypy.request.headers.get("x-forwarded-for")
     sid = uuid.uuid4().hex
+    ssh = None
     try:
-        ssh = slycat.web.server.ssh_connect(hostname=hostname, username=username, password=password)
+        ssh = slycat.web.server.ssh_pool.pool.acquire(hostname, username, password)
         # Detect problematic startup scripts.
         stdin, stdout, stderr = ssh.exec_command("/bin/true")
         if stdout.read():
@@ -1022,7 +1417,9 @@ def create_session(hostname, username, password, agent):
                 raise cherrypy.HTTPError("500 Agent startup failed: %s" % startup["message"])
             agent = (stdin, stdout, stderr)
             with session_cache_lock:
-                session_cache[sid] = Session(client, username, hostname, ssh, sftp, agent)
+                session_cache[sid] = Session(client, username, hostname, ssh, sftp, agent,
+                                             multiplexed=startup.get("multiplexed", False),
+                                             flow_control=startup.get("flow-control", False))
         else:
             with session_cache_lock:
                 session_cache[sid] = Session(client, username, hostname, ssh, sftp)
@@ -1044,6 +1441,10 @@ def create_session(hostname, username, password, agent):
                                 "cherrypy.HTTPError 500 unknown exception for %s@%s: %s %s." % (
                                     username, hostname, type(e), str(e)))
         raise cherrypy.HTTPError("500 Remote connection failed: %s" % str(e))
+    finally:
+        # Return the connection to the pool if the session wasn't created.
+        if ssh is not None and sid not in session_cache:
+            ssh.close()
 
 
 def get_session(sid):
@@ -1163,6 +1564,7 @@ def _session_monitor():
             for sid in list(
                     session_cache.keys()):  # We make an explicit copy of the keys because we may be modifying the dict contents
                 _expire_session(sid)
+        slycat.web.server.ssh_pool.pool.reap()
         cherrypy.log.error("Remote session cleanup worker finished.")
         time.sleep(datetime.timedelta(minutes=15).total_seconds())
 
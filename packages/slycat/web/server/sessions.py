@@ -0,0 +1,183 @@
+# Copyright 2013, Sandia Corporation. Under the terms of Contract
+# DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
+# rights in this software.
+
+"""Process-local table of login sessions.
+
+CouchDB is the durable store for login sessions, but every authenticated
+request needs its session, so sessions are kept in memory and CouchDB is only
+consulted when a session isn't in the table (after a restart, for example).
+The time each session was last active is updated in memory, and written back
+to CouchDB in bulk by :meth:`SessionTable.flush`.  Expired sessions are found
+with a heap ordered by expiration time, instead of scanning every session
+document.
+"""
+
+import cherrypy
+import copy
+import datetime
+import heapq
+import threading
+import couchdb.http
+import slycat.web.server.database.couchdb
+
+def _created(session):
+  try:
+    return datetime.datetime.strptime(session["created"], "%Y-%m-%dT%H:%M:%S.%f")
+  except ValueError:
+    return datetime.datetime.strptime(session["created"], "%Y-%m-%dT%H:%M:%S")
+
+class SessionTable(object):
+  """Thread-safe table of login session documents.
+
+  Parameters
+  ----------
+  timeout : :class:`datetime.timedelta`, optional.
+    Session lifetime, measured from creation.  Defaults to the
+    "session-timeout" configuration value.
+  """
+  def __init__(self, timeout=None):
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    self._sessions = {}
+    self._expirations = []
+    self._active = {}
+    self._deletions = 0
+    self._loaded = False
+
+  @property
+  def timeout(self):
+    if self._timeout is None:
+      self._timeout = cherrypy.tree.apps[""].config["slycat"]["session-timeout"]
+    return self._timeout
+
+  def expiration(self, session):
+    """Return the time (UTC) when a session expires."""
+    return _created(session) + self.timeout
+
+  def get(self, sid):
+    """Return a copy of a session document, loading it from CouchDB if it isn't in the table.
+
+    Raises :class:`cherrypy.HTTPError` 404 if the session doesn't exist.
+    Expired sessions are returned until they're deleted, so callers must check
+    :meth:`expiration` themselves.
+    """
+    with self._lock:
+      session = self._sessions.get(sid)
+      deletions = self._deletions
+    if session is None:
+      session = slycat.web.server.database.couchdb.connect().get("session", sid)
+      with self._lock:
+        # Don't resurrect a session that was deleted while it was being loaded.
+        if deletions == self._deletions:
+          self._remember(session)
+    return copy.deepcopy(session)
+
+  def save(self, session):
+    """Save a new or modified session document to CouchDB, and to the table."""
+    session = copy.deepcopy(session)
+    with self._lock:
+      current = self._sessions.get(session["_id"])
+      if current is not None:
+        # Pick up revisions written by flush(), and any activity not yet written.
+        session["_rev"] = current["_rev"]
+        if session["_id"] in self._active:
+          session["last-active"] = self._active.pop(session["_id"])
+    slycat.web.server.database.couchdb.connect().save(session)
+    with self._lock:
+      self._remember(session)
+
+  def touch(self, sid):
+    """Record activity for a session, to be written to CouchDB by the next :meth:`flush`."""
+    with self._lock:
+      if sid in self._sessions:
+        self._active[sid] = datetime.datetime.utcnow().isoformat()
+
+  def delete(self, sid):
+    """Delete a session from the table and from CouchDB."""
+    with self._lock:
+      session = self._sessions.pop(sid, None)
+      self._active.pop(sid, None)
+      self._deletions += 1
+    database = slycat.web.server.database.couchdb.connect()
+    try:
+      if session is None:
+        session = database.get("session", sid)
+      database.delete(session)
+    except couchdb.http.ResourceConflict:
+      database.delete(database.get("session", sid))
+    except (couchdb.http.ResourceNotFound, cherrypy.HTTPError):
+      pass
+
+  def flush(self, database):
+    """Write the activity recorded since the last flush to CouchDB in bulk, returning the number of sessions written."""
+    with self._lock:
+      active, self._active = self._active, {}
+      documents = []
+      for sid, last_active in active.items():
+        if sid in self._sessions:
+          document = copy.deepcopy(self._sessions[sid])
+          document["last-active"] = last_active
+          documents.append(document)
+    if not documents:
+      return 0
+
+    written = 0
+    results = database.update(documents)
+    with self._lock:
+      for document, (success, sid, result) in zip(documents, results):
+        if success:
+          if sid in self._sessions:
+            document["_rev"] = result
+            self._sessions[sid] = document
+          written += 1
+        else:
+          # The document was modified elsewhere, so reload it on next use.
+          cherrypy.log.error("Couldn't record activity for session %s: %s" % (sid, result))
+          self._sessions.pop(sid, None)
+    return written
+
+  def expire(self, database):
+    """Delete every expired session, returning the number deleted.
+
+    The first call loads every session document, so sessions created before
+    the server started will expire, too.
+    """
+    if not self._loaded:
+      sessions = list(database.scan("slycat/sessions"))
+      with self._lock:
+        for session in sessions:
+          if session["_id"] not in self._sessions:
+            self._remember(session)
+        self._loaded = True
+
+    now = datetime.datetime.utcnow()
+    expired = {}
+    missing = set()
+    with self._lock:
+      while self._expirations and self._expirations[0][0] <= now:
+        expiration, sid = heapq.heappop(self._expirations)
+        session = self._sessions.get(sid)
+        if session is None:
+          # The document was dropped from the table, so look up its revision below.
+          missing.add(sid)
+        elif self.expiration(session) <= now:
+          del self._sessions[sid]
+          self._active.pop(sid, None)
+          self._deletions += 1
+          expired[sid] = session
+
+    missing -= set(expired)
+    if missing:
+      for row in database.view("_all_docs", keys=sorted(missing)):
+        if row.value is not None and not row.value.get("deleted"):
+          expired[row.id] = {"_id": row.id, "_rev": row.value["rev"]}
+    return len(database.delete_all(expired.values())) if expired else 0
+
+  def _remember(self, session):
+    # Must be called with the lock held.
+    if session["_id"] not in self._sessions:
+      heapq.heappush(self._expirations, (self.expiration(session), session["_id"]))
+    self._sessions[session["_id"]] = session
+
+table = SessionTable()
@@ -0,0 +1,286 @@
+# Copyright 2013, Sandia Corporation. Under the terms of Contract
+# DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
+# rights in this software.
+
+"""Persistent store for table sort indexes.
+
+A sort index is the permutation that orders the rows of a 1D array by one or
+more (column, order) keys.  Indexes are kept in a size-bounded,
+least-recently-used :class:`slycat.web.server.cache.Cache`, separate from the
+model's HDF5 files, and are keyed by the array's data version so they never
+outlive the data they were computed from.
+"""
+
+import cherrypy
+import numpy
+import os
+import slycat.web.server.cache
+import slycat.web.server.hdf5
+import threading
+import time
+
+maximum_columns = 4
+"""Maximum number of columns in a single sort."""
+
+_packed_key_limit = 2 ** 63
+
+def compute(array, sort):
+  """Return the indices that would sort the rows of a 1D darray.
+
+  Parameters
+  ----------
+  array : darray, required.
+    The array to be sorted.  Column indices past the last attribute refer to
+    the (virtual) row index column.
+  sort : list of (column, order) tuples, required.
+    Sort keys, most significant first.  Order must be "ascending" or
+    "descending".
+
+  A single ascending key is sorted stably.  A single descending key is the
+  reverse of the ascending sort, so ties are reversed too.  With multiple
+  keys, rows that tie on every key keep their original order.
+  """
+  def values(column):
+    if column >= len(array.attributes):
+      return numpy.arange(array.shape[0])
+    return array.get_data(column)[...]
+
+  if len(sort) == 1:
+    column, order = sort[0]
+    sort_index = numpy.argsort(values(column), kind="mergesort")
+    if order == "descending":
+      sort_index = sort_index[::-1].copy()
+    return sort_index
+
+  # Replace each column with dense integer ranks, then pack the ranks and the
+  # row number into a single int64 key.  Keys are unique, so a fast (unstable)
+  # sort orders every column at once, with ties in their original order.  Fall
+  # back to numpy.lexsort() (which is much slower) if the key won't fit.
+  ranks = []
+  for column, order in sort:
+    column_ranks, count = _ranks(values(column))
+    if order == "descending":
+      column_ranks = count - 1 - column_ranks
+    ranks.append((column_ranks, count))
+
+  row_count = array.shape[0]
+  if numpy.prod([float(count) for column_ranks, count in ranks]) * row_count < _packed_key_limit:
+    key = numpy.zeros(row_count, dtype="int64")
+    for column_ranks, count in ranks:
+      key *= count
+      key += column_ranks
+    key *= row_count
+    key += numpy.arange(row_count)
+    return numpy.argsort(key, kind="quicksort")
+
+  # numpy.lexsort() treats its last key as the most significant.
+  return numpy.lexsort([column_ranks for column_ranks, count in reversed(ranks)])
+
+def _ranks(values):
+  """Return dense integer ranks for a column of values with NaNs ranked (equally) last, and the number of distinct ranks."""
+  if values.dtype.kind == "f":
+    nans = numpy.isnan(values)
+    if nans.any():
+      unique, ranks = numpy.unique(values[~nans], return_inverse=True)
+      result = numpy.full(len(values), len(unique), dtype="int64")
+      result[~nans] = ranks
+      return result, len(unique) + 1
+  if values.dtype.kind in "iu" and len(values):
+    # Small integer ranges don't need to be sorted to be ranked.
+    minimum, maximum = int(values.min()), int(values.max())
+    if maximum - minimum < len(values):
+      return values.astype("int64") - minimum, maximum - minimum + 1
+  unique, ranks = numpy.unique(values, return_inverse=True)
+  return ranks.astype("int64"), max(len(unique), 1)
+
+class IndexStore(object):
+  """Size-bounded, persistent store of table sort indexes.
+
+  Indexes are computed on demand.  After an array has been written, the
+  indexes that were requested recently are rebuilt ahead of time by a background
+  thread (see :meth:`schedule`), so clients sorting the same way don't wait.
+  """
+  def __init__(self, path=None, memory_limit=None, disk_limit=None, delay=None, rebuild_window=None):
+    self._path = path
+    self._memory_limit = memory_limit
+    self._disk_limit = disk_limit
+    self._delay = delay
+    self._rebuild_window = rebuild_window
+    self._cache = None
+    self._lock = threading.Lock()
+    self._pending = {}
+    self._requested = {}
+    self._wakeup = threading.Condition(self._lock)
+    self._thread = None
+
+  @property
+  def cache(self):
+    """Return the underlying :class:`slycat.web.server.cache.Cache`, creating it on first use."""
+    with self._lock:
+      if self._cache is None:
+        configuration = lambda key, default: cherrypy.tree.apps[""].config["slycat-web-server"].get(key, default)
+        path = self._path
+        if path is None:
+          path = configuration("index-store", None) or os.path.join(configuration("data-store", None), "index")
+        memory_limit = self._memory_limit
+        if memory_limit is None:
+          memory_limit = configuration("index-store-memory-limit", 512 * 1024 * 1024)
+        disk_limit = self._disk_limit
+        if disk_limit is None:
+          disk_limit = configuration("index-store-disk-limit", 8 * 1024 * 1024 * 1024)
+        cherrypy.log.error("[INDEX] %s is the index store location" % path)
+        self._cache = slycat.web.server.cache.Cache(path, memory_limit=memory_limit, disk_limit=disk_limit)
+      return self._cache
+
+  @property
+  def delay(self):
+    """Seconds to wait after the last write to an array before building its indexes."""
+    if self._delay is None:
+      self._delay = cherrypy.tree.apps[""].config["slycat-web-server"].get("index-store-delay", 5.0)
+    return self._delay
+
+  @property
+  def rebuild_window(self):
+    """Seconds after an index was last requested during which it's rebuilt when its array is written."""
+    if self._rebuild_window is None:
+      self._rebuild_window = cherrypy.tree.apps[""].config["slycat-web-server"].get("index-store-rebuild-window", 24 * 60 * 60)
+    return self._rebuild_window
+
+  def get(self, artifact, array, array_index, sort):
+    """Return the sort index for an array, computing and storing it if necessary.
+
+    Parameters
+    ----------
+    artifact : string, required.
+      Arrayset artifact id.
+    array : darray, required.
+      The array to be sorted, from the artifact.
+    array_index : integer, required.
+      Index of the array within the arrayset.
+    sort : list of (column, order) tuples, required.
+      Sort keys, see :func:`compute`.
+    """
+    sort, descending = self._normalize(sort)
+    self._record(artifact, array_index, sort)
+    sort_index = self._permutations(artifact, array, array_index, sort)[0]
+    return sort_index[::-1] if descending else sort_index
+
+  def rows(self, artifact, array, array_index, sort, positions):
+    """Return the rows at the given positions in sorted order.
+
+    Only the requested positions are looked up, using the stored sort index.
+    Other parameters are the same as :meth:`get`.
+    """
+    sort, descending = self._normalize(sort)
+    self._record(artifact, array_index, sort)
+    sort_index = self._permutations(artifact, array, array_index, sort)[0]
+    positions = numpy.asarray(positions, dtype="int64")
+    if descending:
+      positions = len(sort_index) - 1 - positions
+    return sort_index.take(positions)
+
+  def positions(self, artifact, array, array_index, sort, rows):
+    """Return the positions of the given rows in sorted order.
+
+    Only the requested rows are looked up, using the inverse of the sort index,
+    which is computed and stored along with it.  Other parameters are the same
+    as :meth:`get`.
+    """
+    sort, descending = self._normalize(sort)
+    self._record(artifact, array_index, sort)
+    inverse = self._permutations(artifact, array, array_index, sort)[1]
+    positions = inverse.take(numpy.asarray(rows, dtype="int64"))
+    if descending:
+      positions = len(inverse) - 1 - positions
+    return positions
+
+  def _normalize(self, sort):
+    # Single descending sorts are derived from the ascending index, so only one is stored.
+    sort = tuple((int(column), order) for column, order in sort)
+    if len(sort) == 1 and sort[0][1] == "descending":
+      return ((sort[0][0], "ascending"),), True
+    return sort, False
+
+  def _record(self, artifact, array_index, sort):
+    """Remember when a client last asked for an index, so it can be rebuilt after writes."""
+    with self._lock:
+      self._requested.setdefault(artifact, {})[(array_index, sort)] = time.time()
+
+  def _recent(self, artifact):
+    """Return the indexes requested for an arrayset within the rebuild window, forgetting older ones."""
+    oldest = time.time() - self.rebuild_window
+    with self._lock:
+      requested = self._requested.get(artifact, {})
+      for key, requested_time in requested.items():
+        if requested_time < oldest:
+          del requested[key]
+      if not requested:
+        self._requested.pop(artifact, None)
+      return sorted(requested.keys())
+
+  def _permutations(self, artifact, array, array_index, sort):
+    """Return the stored sort index and its inverse, computing and storing them if necessary."""
+    key = ("sort-index", artifact, array_index, array.version, sort)
+    try:
+      return self.cache[key]
+    except KeyError:
+      pass
+
+    # The inverse maps rows to sorted positions, and costs one pass over the sort index.
+    start = time.time()
+    sort_index = compute(array, sort)
+    inverse = numpy.empty_like(sort_index)
+    inverse[sort_index] = numpy.arange(len(sort_index), dtype=sort_index.dtype)
+    cherrypy.log.error("[INDEX] computed %s/%s %s in %.3f s" % (artifact, array_index, list(sort), time.time() - start))
+    self.cache[key] = (sort_index, inverse)
+    return sort_index, inverse
+
+  def build(self, artifact):
+    """Rebuild the indexes recently requested for an arrayset.
+
+    Indexes that nobody has asked for aren't built, since a wide table would
+    otherwise fill the store with indexes for columns that are never sorted.
+    """
+    requested = self._recent(artifact)
+    if not requested:
+      return
+    with slycat.web.server.hdf5.pool.arrayset(artifact) as arrayset:
+      arrays = set(arrayset.keys())
+      for array_index, sort in requested:
+        if array_index not in arrays:
+          continue
+        try:
+          self._permutations(artifact, arrayset[array_index], array_index, sort)
+        except Exception as e:
+          cherrypy.log.error("[INDEX] rebuilding %s/%s %s failed: %s" % (artifact, array_index, list(sort), e))
+
+  def schedule(self, artifact):
+    """Rebuild the indexes recently requested for an arrayset in the background, once writes to it have settled."""
+    with self._lock:
+      if artifact not in self._requested:
+        return
+      self._pending[artifact] = time.time() + self.delay
+      if self._thread is None:
+        self._thread = threading.Thread(name="sort index builder", target=self._build_pending)
+        self._thread.daemon = True
+        self._thread.start()
+      self._wakeup.notify()
+
+  def _build_pending(self):
+    while True:
+      with self._lock:
+        while not self._pending:
+          self._wakeup.wait()
+        artifact, deadline = min(self._pending.items(), key=lambda item: item[1])
+        now = time.time()
+        if deadline > now:
+          self._wakeup.wait(deadline - now)
+          continue
+        del self._pending[artifact]
+      try:
+        if os.path.exists(slycat.web.server.hdf5.path(artifact)):
+          self.build(artifact)
+      except Exception as e:
+        cherrypy.log.error("[INDEX] building sort indexes for %s failed: %s" % (artifact, e))
+
+store = IndexStore()
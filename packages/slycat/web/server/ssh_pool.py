@@ -0,0 +1,245 @@
+# Copyright 2013, Sandia Corporation. Under the terms of Contract
+# DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
+# rights in this software.
+
+"""Pooled ssh connections for remote sessions.
+
+Opening an ssh connection means a key exchange and authentication, and in
+certificate mode, generating an RSA key and having it signed, so remote
+sessions share authenticated connections instead.  A :class:`Pool` keeps the
+connections for each host, user, and set of credentials, and every session
+opens its own channels (for the agent, sftp, and commands) on one of them.
+Connections are checked before they are reused, and closed once they have
+been idle for a while.
+"""
+
+import base64
+import cherrypy
+import datetime
+import hashlib
+import os
+import paramiko
+import threading
+import time
+
+class Connection(object):
+  """An authenticated ssh connection, shared by one or more remote sessions.
+
+  Provides the parts of :class:`paramiko.SSHClient` used by sessions, but
+  :meth:`close` returns the connection to its pool instead of closing it.
+  """
+  def __init__(self, pool, key, client):
+    self._pool = pool
+    self._key = key
+    self._client = client
+    self._users = 0
+    self._released = time.time()
+
+  def get_transport(self):
+    return self._client.get_transport()
+
+  def exec_command(self, command):
+    """Execute a command on a new channel, returning its stdin, stdout, and stderr."""
+    channel = self.get_transport().open_session()
+    channel.exec_command(command)
+    return channel.makefile("wb"), channel.makefile("r"), channel.makefile_stderr("r")
+
+  def open_sftp(self):
+    return paramiko.SFTPClient.from_transport(self.get_transport())
+
+  def healthy(self):
+    """Return True if the connection is still open and authenticated."""
+    transport = self.get_transport()
+    if transport is None or not transport.is_active() or not transport.is_authenticated():
+      return False
+    try:
+      transport.send_ignore()
+    except Exception:
+      return False
+    return True
+
+  def close(self):
+    """Release the connection, so it can be reused by other sessions."""
+    self._pool._release(self)
+
+class Pool(object):
+  """Thread-safe pool of ssh connections.
+
+  Parameters
+  ----------
+  connect : callable, optional.
+    Called with hostname, username, and password to open a new
+    :class:`paramiko.SSHClient`.  Defaults to :func:`slycat.web.server.ssh_connect`.
+  sessions : integer, optional.
+    Maximum number of sessions sharing a connection, defaults to the
+    "remote-connection-sessions" configuration value, or 4.  Each session uses
+    up to three channels, and servers limit the channels per connection (ten,
+    for OpenSSH).
+  timeout : :class:`datetime.timedelta`, optional.
+    How long unused connections are kept open, defaults to the
+    "remote-connection-timeout" configuration value, or five minutes.
+  """
+  def __init__(self, connect=None, sessions=None, timeout=None):
+    self._connect = connect
+    self._sessions = sessions
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    self._connections = {}
+    # Credentials are only kept as salted digests.
+    self._salt = os.urandom(16)
+
+  @property
+  def sessions(self):
+    if self._sessions is None:
+      self._sessions = cherrypy.tree.apps[""].config["slycat-web-server"].get("remote-connection-sessions", 4)
+    return self._sessions
+
+  @property
+  def timeout(self):
+    if self._timeout is None:
+      self._timeout = cherrypy.tree.apps[""].config["slycat-web-server"].get("remote-connection-timeout", datetime.timedelta(minutes=5))
+    return self._timeout
+
+  def acquire(self, hostname, username, password):
+    """Return a connection to a host, reusing an open connection if possible.
+
+    Connections are only shared by sessions with the same credentials, created
+    by the same Slycat user.  The caller must :meth:`Connection.close` the
+    connection when it's done with it.
+    """
+    self.reap()
+    digest = hashlib.sha256(self._salt + (password or u"").encode("utf-8")).hexdigest()
+    key = (hostname, username, digest, getattr(cherrypy.request, "login", None))
+    with self._lock:
+      candidates = [connection for connection in self._connections.get(key, []) if connection._users < self.sessions]
+    for connection in candidates:
+      if not connection.healthy():
+        self._discard(connection)
+        continue
+      with self._lock:
+        if connection._users < self.sessions and connection in self._connections.get(key, []):
+          connection._users += 1
+          return connection
+
+    connect = self._connect
+    if connect is None:
+      import slycat.web.server
+      connect = slycat.web.server.ssh_connect
+    connection = Connection(self, key, connect(hostname=hostname, username=username, password=password))
+    connection._users = 1
+    with self._lock:
+      self._connections.setdefault(key, []).append(connection)
+    return connection
+
+  def reap(self):
+    """Close connections that have been unused for longer than the timeout, or are no longer healthy, returning the number closed."""
+    deadline = time.time() - self.timeout.total_seconds()
+    with self._lock:
+      idle = [connection for connections in self._connections.values() for connection in connections if connection._users == 0]
+    closed = 0
+    for connection in idle:
+      if connection._released < deadline or not connection.healthy():
+        with self._lock:
+          if connection._users:
+            continue
+          self._remove(connection)
+        connection._client.close()
+        closed += 1
+    return closed
+
+  def _release(self, connection):
+    with self._lock:
+      connection._users = max(0, connection._users - 1)
+      connection._released = time.time()
+      if connection._users or connection in self._connections.get(connection._key, []):
+        return
+    # The connection was discarded while it was in use.
+    connection._client.close()
+
+  def _discard(self, connection):
+    with self._lock:
+      self._remove(connection)
+      if connection._users:
+        return
+    connection._client.close()
+
+  def _remove(self, connection):
+    # Must be called with the lock held.
+    connections = self._connections.get(connection._key, [])
+    if connection in connections:
+      connections.remove(connection)
+    if not connections:
+      self._connections.pop(connection._key, None)
+
+pool = Pool()
+
+class CertificateCache(object):
+  """Keeps the key pair and certificate used to connect in certificate mode, until the certificate expires.
+
+  Parameters
+  ----------
+  margin : :class:`datetime.timedelta`, optional.
+    Certificates are replaced this long before they expire.
+  """
+  def __init__(self, margin=datetime.timedelta(minutes=1)):
+    self._margin = margin
+    self._lock = threading.Lock()
+    self._certificates = {}
+
+  def get(self, login, sign, bits=2056):
+    """Return a private key and its certificate for a user, generating and signing new ones if needed.
+
+    Parameters
+    ----------
+    login : string, required.
+      Slycat user the certificate is issued to.
+    sign : callable, required.
+      Called with the public key, in OpenSSH format, to return the certificate.
+    bits : integer, optional.
+      Size of generated keys.
+
+    Returns
+    -------
+    key : :class:`paramiko.RSAKey`
+    certificate : string
+    """
+    now = time.time()
+    with self._lock:
+      cached = self._certificates.get(login)
+    if cached is not None and cached[2] - self._margin.total_seconds() > now:
+      return cached[0], cached[1]
+
+    key = paramiko.RSAKey.generate(bits)
+    certificate = sign("ssh-rsa " + key.get_base64())
+    expiration = certificate_expiration(certificate)
+    with self._lock:
+      if expiration is not None:
+        self._certificates[login] = (key, certificate, expiration)
+      else:
+        self._certificates.pop(login, None)
+    return key, certificate
+
+  def discard(self, login):
+    """Forget the certificate for a user, after it was rejected."""
+    with self._lock:
+      self._certificates.pop(login, None)
+
+certificates = CertificateCache()
+
+def certificate_expiration(certificate):
+  """Return the time (seconds since the epoch) an OpenSSH RSA certificate expires, or None if it can't be parsed."""
+  try:
+    message = paramiko.Message(base64.b64decode(certificate.split()[1]))
+    if message.get_text() != "ssh-rsa-cert-v01@openssh.com":
+      return None
+    message.get_string() # nonce
+    message.get_mpint() # e
+    message.get_mpint() # n
+    message.get_int64() # serial
+    message.get_int() # type
+    message.get_string() # key id
+    message.get_string() # valid principals
+    message.get_int64() # valid after
+    return message.get_int64()
+  except Exception:
+    return None
@@ -2,15 +2,237 @@
 # DE-AC04-94AL85000 with Sandia Corporation, the U.S. Government retains certain
 # rights in this software.
 
+"""Serve remote content, honoring HTTP Range requests.
+
+Clients such as video players seek by requesting byte ranges, so content that
+can be read at an offset (from an sftp file handle, or with ranged agent
+commands) is served with :func:`serve_ranges`, which only reads the requested
+ranges, a block at a time as the response is sent.  Recently read regions
+are kept in a bounded :class:`BlockCache`, so repeated and overlapping
+requests don't go back to the remote host.
+"""
+
 import cherrypy
+import collections
+import threading
+import uuid
+import slycat.email
 
-def serve(stream, size, content_type):
+maximum_ranges = 16
+"""Requests with more ranges than this are served in full."""
+
+class BlockCache(object):
+  """Thread-safe, bounded cache of fixed-size blocks read from remote files.
+
+  Parameters
+  ----------
+  block_size : integer, optional.
+    Size of the blocks read and cached, in bytes.
+  capacity : integer, optional.
+    Maximum number of cached blocks.  The least recently used blocks are evicted.
+  """
+  def __init__(self, block_size=1024 * 1024, capacity=64):
+    self.block_size = block_size
+    self.capacity = capacity
+    self._lock = threading.Lock()
+    self._blocks = collections.OrderedDict()
+
+  def read(self, key, size, read, offset, length):
+    """Read part of a file through the cache.
+
+    Parameters
+    ----------
+    key : hashable, required.
+      Identifies the file and its version, and who may read it.
+    size : integer, required.
+      Size of the file in bytes.
+    read : callable, required.
+      Called with an offset and length to read part of the file.  Missing
+      blocks are read in as few calls as possible.
+    offset, length : integers, required.
+      Region to be read.
+
+    Returns
+    -------
+    content : string
+    """
+    length = max(0, min(length, size - offset))
+    if length == 0:
+      return ""
+    first = offset // self.block_size
+    last = (offset + length - 1) // self.block_size
+    # Reads too large to cache would only evict everything else.
+    if last - first + 1 > self.capacity:
+      return read(offset, length)
+
+    first = offset // self.block_size
+    last = (offset + length - 1) // self.block_size
+
+    blocks = {}
+    missing = []
+    with self._lock:
+      for index in range(first, last + 1):
+        block = self._blocks.pop((key, index), None)
+        if block is None:
+          missing.append(index)
+        else:
+          self._blocks[(key, index)] = block
+          blocks[index] = block
+
+    # Read each run of consecutive missing blocks at once.
+    runs = []
+    for index in missing:
+      if runs and runs[-1][1] == index:
+        runs[-1][1] = index + 1
+      else:
+        runs.append([index, index + 1])
+    for begin, end in runs:
+      start = begin * self.block_size
+      content = read(start, min(size, end * self.block_size) - start)
+      for index in range(begin, end):
+        blocks[index] = content[(index - begin) * self.block_size:(index - begin + 1) * self.block_size]
+
+    if missing:
+      with self._lock:
+        for index in missing:
+          self._blocks[(key, index)] = blocks[index]
+        while len(self._blocks) > self.capacity:
+          self._blocks.popitem(last=False)
+
+    content = "".join([blocks[index] for index in range(first, last + 1)])
+    begin = offset - first * self.block_size
+    return content[begin:begin + length]
+
+  def reader(self, key, size, read):
+    """Return a function that reads an offset and length of a file through the cache."""
+    return lambda offset, length: self.read(key, size, read, offset, length)
+
+cache = BlockCache()
+
+def parse_ranges(header, size):
+  """Parse an HTTP Range header.
+
+  Parameters
+  ----------
+  header : string, required.
+    Value of the Range header.
+  size : integer, required.
+    Size of the content in bytes.
+
+  Returns
+  -------
+  ranges : list of (first, last) tuples, or None.
+    Inclusive byte positions of the satisfiable ranges, sorted, with
+    overlapping and adjacent ranges merged.  None if the header isn't a valid
+    byte range set, which means it should be ignored.  Raises
+    :class:`cherrypy.HTTPError` 416 if none of the ranges can be satisfied.
+  """
+  units, equals, specs = header.partition("=")
+  if units.strip().lower() != "bytes" or not equals:
+    return None
+
+  ranges = []
+  for spec in specs.split(","):
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+      return None
+    try:
+      if first == "":
+        suffix = int(last)
+        if suffix < 0:
+          return None
+        if suffix > 0 and size > 0:
+          ranges.append((max(0, size - suffix), size - 1))
+        continue
+      first = int(first)
+      last = int(last) if last != "" else max(first, size - 1)
+    except ValueError:
+      return None
+    if first < 0 or last < first:
+      return None
+    if first < size:
+      ranges.append((first, min(last, size - 1)))
+
+  if not ranges:
+    cherrypy.response.headers["content-range"] = "bytes */%s" % size
+    slycat.email.send_error("slycat.web.server.streaming.py parse_ranges", "cherrypy.HTTPError 416 unsatisfiable range %s for %s bytes." % (header, size))
+    raise cherrypy.HTTPError("416 Requested range not satisfiable.")
+  if len(ranges) > maximum_ranges:
+    return None
+
+  merged = []
+  for first, last in sorted(ranges):
+    if merged and first <= merged[-1][1] + 1:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+    else:
+      merged.append((first, last))
+  return merged
+
+def _blocks(read, offset, length, block_size):
+  """Read a region in blocks, yielding each as it's read."""
+  end = offset + length
+  while offset < end:
+    # Block-aligned reads are each served from a single cached block.
+    size = min(end, (offset // block_size + 1) * block_size) - offset
+    yield read(offset, size)
+    offset += size
+
+def serve_ranges(read, size, content_type, block_size=None):
+  """Serve content that can be read at an offset, honoring the request's Range header.
+
+  Parameters
+  ----------
+  read : callable, required.
+    Called with an offset and length to read part of the content.
+  size : integer, required.
+    Size of the content in bytes.
+  content_type : string, required.
+    MIME type of the content.
+  block_size : integer, optional.
+    Maximum number of bytes read at a time, defaults to the cache block size.
+
+  Returns
+  -------
+  content : iterable of strings
+    The whole content (200), a single range (206), or several ranges as
+    multipart/byteranges (206).  The content is read as the iterable is
+    consumed, a block at a time, so open-ended ranges over large files are
+    never held in memory.
+  """
+  block_size = cache.block_size if block_size is None else block_size
   cherrypy.response.headers["accept-ranges"] = "bytes"
-  cherrypy.response.headers["content-type"] = content_type
-  if "range" in cherrypy.request.headers:
-    cherrypy.response.headers["content-range"] = "bytes 0-%s/%s" % (size-1, size)
-    cherrypy.response.status = "206"
-  else:
+  ranges = parse_ranges(cherrypy.request.headers["range"], size) if "range" in cherrypy.request.headers else None
+
+  if ranges is None:
+    cherrypy.response.headers["content-type"] = content_type
+    cherrypy.response.headers["content-length"] = size
     cherrypy.response.status = "200"
+    return _blocks(read, 0, size, block_size)
+
+  cherrypy.response.status = "206"
+  if len(ranges) == 1:
+    first, last = ranges[0]
+    cherrypy.response.headers["content-type"] = content_type
+    cherrypy.response.headers["content-range"] = "bytes %s-%s/%s" % (first, last, size)
+    cherrypy.response.headers["content-length"] = last - first + 1
+    return _blocks(read, first, last - first + 1, block_size)
+
+  boundary = uuid.uuid4().hex
+  cherrypy.response.headers["content-type"] = "multipart/byteranges; boundary=%s" % boundary
+  def parts():
+    for first, last in ranges:
+      yield "--%s\r\ncontent-type: %s\r\ncontent-range: bytes %s-%s/%s\r\n\r\n" % (boundary, content_type, first, last, size)
+      for block in _blocks(read, first, last - first + 1, block_size):
+        yield block
+      yield "\r\n"
+    yield "--%s--\r\n" % boundary
+  return parts()
+
+def serve(stream, size, content_type):
+  """Serve content from a stream that can only be read sequentially, honoring the request's Range header.
+
+  The whole stream is always read, so whatever follows the content (the next
+  agent response, for example) is left in place.
+  """
   content = stream.read(size)
-  return content
+  return serve_ranges(lambda offset, length: content[offset:offset + length], size, content_type)
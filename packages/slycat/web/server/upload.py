@@ -61,6 +61,105 @@ def path(uid, fid=None, pid=None):
     result = os.path.join(result, "part-%s" % pid)
   return result
 
+class PartStream(object):
+  """Read-only file-like object that reads the parts of an uploaded file in order.
+
+  The parts are read directly from upload storage, one at a time, so parsers
+  can consume arbitrarily large uploads incrementally with :meth:`read` or
+  :meth:`readline`, or by iterating over lines.  Reading the whole stream
+  with :meth:`read` returns the entire file as a string.  Parsers that need
+  more than one pass can rewind the stream with :meth:`seek`.  The total
+  size of the file in bytes is available as :attr:`size`.
+
+  Parameters
+  ----------
+  paths : list of strings, required
+    Paths of the file parts, in order.
+  """
+  def __init__(self, paths):
+    self.size = sum([os.path.getsize(part) for part in paths])
+    self._parts = list(paths)
+    self._paths = list(paths)
+    self._file = None
+
+  def _current(self):
+    """Return the open part, or None once every part has been read."""
+    if self._file is None and self._paths:
+      self._file = open(self._paths.pop(0), "rb")
+    return self._file
+
+  def _next(self):
+    self._file.close()
+    self._file = None
+
+  def read(self, size=-1):
+    """Read at most size bytes, or the rest of the file if size is negative."""
+    if size < 0:
+      # Grow one string, which CPython resizes in place, instead of joining
+      # a list of parts, which would need twice the memory of the file.
+      result = ""
+      while self._current() is not None:
+        result += self._file.read()
+        self._next()
+      return result
+
+    chunks = []
+    remaining = size
+    while remaining and self._current() is not None:
+      chunk = self._file.read(remaining)
+      if not chunk:
+        self._next()
+        continue
+      chunks.append(chunk)
+      remaining -= len(chunk)
+    return "".join(chunks)
+
+  def readline(self, size=-1):
+    """Read one line, which may span parts, including its trailing newline."""
+    chunks = []
+    remaining = size
+    while remaining != 0 and self._current() is not None:
+      chunk = self._file.readline(remaining)
+      if not chunk:
+        self._next()
+        continue
+      chunks.append(chunk)
+      if chunk.endswith("\n"):
+        break
+      if remaining > 0:
+        remaining -= len(chunk)
+    return "".join(chunks)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration()
+    return line
+
+  def seek(self, offset, whence=0):
+    """Rewind to the start of the file, so it can be read again.  Other positions aren't supported."""
+    if offset != 0 or whence != 0:
+      raise IOError("Upload streams can only be rewound to the start.")
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    self._paths = list(self._parts)
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    self._paths = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
 class Session(object):
   """Encapsulates an upload session.
 
@@ -88,6 +187,7 @@ class Session(object):
     self._accessed = now
     self._received = set()
     self._parsing_thread = None
+    self._parsing_error = None
     self._lock = threading.Lock()
 
   def __enter__(self):
@@ -112,6 +212,11 @@ class Session(object):
     """Return the time the session was last accessed."""
     return self._accessed
 
+  @property
+  def parsing_error(self):
+    """Return the error that stopped parsing, or None if parsing hasn't failed."""
+    return self._parsing_error
+
   def put_upload_file_part(self, fid, pid, data):
     if self._parsing_thread is not None:
       raise cherrypy.HTTPError("409 Upload already finished.")
@@ -178,16 +283,12 @@ class Session(object):
         """Files and file parts must be loaded in numeric, not lexicographical, order."""
         return int(x.split("-")[-1])
 
+      # Parsers read each file straight from its parts, instead of from a copy assembled in memory.
       files = []
       storage = path(self._uid)
       for file_dir in sorted(glob.glob(os.path.join(storage, "file-*")), key=numeric_order):
-        cherrypy.log.error("Assembling %s" % file_dir)
-        file = ""
-        for file_part in sorted(glob.glob(os.path.join(file_dir, "part-*")), key=numeric_order):
-          cherrypy.log.error(" Loading %s" % file_part)
-          with open(file_part, "r") as f:
-            file += f.read()
-        files.append(file)
+        cherrypy.log.error("Streaming %s" % file_dir)
+        files.append(PartStream(sorted(glob.glob(os.path.join(file_dir, "part-*")), key=numeric_order)))
 
       try:
         slycat.web.server.plugin.manager.parsers[self._parser]["parse"](database, model, self._input, files, self._aids, **self._kwargs)
@@ -195,6 +296,10 @@ class Session(object):
         cherrypy.log.error("Exception parsing posted files: %s" % e)
         import traceback
         cherrypy.log.error(traceback.format_exc())
+        self._parsing_error = e
+      finally:
+        for file in files:
+          file.close()
 
       cherrypy.log.error("Upload parsing finished.")
 
@@ -281,6 +386,9 @@ def get_session(uid):
 def delete_session(uid):
   """Delete a cached upload session.
 
+  If parsing failed, the session is deleted, then a 400 exception is raised so
+  the client knows that its upload wasn't stored.
+
   Parameters
   ----------
   uid : string, required
@@ -292,6 +400,9 @@ def delete_session(uid):
       cherrypy.log.error("Deleting upload session for %s" % (session.client))
       session_cache[uid].close()
       del session_cache[uid]
+      if session.parsing_error is not None:
+        slycat.email.send_error("slycat.web.server.upload.py delete_session", "cherrypy.HTTPError 400 parsing failed: %s" % session.parsing_error)
+        raise cherrypy.HTTPError("400 Parsing failed: %s" % session.parsing_error)
 
 def _expire_session(uid):
   """Test an existing session to see if it is expired.
@@ -0,0 +1,64 @@
+import numpy
+import pytest
+import slycat.columnar
+
+def roundtrip(arrays, byteorder=None):
+  return slycat.columnar.decode("".join(slycat.columnar.encode(arrays, byteorder)))
+
+def test_numeric_arrays():
+  arrays = [numpy.array([1.5, numpy.nan, -2.0]), numpy.arange(6, dtype="int32").reshape(2, 3), numpy.array([True, False]), numpy.float32(7)]
+  for byteorder in ["little", "big"]:
+    result = roundtrip(arrays, byteorder)
+    assert len(result) == 4
+    for expected, actual in zip(arrays, result):
+      numpy.testing.assert_array_equal(actual, expected)
+      assert actual.shape == numpy.shape(expected)
+      assert actual.dtype.newbyteorder("=") == numpy.asarray(expected).dtype
+
+def test_buffers_are_aligned():
+  message = "".join(slycat.columnar.encode([numpy.arange(3, dtype="int8"), numpy.arange(3, dtype="float64")]))
+  result = slycat.columnar.decode(message)
+  assert len(message) % slycat.columnar.alignment == 0
+  assert result[1].ctypes.data % slycat.columnar.alignment == result[0].ctypes.data % slycat.columnar.alignment
+
+def test_string_arrays():
+  strings = numpy.array([u"alpha", u"", u"\u03b2eta", "gamma"], dtype="object")
+  result = roundtrip([strings, numpy.array([], dtype="object"), numpy.arange(2)])
+  assert list(result[0]) == [u"alpha", u"", u"\u03b2eta", u"gamma"]
+  assert result[1].shape == (0,)
+  numpy.testing.assert_array_equal(result[2], [0, 1])
+
+def test_invalid_message():
+  with pytest.raises(ValueError):
+    slycat.columnar.decode("[[1, 2, 3]]")
+  with pytest.raises(ValueError):
+    list(slycat.columnar.encode([numpy.arange(3)], "middle"))
+
+def test_arrays_are_encoded_as_they_are_read():
+  read = []
+  def arrays():
+    for index in range(3):
+      read.append(index)
+      yield numpy.arange(index + 1)
+  message = slycat.columnar.encode(arrays())
+  assert read == []
+  pieces = [message.next(), message.next()]
+  assert read == [0]
+  result = slycat.columnar.decode("".join(pieces + list(message)))
+  assert read == [0, 1, 2]
+  numpy.testing.assert_array_equal(result[2], [0, 1, 2])
+
+def test_string_lengths_use_the_smallest_type():
+  strings = numpy.array(["a" * 300, "b"], dtype="object")
+  message = "".join(slycat.columnar.encode([strings, numpy.array(["c"], dtype="object")]))
+  assert len(message) < 8 + 2 * 128 + 300
+  result = slycat.columnar.decode(message)
+  assert list(result[0]) == ["a" * 300, "b"]
+  assert list(result[1]) == ["c"]
+
+def test_truncated_message():
+  message = "".join(slycat.columnar.encode([numpy.arange(3), numpy.arange(4)]))
+  with pytest.raises(ValueError):
+    slycat.columnar.decode(message[:-len(slycat.columnar.terminator)])
+  with pytest.raises(ValueError):
+    slycat.columnar.decode(message[:-len(slycat.columnar.terminator) - 8])
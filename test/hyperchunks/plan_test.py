@@ -0,0 +1,63 @@
+import pytest
+import numpy
+import slycat.darray
+import slycat.hyperchunks
+
+class CountingArray(slycat.darray.MemArray):
+  def __init__(self, *args, **kwargs):
+    slycat.darray.MemArray.__init__(self, *args, **kwargs)
+    self.reads = []
+  def get_data(self, attribute=0):
+    array = self
+    data = slycat.darray.MemArray.get_data(self, attribute)
+    class Reader(object):
+      def __getitem__(self, key):
+        array.reads.append((attribute, key))
+        return data[key]
+    return Reader()
+
+def table():
+  a0 = numpy.arange(10, dtype="float64")
+  a1 = numpy.array([5, 3, 8, 1, 9, 2, 7, 4, 6, 0], dtype="float64")
+  a1[4] = numpy.nan
+  return CountingArray([dict(name="row", end=10)], [dict(name="a0", type="float64"), dict(name="a1", type="float64")], [a0, a1])
+
+def plan(string):
+  return slycat.hyperchunks.compile(slycat.hyperchunks.parse(string)[0].attributes[0])
+
+def test_compound_predicate_reads_attribute_once():
+  array = table()
+  result = plan("0/a1 > 3 and a1 < 7/...").evaluate(array)
+  a1 = array._data[1]
+  numpy.testing.assert_array_equal(result, numpy.logical_and(a1 > 3, a1 < 7))
+  assert [attribute for attribute, key in array.reads] == [1]
+
+def test_cache_is_shared_between_plans():
+  array = table()
+  cache = {}
+  plan("0/a1 > 3/...").evaluate(array, cache=cache)
+  plan("0/a1 in [1, 2, 3]/...").evaluate(array, cache=cache)
+  assert len(array.reads) == 1
+
+def test_hyperslice_is_applied_before_reading():
+  array = table()
+  result = plan("0/a0 >= 2 or a1 == nan/...").evaluate(array, (slice(2, 6),))
+  numpy.testing.assert_array_equal(result, [True, True, True, True])
+  assert array.reads == [(0, (slice(2, 6, 1),)), (1, (slice(2, 6, 1),))]
+
+def test_negative_step_falls_back_to_full_read():
+  array = table()
+  result = plan("0/a0/...").evaluate(array, (slice(None, None, -1),))
+  numpy.testing.assert_array_equal(result, numpy.arange(10)[::-1])
+  assert array.reads == [(0, Ellipsis)]
+
+def test_rank_reads_whole_attribute():
+  array = table()
+  result = plan('0/rank(a0, "desc")/...').evaluate(array, (slice(0, 3),))
+  numpy.testing.assert_array_equal(result, [9, 8, 7])
+  assert array.reads == [(0, Ellipsis)]
+
+def test_membership_and_index():
+  array = table()
+  numpy.testing.assert_array_equal(plan("0/a1 not in [1, 2]/...").evaluate(array), numpy.in1d(array._data[1], [1, 2], invert=True))
+  numpy.testing.assert_array_equal(plan("0/index(0)/...").evaluate(array, (slice(3, 5),)), [3, 4])
@@ -0,0 +1,42 @@
+import json
+import numpy
+import slycat.jsonarray
+
+def masked(array):
+  # The encoding used before slycat.jsonarray existed.
+  return json.dumps([None if numpy.isnan(value) else value for value in array.tolist()])
+
+def test_nans_are_null():
+  array = numpy.array([1.5, numpy.nan, -2.0, numpy.nan, 1e300])
+  assert slycat.jsonarray.dumps(array) == masked(array)
+  assert json.loads(slycat.jsonarray.dumps(array)) == [1.5, None, -2.0, None, 1e300]
+  assert slycat.jsonarray.dumps(numpy.array([numpy.nan], dtype="float32")) == "[null]"
+  assert slycat.jsonarray.dumps(numpy.float64(numpy.nan)) == "null"
+
+def test_whole_numbers():
+  arrays = [
+    numpy.array([1.0, numpy.nan, -2.0, 0.0, 123456789012345.0]),
+    numpy.array([1.0, -0.0, 2.0]),
+    numpy.array([1.0, 1e16, -1e17]),
+    numpy.array([1.0, numpy.inf, 2.0]),
+    numpy.array([1.0, 2.5]),
+    numpy.array([3.0, 4.0], dtype="float32"),
+    numpy.array([numpy.nan, numpy.nan]),
+    numpy.array([], dtype="float64"),
+    ]
+  for array in arrays:
+    assert slycat.jsonarray.dumps(array) == masked(array)
+
+def test_multidimensional_arrays():
+  array = numpy.arange(6, dtype="float64").reshape(2, 3)
+  array[1, 1] = numpy.nan
+  assert json.loads(slycat.jsonarray.dumps(array)) == [[0.0, 1.0, 2.0], [3.0, None, 5.0]]
+
+def test_other_types():
+  assert slycat.jsonarray.dumps(numpy.arange(3, dtype="int32")) == "[0, 1, 2]"
+  assert json.loads(slycat.jsonarray.dumps(numpy.array(["NaN", u"\u03b2"], dtype="object"))) == ["NaN", u"\u03b2"]
+  assert slycat.jsonarray.dumps(numpy.array([True, False])) == "[true, false]"
+
+def test_dumps_list():
+  arrays = [numpy.array([numpy.nan, 1.0]), numpy.array(["a"], dtype="object"), numpy.zeros((0,))]
+  assert slycat.jsonarray.dumps_list(arrays) == json.dumps([[None, 1.0], ["a"], []])
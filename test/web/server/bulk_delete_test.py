@@ -0,0 +1,145 @@
+import BaseHTTPServer
+import cherrypy
+import json
+import pytest
+import SocketServer
+import threading
+import urlparse
+import slycat.web.server.authentication
+import slycat.web.server.cleanup
+import slycat.web.server.database.couchdb
+import slycat.web.server.handlers
+
+class CouchDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Imitates just enough of CouchDB to store and delete project documents."""
+  protocol_version = "HTTP/1.1"
+  wbufsize = -1
+
+  def reply(self, status, content):
+    body = json.dumps(content)
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(body)
+
+  def respond(self):
+    path, query = self.path.split("?", 1) if "?" in self.path else (self.path, "")
+    query = dict((key, json.loads(value)) for key, value in urlparse.parse_qsl(query))
+    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "null")
+    with self.server.lock:
+      self.server.requests.append((self.command, path))
+      return self.handle_request(path.split("/")[2:], query, body)
+
+  def handle_request(self, path, query, body):
+    documents = self.server.documents
+    if path == []:
+      return 200, {"db_name": "slycat"}
+    if path == ["_bulk_docs"]:
+      if len(body["docs"]) > self.server.bulk_limit:
+        return 413, {"error": "too_large", "reason": "Request entity too large."}
+      results = []
+      for stub in body["docs"]:
+        if stub["_id"] not in documents or documents[stub["_id"]]["_rev"] != stub["_rev"]:
+          results.append({"id": stub["_id"], "error": "conflict", "reason": "Document update conflict."})
+        else:
+          del documents[stub["_id"]]
+          results.append({"id": stub["_id"], "rev": "2-x"})
+      return 201, results
+    if path == ["_all_docs"]:
+      return 200, {"rows": [{"id": key, "key": key, "value": {"rev": documents[key]["_rev"]}} if key in documents else {"key": key, "error": "not_found"} for key in body["keys"]]}
+    if path[:3] == ["_design", "slycat", "_view"]:
+      view = path[3]
+      if view == "hdf5-file-counts":
+        counts = dict((id, 0) for id, document in documents.items() if document["type"] == "hdf5")
+        for document in documents.values():
+          if document["type"] == "model":
+            for artifact, artifact_type in document.get("artifact-types", {}).items():
+              counts[document["artifact:" + artifact]] = counts.get(document["artifact:" + artifact], 0) + 1
+        return 200, {"rows": [{"key": key, "value": value} for key, value in sorted(counts.items())]}
+      type = {"project-models": "model", "project-bookmarks": "bookmark", "project-references": "reference", "project-cache-objects": "cache-object"}[view]
+      rows = [{"id": id, "key": document["project"], "value": None, "doc": document} for id, document in sorted(documents.items()) if document["type"] == type and query["startkey"] <= document["project"] <= query["endkey"]]
+      return 200, {"total_rows": len(rows), "offset": 0, "rows": rows}
+    if path[0] in documents and self.command in ["GET", "HEAD"]:
+      return 200, documents[path[0]]
+    return 404, {"error": "not_found", "reason": "missing"}
+
+  def do_HEAD(self):
+    self.reply(*self.respond())
+
+  def do_GET(self):
+    self.reply(*self.respond())
+
+  def do_POST(self):
+    self.reply(*self.respond())
+
+  def log_message(self, *arguments):
+    pass
+
+class CouchDBServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+@pytest.fixture
+def server(monkeypatch):
+  server = CouchDBServer(("127.0.0.1", 0), CouchDBHandler)
+  server.lock = threading.Lock()
+  server.requests = []
+  server.documents = {}
+  server.bulk_limit = 1000
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  monkeypatch.setattr(slycat.web.server.database.couchdb, "pool", slycat.web.server.database.couchdb.ConnectionPool("http://127.0.0.1:%s" % server.server_port, "slycat", size=1, check_interval=60))
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def add(server, id, type, **fields):
+  server.documents[id] = dict(_id=id, _rev="1-x", type=type, **fields)
+
+def test_delete_all_splits_rejected_chunks(server):
+  for i in range(100):
+    add(server, "doc%03d" % i, "bookmark", project="p")
+  server.bulk_limit = 30
+  database = slycat.web.server.database.couchdb.connect()
+  documents = [database["doc%03d" % i] for i in range(100)]
+  server.documents["doc050"]["_rev"] = "2-y"
+  del server.requests[:]
+
+  deleted = database.delete_all(documents, chunk_size=50)
+  assert deleted == ["doc%03d" % i for i in range(100) if i != 50]
+  assert server.documents.keys() == ["doc050"]
+  # Two rejected chunks of 50, split into four accepted chunks of 25.
+  assert [method for method, path in server.requests] == ["POST"] * 6
+
+def test_delete_project(server, monkeypatch):
+  monkeypatch.setattr(slycat.web.server.authentication, "require_project_administrator", lambda project: None)
+  add(server, "p", "project")
+  add(server, "other", "project")
+  for i in range(5000):
+    add(server, "model%s" % i, "model", project="p", **{"artifact-types": {"data": "hdf5"}, "artifact:data": "array%s" % i})
+    add(server, "array%s" % i, "hdf5")
+    add(server, "bookmark%s" % i, "bookmark", project="p")
+  add(server, "reference", "reference", project="p")
+  add(server, "cache", "cache-object", project="p")
+  add(server, "model", "model", project="other", **{"artifact-types": {"data": "hdf5"}, "artifact:data": "array"})
+  add(server, "array", "hdf5")
+  slycat.web.server.database.couchdb.connect()
+  del server.requests[:]
+
+  slycat.web.server.handlers.delete_project("p")
+  assert cherrypy.response.status == "204 Project deleted."
+  assert sorted(id for id, document in server.documents.items() if document["type"] != "hdf5") == ["model", "other"]
+  # One request for the project and one per view, plus one per thousand deleted documents.
+  assert len(server.requests) == 1 + 4 + 11
+
+  # The documents for unused arrays are deleted in bulk, and the files are queued for deletion.
+  while not slycat.web.server.cleanup.delete_array.queue.empty():
+    slycat.web.server.cleanup.delete_array.queue.get()
+  slycat.web.server.cleanup._delete_unused_arrays(slycat.web.server.database.couchdb.connect())
+  assert sorted(id for id, document in server.documents.items() if document["type"] == "hdf5") == ["array"]
+  queued = []
+  while not slycat.web.server.cleanup.delete_array.queue.empty():
+    queued.append(slycat.web.server.cleanup.delete_array.queue.get())
+  assert sorted(queued) == sorted("array%s" % i for i in range(5000))
@@ -1,2 +1,57 @@
 import pytest
+import os
+import time
 import slycat.web.server.cache
+
+def test_hits_do_not_rewrite_payloads(tmpdir):
+  cache = slycat.web.server.cache.Cache(str(tmpdir), seconds=60)
+  cache["key"] = "value"
+  path = os.path.join(str(tmpdir), cache.digest_hash("key"))
+  modified = os.path.getmtime(path)
+  time.sleep(0.05)
+  assert cache["key"] == "value"
+  assert os.path.getmtime(path) == modified
+
+def test_memory_limit_evicts_least_recently_used(tmpdir):
+  cache = slycat.web.server.cache.Cache(str(tmpdir), memory_limit=3000)
+  for key in ["a", "b", "c"]:
+    cache[key] = "x" * 1000
+  assert cache.memory_usage <= 3000
+  assert cache.digest_hash("a") not in cache.v_keys
+  assert cache["a"] == "x" * 1000
+  assert cache.digest_hash("b") not in cache.v_keys
+
+def test_disk_limit_evicts_least_recently_used(tmpdir):
+  cache = slycat.web.server.cache.Cache(str(tmpdir), disk_limit=3000)
+  for key in ["a", "b", "c", "d"]:
+    cache[key] = "x" * 1000
+  assert cache.disk_usage <= 3000
+  assert "a" not in cache
+  assert "d" in cache
+  assert cache.disk_usage == sum([os.path.getsize(os.path.join(str(tmpdir), digest)) for digest in cache.fs_keys])
+
+def test_expired_items_are_removed(tmpdir):
+  cache = slycat.web.server.cache.Cache(str(tmpdir), seconds=0.05)
+  cache["key"] = "value"
+  time.sleep(0.1)
+  cache.clean()
+  assert cache.fs_keys == []
+  assert cache.disk_usage == 0
+
+def test_index_survives_restart(tmpdir):
+  cache = slycat.web.server.cache.Cache(str(tmpdir), seconds=60)
+  cache["key"] = "value"
+  cache = slycat.web.server.cache.Cache(str(tmpdir), seconds=60)
+  assert cache["key"] == "value"
+  assert cache.disk_usage > 0
+
+def test_decorator(tmpdir):
+  cache = slycat.web.server.cache.Cache(str(tmpdir))
+  calls = []
+  @cache
+  def square(value):
+    calls.append(value)
+    return value * value
+  assert square(3) == 9
+  assert square(3) == 9
+  assert calls == [3]
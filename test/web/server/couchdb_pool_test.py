@@ -0,0 +1,85 @@
+import BaseHTTPServer
+import json
+import pytest
+import SocketServer
+import threading
+import time
+import slycat.web.server.database.couchdb
+
+class CouchDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Imitates just enough of CouchDB to serve documents from a single database."""
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections.append(self.client_address)
+
+  def reply(self, body):
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    return body
+
+  def do_HEAD(self):
+    time.sleep(self.server.delay)
+    self.reply("{}")
+
+  def do_GET(self):
+    document = {"_id": self.path.split("/")[-1], "type": "project"}
+    self.wfile.write(self.reply(json.dumps(document)))
+
+  def log_message(self, *arguments):
+    pass
+
+class CouchDBServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+@pytest.fixture
+def server():
+  server = CouchDBServer(("127.0.0.1", 0), CouchDBHandler)
+  server.connections = []
+  server.delay = 0
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def test_databases_are_pooled(server):
+  pool = slycat.web.server.database.couchdb.ConnectionPool("http://127.0.0.1:%s" % server.server_port, "slycat", size=2, check_interval=60)
+  databases = [pool.get() for i in range(6)]
+  assert len(set([id(database) for database in databases])) == 2
+  for database in databases:
+    assert database.get("project", "abc")["_id"] == "abc"
+  # One keep-alive connection per pooled database.
+  assert len(server.connections) == 2
+
+def test_unhealthy_databases_are_replaced(server):
+  pool = slycat.web.server.database.couchdb.ConnectionPool("http://127.0.0.1:%s" % server.server_port, "slycat", size=1, check_interval=0)
+  database = pool.get()
+  assert pool.get() is database
+  def fail():
+    raise IOError("Connection reset.")
+  database.ping = fail
+  replacement = pool.get()
+  assert replacement is not database
+  assert replacement.get("project", "abc")["_id"] == "abc"
+
+def test_databases_are_created_outside_the_lock(server):
+  pool = slycat.web.server.database.couchdb.ConnectionPool("http://127.0.0.1:%s" % server.server_port, "slycat", size=2, check_interval=60)
+  database = pool.get()
+
+  # While a slow server connects the second database, the first is still handed out.
+  server.delay = 1.0
+  created = []
+  thread = threading.Thread(target=lambda: created.append(pool.get()))
+  thread.start()
+  time.sleep(0.2)
+  start = time.time()
+  assert pool.get() is database
+  assert time.time() - start < 0.5
+  thread.join()
+  assert created[0] is not database
+  assert set([id(pool.get()) for i in range(4)]) == set([id(database), id(created[0])])
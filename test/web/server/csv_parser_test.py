@@ -0,0 +1,150 @@
+import imp
+import numpy
+import os
+import StringIO
+import pytest
+import slycat.hdf5
+import slycat.web.server.hdf5
+
+parser = imp.load_source("slycat_csv_parser", os.path.join(os.path.dirname(__file__), "..", "..", "..", "web-server", "plugins", "slycat-csv-parser.py"))
+
+class Array(object):
+  """Collects the data stored by the parser."""
+  def __init__(self):
+    self.starts = []
+    self.chunks = []
+    self.retyped = []
+    self.filled = []
+
+  def start(self, attributes):
+    self.starts.append([attribute["type"] for attribute in attributes])
+    self.columns = [[] for attribute in attributes]
+    self.chunks = []
+    self.rows = 0
+    return self
+
+  def append(self, data):
+    self.chunks.append((self.rows, self.rows + len(data[0])))
+    self.rows += len(data[0])
+    for column, values in zip(self.columns, data):
+      column.extend(values)
+
+  def retype(self, attribute, type):
+    self.retyped.append((attribute, self.rows))
+    self.columns[attribute] = [""] * self.rows
+
+  def fill(self, attribute, begin, values):
+    assert begin + len(values) <= self.rows
+    self.filled.append((attribute, begin, begin + len(values)))
+    self.columns[attribute][begin:begin + len(values)] = values
+
+  def finish(self):
+    self.columns = [numpy.array(column, dtype=object) for column in self.columns]
+
+def test_chunks_are_stored_as_they_are_parsed():
+  array = Array()
+  file = StringIO.StringIO("a, b,c\n1,x,\n\n2.5,\"y,\nz\",3\n,w,4\r\n5,v")
+  attributes, dimensions = parser.parse_file(file, array.start, chunk_size=16)
+  array.finish()
+  assert attributes == [{"name": "a", "type": "float64"}, {"name": "b", "type": "string"}, {"name": "c", "type": "float64"}]
+  assert dimensions == [{"name": "row", "type": "int64", "begin": 0, "end": 4}]
+  assert len(array.chunks) > 1
+  assert array.columns[0][[0, 1, 3]].tolist() == [1.0, 2.5, 5.0]
+  assert numpy.isnan(array.columns[0][2])
+  assert array.columns[1].tolist() == ["x", "y,\nz", "w", "v"]
+  assert array.columns[2][1:3].tolist() == [3.0, 4.0]
+  # Empty and missing values are NaN.
+  assert numpy.isnan(array.columns[2][[0, 3]].astype("float64")).all()
+
+def test_columns_fall_back_to_strings():
+  array = Array()
+  file = StringIO.StringIO("a,b\n" + "1,2\n" * 10 + "3,four\n")
+  attributes, dimensions = parser.parse_file(file, array.start, chunk_size=16, sample_size=2)
+  array.finish()
+  # Only the column with a non-numeric value changes type, without storing the others again.
+  assert attributes == [{"name": "a", "type": "float64"}, {"name": "b", "type": "string"}]
+  assert len(array.starts) == 1
+  assert array.retyped == [(1, 10)]
+  assert [begin for begin, end in array.chunks[1:]] == [end for begin, end in array.chunks[:-1]]
+  assert array.chunks[0][0] == 0 and array.chunks[-1][1] == 11
+  # The rows stored before the change are read again, for that column only.
+  assert set([attribute for attribute, begin, end in array.filled]) == set([1])
+  assert sum([end - begin for attribute, begin, end in array.filled]) == 10
+  assert array.columns[0].tolist() == [1.0] * 10 + [3.0]
+  assert array.columns[1].tolist() == ["2"] * 10 + ["four"]
+
+def test_empty_columns_are_undecided():
+  array = Array()
+  file = StringIO.StringIO("a,b,c,d\n" + "1,,,\n" * 10 + "2,3.5,,x\n")
+  attributes, dimensions = parser.parse_file(file, array.start, chunk_size=16, sample_size=2)
+  array.finish()
+  # Columns without values in the sample are stored as numbers until a value says otherwise, and columns
+  # without any values are strings, like the old parser.
+  assert array.starts == [["float64", "float64", "float64", "float64"]]
+  assert [attribute["type"] for attribute in attributes] == ["float64", "float64", "string", "string"]
+  assert sorted(array.retyped) == [(2, 11), (3, 10)]
+  assert set([attribute for attribute, begin, end in array.filled]) == set([3])
+  assert numpy.isnan(array.columns[1][:10].astype("float64")).all()
+  assert array.columns[1][10] == 3.5
+  assert array.columns[2].tolist() == [""] * 11
+  assert array.columns[3].tolist() == [""] * 10 + ["x"]
+
+def test_files_need_a_header_and_a_row():
+  with pytest.raises(Exception):
+    parser.parse_file(StringIO.StringIO("a,b\n\n"), None)
+
+def test_blocks_are_split_like_the_csv_module():
+  rows = ["%s,%s,label-%s" % (i, i * 0.5, i % 3) for i in range(100)]
+  results = []
+  for text in ["x,y,z\n" + "\n".join(rows), "x, y, z\n" + "\n".join(row.replace(",", ", ") for row in rows), "x,y,z\n" + "\n".join(rows) + ",\"\"\n"]:
+    array = Array()
+    attributes, dimensions = parser.parse_file(StringIO.StringIO(text), array.start, chunk_size=64)
+    array.finish()
+    results.append((attributes, dimensions, [column.tolist() for column in array.columns]))
+  assert results[0] == results[1] == results[2]
+  assert results[0][2][2][:3] == ["label-0", "label-1", "label-2"]
+
+def test_files_are_prepared_as_array_sets(monkeypatch, tmpdir):
+  monkeypatch.setattr(slycat.web.server.hdf5.path, "root", str(tmpdir))
+  monkeypatch.setattr(slycat.web.server.hdf5.layout, "policy", {"chunk-size": 64})
+  storage = parser.prepare(True, StringIO.StringIO("a,b\n" + "".join("%s,label-%s\n" % (i, i) for i in range(100))))
+  with slycat.web.server.hdf5.open(storage) as file:
+    array = slycat.hdf5.ArraySet(file)[0]
+    assert [attribute["type"] for attribute in array.attributes] == ["float64", "string"]
+    assert array.shape == (100,)
+    assert array.get_statistics(0)["max"] == 99.0
+    assert array.get_data(0)[...].tolist() == range(100)
+    assert array.get_data(1)[98:].tolist() == ["label-98", "label-99"]
+
+  retyped = parser.prepare(True, StringIO.StringIO("a,b,c\n" + "".join("%s,%s,\n" % (i, i) for i in range(100)) + "100,label,\n"))
+  with slycat.web.server.hdf5.open(retyped) as file:
+    array = slycat.hdf5.ArraySet(file)[0]
+    assert [attribute["type"] for attribute in array.attributes] == ["float64", "string", "string"]
+    assert array.get_data(0)[...].tolist() == range(101)
+    assert array.get_data(1)[...].tolist() == [str(i) for i in range(100)] + ["label"]
+    assert array.get_data(2)[...].tolist() == [""] * 101
+    assert array.get_statistics(1)["unique"] == 101
+
+  with pytest.raises(Exception):
+    parser.prepare(True, StringIO.StringIO("a,b\n"))
+  assert sorted([path.purebasename for path in tmpdir.visit("*.hdf5")]) == sorted([storage, retyped])
+
+def test_unattached_array_sets_are_deleted(monkeypatch):
+  deleted = []
+  monkeypatch.setattr(slycat.web.server.hdf5, "delete", deleted.append)
+  def put_model_arrayset(database, model, aid, input, storage):
+    if aid == "b":
+      raise Exception("Conflict.")
+    model["artifact:%s" % aid] = storage
+  monkeypatch.setattr(slycat.web.server, "put_model_arrayset", put_model_arrayset)
+
+  model = {}
+  with pytest.raises(Exception):
+    parser.parse(None, model, True, ["1", "2", "3"], ["a", "b", "c"])
+  assert model == {"artifact:a": "1"}
+  assert deleted == ["2", "3"]
+
+  del deleted[:]
+  with pytest.raises(Exception):
+    parser.parse(None, {}, True, ["1", "2"], ["a"])
+  assert deleted == ["1", "2"]
@@ -0,0 +1,160 @@
+import pytest
+import numpy
+import threading
+import time
+import slycat.hdf5
+import slycat.web.server.hdf5
+
+@pytest.fixture
+def data_store(tmpdir):
+  slycat.web.server.hdf5.path.root = str(tmpdir)
+  yield str(tmpdir)
+  slycat.web.server.hdf5.pool.clear()
+  slycat.web.server.hdf5.path.root = None
+
+def create_array(array, values):
+  with slycat.web.server.hdf5.create(array) as file:
+    arrayset = slycat.hdf5.start_arrayset(file)
+    arrayset.start_array(0, [dict(name="row", end=len(values))], [dict(name="value", type="float64")])
+    arrayset[0].set_data(0, slice(None), values)
+
+def test_readers_share_lock():
+  lock = slycat.web.server.hdf5.ReaderWriterLock()
+  inside = []
+  barrier = threading.Event()
+  def reader():
+    with lock.read():
+      inside.append(1)
+      barrier.wait(5)
+  threads = [threading.Thread(target=reader) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  deadline = time.time() + 5
+  while len(inside) < 4 and time.time() < deadline:
+    time.sleep(0.01)
+  assert len(inside) == 4
+  barrier.set()
+  for thread in threads:
+    thread.join()
+
+def test_writer_excludes_readers():
+  lock = slycat.web.server.hdf5.ReaderWriterLock()
+  events = []
+  def reader():
+    with lock.read():
+      events.append("read")
+  with lock.write():
+    thread = threading.Thread(target=reader)
+    thread.start()
+    time.sleep(0.1)
+    events.append("write")
+  thread.join()
+  assert events == ["write", "read"]
+
+def test_lock_is_reentrant():
+  lock = slycat.web.server.hdf5.ReaderWriterLock()
+  with lock.write():
+    with lock.write():
+      with lock.read():
+        pass
+  with lock.read():
+    with lock.read():
+      pass
+  with lock.write():
+    pass
+
+def test_pool_reuses_handles(data_store):
+  create_array("aaaaaaaa", numpy.arange(10, dtype="float64"))
+  pool = slycat.web.server.hdf5.FilePool(size=2)
+  with pool.reader("aaaaaaaa") as first:
+    pass
+  with pool.reader("aaaaaaaa") as second:
+    numpy.testing.assert_array_equal(slycat.hdf5.ArraySet(second)[0].get_data(0)[...], numpy.arange(10))
+  assert first is second
+  assert len(pool) == 1
+  pool.clear()
+
+def test_pool_evicts_least_recently_used(data_store):
+  for array in ["aaaaaaaa", "bbbbbbbb", "cccccccc"]:
+    create_array(array, numpy.zeros(3))
+  pool = slycat.web.server.hdf5.FilePool(size=2)
+  for array in ["aaaaaaaa", "bbbbbbbb", "cccccccc"]:
+    with pool.reader(array) as file:
+      pass
+  assert len(pool) == 2
+  pool.clear()
+
+def test_writer_invalidates_pooled_handle(data_store):
+  create_array("aaaaaaaa", numpy.zeros(3))
+  pool = slycat.web.server.hdf5.FilePool(size=2)
+  with pool.reader("aaaaaaaa") as file:
+    pass
+  with pool.writer("aaaaaaaa") as file:
+    slycat.hdf5.ArraySet(file)[0].set_data(0, slice(None), numpy.ones(3))
+  assert len(pool) == 0
+  with pool.reader("aaaaaaaa") as file:
+    numpy.testing.assert_array_equal(slycat.hdf5.ArraySet(file)[0].get_data(0)[...], numpy.ones(3))
+  pool.clear()
+
+def create_legacy_array(array, values):
+  # Files written before statistics were computed at write time have to derive them when read.
+  create_array(array, values)
+  with slycat.web.server.hdf5.open(array, "r+") as file:
+    attribute = file["array/0/attribute/0"]
+    for key in list(attribute.attrs.keys()):
+      del attribute.attrs[key]
+    del file["array/0/unique/0"]
+
+def read_derived(path):
+  import h5py
+  with h5py.File(path, "r") as file:
+    array = slycat.hdf5.ArraySet(file)[0]
+    return array.get_statistics(0), array.get_unique(0, slice(None))["values"].tolist()
+
+def test_derived_data_with_read_only_readers(data_store):
+  values = numpy.array([3, 1, numpy.nan, 2, 1], dtype="float64")
+  create_legacy_array("aaaaaaaa", values)
+  pool = slycat.web.server.hdf5.FilePool(size=2)
+
+  # Separate processes can derive data from the file concurrently, with read-only access.  They're
+  # started before any threads, so they can't inherit locks held by another thread.
+  import multiprocessing
+  processes = multiprocessing.Pool(4)
+  remote = processes.map(read_derived, [slycat.web.server.hdf5.path("aaaaaaaa")] * 8)
+  processes.close()
+  processes.join()
+
+  # Concurrent readers in this process share one read-only handle, and derived data, through the pool.
+  results = []
+  def reader():
+    with pool.arrayset("aaaaaaaa") as arrayset:
+      results.append((arrayset[0].get_statistics(0), arrayset[0].get_unique(0, slice(None))["values"].tolist()))
+  threads = [threading.Thread(target=reader) for i in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  expected = ({"min": 1.0, "max": 3.0, "unique": 3, "nan-count": 1}, [1.0, 2.0, 3.0])
+  assert len(results) == 8
+  assert all(result == expected for result in results + remote)
+
+  # Derived data is written back to the file in the background.
+  pool.flush()
+  with slycat.web.server.hdf5.open("aaaaaaaa") as file:
+    assert file["array/0/attribute/0"].attrs["unique"] == 3
+    numpy.testing.assert_array_equal(file["array/0/unique/0"][...], expected[1])
+  pool.clear()
+
+def test_stale_derived_data_is_discarded(data_store):
+  create_legacy_array("aaaaaaaa", numpy.arange(4, dtype="float64"))
+  pool = slycat.web.server.hdf5.FilePool(size=2)
+  with pool.lock("aaaaaaaa").write():
+    with pool.arrayset("aaaaaaaa") as arrayset:
+      assert arrayset[0].get_statistics(0)["max"] == 3
+    with pool.writer("aaaaaaaa") as file:
+      slycat.hdf5.ArraySet(file)[0].set_data(0, slice(None), numpy.arange(4, 8, dtype="float64"))
+  pool.flush()
+  with pool.arrayset("aaaaaaaa") as arrayset:
+    assert arrayset[0].get_statistics(0)["max"] == 7
+  pool.clear()
@@ -0,0 +1,140 @@
+import copy
+import couchdb.http
+import pytest
+import time
+import slycat.web.server.progress
+
+class Database(object):
+  """Stands in for the CouchDB database, enforcing revisions and counting writes."""
+  def __init__(self):
+    self.documents = {}
+    self.writes = 0
+    # Called once, at the start of the next save.
+    self.before_save = None
+
+  def get(self, type, id):
+    return copy.deepcopy(self.documents[id])
+
+  def save(self, document):
+    before_save, self.before_save = self.before_save, None
+    if before_save is not None:
+      before_save()
+    current = self.documents.get(document["_id"])
+    if current is not None and current["_rev"] != document.get("_rev"):
+      raise couchdb.http.ResourceConflict("Document update conflict.")
+    self.writes += 1
+    document["_rev"] = str(int(document.get("_rev", "0")) + 1)
+    self.documents[document["_id"]] = copy.deepcopy(document)
+    return document["_id"], document["_rev"]
+
+@pytest.fixture
+def database():
+  database = Database()
+  database.save({"_id": "m", "type": "model", "state": "running", "progress": 0.0, "message": ""})
+  database.writes = 0
+  return database
+
+def wait_for(condition):
+  deadline = time.time() + 10
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  assert condition()
+
+def test_progress_is_coalesced(database):
+  reporter = slycat.web.server.progress.Reporter(interval=0.2)
+  model = database.get("model", "m")
+  for i in range(100):
+    reporter.update(database, model, progress=i / 100.0, message="Step %s." % i)
+  # The first update is written immediately, the rest are coalesced into a single write.
+  assert database.writes == 1
+  wait_for(lambda: database.writes == 2)
+  assert database.documents["m"]["progress"] == 0.99
+  assert database.documents["m"]["message"] == "Step 99."
+  time.sleep(0.3)
+  assert database.writes == 2
+
+def test_state_changes_are_written_immediately(database):
+  reporter = slycat.web.server.progress.Reporter(interval=60)
+  model = database.get("model", "m")
+  reporter.update(database, model, progress=0.5)
+  reporter.update(database, model, progress=0.75)
+  reporter.update(database, model, state="finished", result="succeeded", progress=1.0)
+  assert database.writes == 2
+  assert database.documents["m"]["state"] == "finished"
+  assert database.documents["m"]["progress"] == 1.0
+
+  # Saves without fields are written immediately, too.
+  model["analysis_computation_time"] = 1.0
+  reporter.update(database, model)
+  assert database.documents["m"]["analysis_computation_time"] == 1.0
+
+def test_conflicts_are_merged(database):
+  reporter = slycat.web.server.progress.Reporter(interval=0)
+  model = database.get("model", "m")
+  other = database.get("model", "m")
+  other["name"] = "Renamed"
+  database.save(other)
+
+  reporter.update(database, model, message="Computing.")
+  assert database.documents["m"]["name"] == "Renamed"
+  assert database.documents["m"]["message"] == "Computing."
+  assert model["name"] == "Renamed"
+  assert model["_rev"] == database.documents["m"]["_rev"]
+
+  # Other saves still fail, since there's no way to know which fields to merge.
+  other = database.get("model", "m")
+  database.save(other)
+  with pytest.raises(couchdb.http.ResourceConflict):
+    reporter.update(database, model)
+
+def test_callers_can_save_while_updates_are_written(database):
+  reporter = slycat.web.server.progress.Reporter(interval=0.1)
+  model = database.get("model", "m")
+  reporter.update(database, model, progress=0.1)
+  reporter.update(database, model, progress=0.2)
+
+  # Someone else saves the model while the deferred update is being written, which the writer retries.
+  def save():
+    other = database.get("model", "m")
+    other["name"] = "Renamed"
+    database.save(other)
+  database.before_save = save
+  wait_for(lambda: database.documents["m"]["progress"] == 0.2)
+  assert database.documents["m"]["name"] == "Renamed"
+
+  # The writer never touches the caller's copy.
+  model = database.get("model", "m")
+  reporter.update(database, model, progress=0.3)
+  revision = model["_rev"]
+  wait_for(lambda: database.documents["m"]["progress"] == 0.3)
+  assert model["_rev"] == revision
+
+  # The caller's next save is written over the deferred updates instead of conflicting, and keeps them.
+  model["progress"] = 0.0
+  model["artifact:other"] = "value"
+  reporter.update(database, model)
+  assert database.documents["m"]["artifact:other"] == "value"
+  assert database.documents["m"]["progress"] == 0.3
+  assert model["_rev"] == database.documents["m"]["_rev"]
+
+  # Unless something else has written the model since.
+  reporter.update(database, model, progress=0.4)
+  time.sleep(0.2)
+  database.save(database.get("model", "m"))
+  with pytest.raises(couchdb.http.ResourceConflict):
+    reporter.update(database, model)
+
+def test_pending_updates_are_written_with_other_copies(database):
+  reporter = slycat.web.server.progress.Reporter(interval=60)
+  a = database.get("model", "m")
+  reporter.update(database, a, progress=0.5)
+  reporter.update(database, a, message="Computing.")
+  assert database.documents["m"]["message"] == ""
+
+  b = database.get("model", "m")
+  b["_rev"] = a["_rev"]
+  reporter.update(database, b, state="finished")
+  assert database.documents["m"]["state"] == "finished"
+  assert database.documents["m"]["message"] == "Computing."
+  time.sleep(0.1)
+  assert database.writes == 2
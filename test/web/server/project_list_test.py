@@ -0,0 +1,57 @@
+import pytest
+import slycat.web.server
+
+class Database(object):
+  """Stands in for the CouchDB database, answering the views used to list projects."""
+  def __init__(self, projects):
+    self.projects = projects
+    self.queries = []
+
+  def scan(self, path, **keywords):
+    self.queries.append(path)
+    for project in self.projects:
+      if path == "slycat/projects":
+        yield project
+      elif path == "slycat/project-acl":
+        for role in ["administrators", "writers", "readers"]:
+          for member in project["acl"][role]:
+            if keywords["startkey"] <= member["user"] <= keywords["endkey"]:
+              yield project
+
+def create_project(id, created, administrators=[], writers=[], readers=[]):
+  acl = {"administrators": [{"user": user} for user in administrators], "writers": [{"user": user} for user in writers], "readers": [{"user": user} for user in readers], "groups": []}
+  return {"_id": id, "type": "project", "created": created, "acl": acl}
+
+@pytest.fixture
+def database():
+  return Database([
+    create_project("a", "2017-01-01", administrators=["alice"], readers=["bob"]),
+    create_project("b", "2017-03-01", administrators=["bob"], writers=["bob"], readers=["bob"]),
+    create_project("c", "2017-02-01", writers=["alice"]),
+    create_project("d", "2017-04-01", administrators=["carol"]),
+    ])
+
+def test_projects_are_listed_by_user(database):
+  cache = slycat.web.server.ProjectListCache(timeout=300)
+  assert [project["_id"] for project in cache.get(database, "alice")] == ["c", "a"]
+  assert [project["_id"] for project in cache.get(database, "bob")] == ["b", "a"]
+  assert [project["_id"] for project in cache.get(database, "dave")] == []
+  assert [project["_id"] for project in cache.get(database)] == ["d", "b", "c", "a"]
+  assert database.queries == ["slycat/project-acl"] * 3 + ["slycat/projects"]
+
+def test_lists_are_cached_until_invalidated(database):
+  cache = slycat.web.server.ProjectListCache(timeout=300)
+  cache.get(database, "alice")
+  cache.get(database, "alice")
+  assert len(database.queries) == 1
+
+  database.projects.append(create_project("e", "2017-05-01", readers=["alice"]))
+  cache.invalidate()
+  assert [project["_id"] for project in cache.get(database, "alice")] == ["e", "c", "a"]
+  assert len(database.queries) == 2
+
+def test_lists_expire(database):
+  cache = slycat.web.server.ProjectListCache(timeout=0)
+  cache.get(database, "alice")
+  cache.get(database, "alice")
+  assert len(database.queries) == 2
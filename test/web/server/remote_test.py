@@ -1,2 +1,287 @@
+import cherrypy
+import cherrypy.lib.httputil
+import json
+import os
+import paramiko
 import pytest
+import random
+import socket
+import StringIO
+import subprocess
+import sys
+import threading
+import time
+import zlib
+import slycat
 import slycat.web.server.remote
+import slycat.web.server.streaming
+
+class Server(paramiko.ServerInterface):
+  """Stands in for sshd, accepting any password."""
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def get_allowed_auths(self, username):
+    return "password"
+
+  def check_channel_request(self, kind, chanid):
+    return paramiko.OPEN_SUCCEEDED
+
+class Handle(paramiko.SFTPHandle):
+  def read(self, offset, length):
+    content = paramiko.SFTPHandle.read(self, offset, length)
+    SFTPServer.transferred += len(content)
+    return content
+
+class SFTPServer(paramiko.SFTPServerInterface):
+  """Stands in for an sftp server, counting the bytes read from files."""
+  transferred = 0
+
+  def stat(self, path):
+    return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+  lstat = stat
+
+  def open(self, path, flags, attr):
+    handle = Handle(flags)
+    handle.filename = path
+    handle.readfile = open(path, "rb")
+    return handle
+
+@pytest.fixture
+def sftp():
+  listener = socket.socket()
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(1)
+  host_key = paramiko.RSAKey.generate(1024)
+
+  def serve():
+    transport = paramiko.Transport(listener.accept()[0])
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler("sftp", paramiko.SFTPServer, SFTPServer)
+    transport.start_server(event=threading.Event(), server=Server())
+
+  thread = threading.Thread(target=serve)
+  thread.daemon = True
+  thread.start()
+  client = paramiko.SSHClient()
+  client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+  client.connect(hostname="127.0.0.1", port=listener.getsockname()[1], username="alice", password="secret", look_for_keys=False, allow_agent=False)
+  yield client, client.open_sftp()
+  client.close()
+  listener.close()
+
+@pytest.fixture
+def headers(monkeypatch):
+  monkeypatch.setattr(cherrypy.request, "headers", cherrypy.lib.httputil.HeaderMap())
+  monkeypatch.setattr(cherrypy.response, "headers", cherrypy.lib.httputil.HeaderMap())
+  return cherrypy.request.headers
+
+def test_seeks_only_read_the_requested_blocks(sftp, headers, monkeypatch, tmpdir):
+  block_size = 64 * 1024
+  monkeypatch.setattr(slycat.web.server.streaming, "cache", slycat.web.server.streaming.BlockCache(block_size=block_size, capacity=16))
+  path = tmpdir.join("video.mp4")
+  content = os.urandom(8 * 1024 * 1024)
+  path.write(content, mode="wb")
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", sftp[0], sftp[1])
+
+  generator = random.Random(0)
+  for block in generator.sample(range(len(content) // block_size), 20):
+    offset = block * block_size + generator.randrange(block_size - 4096)
+    headers["range"] = "bytes=%s-%s" % (offset, offset + 4095)
+    SFTPServer.transferred = 0
+    assert session.get_file(str(path)) == content[offset:offset + 4096]
+    assert cherrypy.response.status == "206"
+    assert cherrypy.response.headers["content-range"] == "bytes %s-%s/%s" % (offset, offset + 4095, len(content))
+    # Each seek only reads the block containing the range, instead of the whole file.
+    assert SFTPServer.transferred == block_size
+
+    # Seeking back to the same place is served from the cache.
+    SFTPServer.transferred = 0
+    assert session.get_file(str(path)) == content[offset:offset + 4096]
+    assert SFTPServer.transferred == 0
+
+  headers["range"] = "bytes=%s-" % len(content)
+  with pytest.raises(cherrypy.HTTPError) as e:
+    session.get_file(str(path))
+  assert e.value.code == 416
+
+@pytest.fixture
+def agent(tmpdir):
+  """Runs the agent in a local subprocess, returning its stdin, stdout, and stderr."""
+  directory = os.path.join(os.path.dirname(__file__), "..", "..", "..", "agent")
+  script = "import sys; sys.path.insert(0, %r); import agent; agent.Agent.__abstractmethods__ = frozenset(); agent.Agent().run()" % directory
+  environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(slycat.__file__)))
+  process = subprocess.Popen([sys.executable, "-c", script, "--workers", "10"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=str(tmpdir), env=environment)
+  assert json.loads(process.stdout.readline())["ok"]
+  yield process
+  process.stdin.close()
+  process.wait()
+
+def peak_rss(process):
+  """Return the peak resident set size of a process, in bytes."""
+  for line in open("/proc/%s/status" % process.pid):
+    if line.startswith("VmHWM:"):
+      return int(line.split()[1]) * 1024
+
+def test_files_are_streamed_in_chunks(agent, headers, tmpdir):
+  path = tmpdir.join("output.bin")
+  content = os.urandom(4 * 1024 * 1024 + 1000)
+  path.write(content, mode="wb")
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (agent.stdin, agent.stdout, agent.stderr), chunk_size=256 * 1024)
+
+  with session:
+    chunks = session.stream_file(str(path))
+  assert cherrypy.response.headers["content-length"] == len(content)
+  assert cherrypy.response.headers["content-type"] == "application/octet-stream"
+
+  # Other requests wait until the file has been streamed.
+  entered = []
+  def enter():
+    with session:
+      entered.append(time.time())
+  thread = threading.Thread(target=enter)
+  thread.start()
+  received = []
+  for chunk in chunks:
+    assert len(chunk) <= 256 * 1024
+    time.sleep(0.01)
+    assert entered == []
+    received.append(chunk)
+  thread.join()
+  assert "".join(received) == content
+  assert len(received) == 17
+  assert len(entered) == 1
+
+  # Closing a stream early leaves the agent ready for the next command.
+  with session:
+    chunks = session.stream_file(str(path))
+  assert chunks.next() == content[:256 * 1024]
+  chunks.close()
+  with session:
+    assert session.get_file(str(path)) == content
+    with pytest.raises(cherrypy.HTTPError):
+      session.get_file(str(tmpdir.join("missing.bin")))
+
+def test_streamed_files_are_not_held_in_memory(agent, headers, tmpdir):
+  path = tmpdir.join("output.bin")
+  with open(str(path), "wb") as file:
+    file.truncate(256 * 1024 * 1024)
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (agent.stdin, agent.stdout, agent.stderr), chunk_size=1024 * 1024)
+  with session:
+    chunks = session.stream_file(str(path))
+  assert sum([len(chunk) for chunk in chunks]) == 256 * 1024 * 1024
+  assert peak_rss(agent) < 64 * 1024 * 1024
+
+def frame(chunk, crc32=None):
+  return "%s\n%s" % (json.dumps({"ok": True, "size": len(chunk), "crc32": zlib.crc32(chunk) & 0xffffffff if crc32 is None else crc32}), chunk)
+
+def test_chunks_are_checked(headers):
+  metadata = {"ok": True, "message": "File retrieved.", "content-type": "text/plain", "size": 6, "chunked": True}
+  stdout = StringIO.StringIO(json.dumps(metadata) + "\n" + frame("abc") + frame("def", crc32=0) + frame("") + json.dumps({"ok": True, "message": "Next."}) + "\n")
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (StringIO.StringIO(), stdout, None), chunk_size=3)
+  with session:
+    chunks = session.stream_file("/output.txt")
+  assert chunks.next() == "abc"
+  with pytest.raises(Exception) as e:
+    chunks.next()
+  assert "Checksum mismatch" in str(e.value)
+  # The rest of the file was discarded.
+  assert json.loads(stdout.readline())["message"] == "Next."
+
+  # Agents without chunked transfers send the whole file at once.
+  metadata = {"ok": True, "message": "File retrieved.", "content-type": "text/plain", "size": 6}
+  stdout = StringIO.StringIO(json.dumps(metadata) + "\n" + "abcdef")
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (StringIO.StringIO(), stdout, None), chunk_size=3)
+  with session:
+    assert list(session.stream_file("/output.txt")) == ["abcdef"]
+
+def test_ranges_from_agents_without_them(headers):
+  # Agents that predate ranged transfers ignore the offset and length, and send the whole file.
+  metadata = {"ok": True, "message": "File retrieved.", "content-type": "video/mp4", "size": 6}
+  stdout = StringIO.StringIO(json.dumps(metadata) + "\n" + "abcdef" + json.dumps({"ok": True, "message": "Next."}) + "\n")
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (StringIO.StringIO(), stdout, None))
+  headers["range"] = "bytes=2-"
+  with session:
+    assert session.get_file("/video.mp4") == "cdef"
+  assert cherrypy.response.status == "206"
+  assert json.loads(stdout.readline())["message"] == "Next."
+
+def test_agent_commands_run_concurrently(agent, headers, tmpdir):
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (agent.stdin, agent.stdout, agent.stderr), chunk_size=64 * 1024, multiplexed=True)
+
+  # Each image is a named pipe, so reading it takes until something is written.
+  images = []
+  for index in range(10):
+    path = str(tmpdir.join("image-%s.png" % index))
+    os.mkfifo(path)
+    images.append((path, os.urandom(100000)))
+
+  def write(path, content, delay):
+    # Opening the pipe waits for the agent to open it.
+    with open(path, "wb") as file:
+      time.sleep(delay)
+      file.write(content)
+
+  results = {}
+  def get_image(path):
+    with session:
+      results[path] = session.get_image(path)
+
+  start = time.time()
+  threads = []
+  for index, (path, content) in enumerate(images):
+    # The slowest images are requested first, so the responses come back out of order.
+    threads.append(threading.Thread(target=write, args=(path, content, 1.0 - 0.05 * index)))
+    threads.append(threading.Thread(target=get_image, args=(path,)))
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+
+  assert results == dict(images)
+  # One at a time, the requests would take more than seven seconds.
+  assert elapsed < 2.0
+
+  # Other commands work as before, including streamed files.
+  path = tmpdir.join("output.bin")
+  content = os.urandom(1024 * 1024)
+  path.write(content, mode="wb")
+  with session:
+    chunks = session.stream_file(str(path))
+    assert session.get_file(str(path)) == content
+  assert "".join(chunks) == content
+
+def test_slow_responses_only_hold_up_themselves(agent, headers, tmpdir, monkeypatch):
+  monkeypatch.setattr(slycat.web.server.remote._Demultiplexer, "buffer_size", 1024 * 1024)
+  session = slycat.web.server.remote.Session("127.0.0.1", "alice", "localhost", None, None, (agent.stdin, agent.stdout, agent.stderr), chunk_size=256 * 1024, multiplexed=True, flow_control=True)
+  path = tmpdir.join("output.bin")
+  content = os.urandom(16 * 1024 * 1024)
+  path.write(content, mode="wb")
+  image = tmpdir.join("image.png")
+  image.write("image", mode="wb")
+
+  # A stream nobody is reading leaves the other commands free to run.
+  with session:
+    stalled = session.stream_file(str(path))
+  assert stalled.next() == content[:256 * 1024]
+  for index in range(3):
+    with session:
+      assert session.get_image(str(image)) == "image"
+      assert session.get_file(str(image)) == "image"
+  # The agent only sent as much as the window allows.
+  assert session._demultiplexer._responses.values()[0]._buffered <= 2 * 1024 * 1024
+  assert "".join(stalled) == content[256 * 1024:]
+
+  # Closing a stream early lets the agent finish with it.
+  with session:
+    chunks = session.stream_file(str(path))
+  chunks.next()
+  chunks.close()
+  deadline = time.time() + 10
+  while session._demultiplexer._responses and time.time() < deadline:
+    time.sleep(0.05)
+  assert session._demultiplexer._responses == {}
+  with session:
+    assert session.get_file(str(image)) == "image"
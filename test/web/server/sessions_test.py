@@ -0,0 +1,131 @@
+import cherrypy
+import copy
+import datetime
+import pytest
+import slycat.web.server.database.couchdb
+import slycat.web.server.sessions
+
+class Row(object):
+  def __init__(self, id, value):
+    self.id = id
+    self.value = value
+
+class Database(object):
+  """Stands in for the CouchDB database, counting round-trips."""
+  def __init__(self):
+    self.documents = {}
+    self.requests = 0
+
+  def get(self, type, id):
+    self.requests += 1
+    if id not in self.documents or self.documents[id]["type"] != type:
+      raise cherrypy.HTTPError(404)
+    return copy.deepcopy(self.documents[id])
+
+  def save(self, document):
+    self.requests += 1
+    document["_rev"] = "%s-x" % (int(self.documents.get(document["_id"], {"_rev": "0-x"})["_rev"].split("-")[0]) + 1)
+    self.documents[document["_id"]] = copy.deepcopy(document)
+
+  def delete(self, document):
+    self.requests += 1
+    del self.documents[document["_id"]]
+
+  def update(self, documents):
+    self.requests += 1
+    results = []
+    for document in documents:
+      if self.documents[document["_id"]]["_rev"] != document["_rev"]:
+        results.append((False, document["_id"], Exception("Document update conflict.")))
+        continue
+      document = copy.deepcopy(document)
+      document["_rev"] = "%s-x" % (int(document["_rev"].split("-")[0]) + 1)
+      self.documents[document["_id"]] = document
+      results.append((True, document["_id"], document["_rev"]))
+    return results
+
+  def scan(self, path):
+    self.requests += 1
+    return [copy.deepcopy(document) for document in self.documents.values() if document["type"] == "session"]
+
+  def view(self, path, keys):
+    self.requests += 1
+    return [Row(key, {"rev": self.documents[key]["_rev"]}) for key in keys if key in self.documents]
+
+  def delete_all(self, documents):
+    self.requests += 1
+    documents = list(documents)
+    for document in documents:
+      del self.documents[document["_id"]]
+    return [document["_id"] for document in documents]
+
+@pytest.fixture
+def database(monkeypatch):
+  database = Database()
+  monkeypatch.setattr(slycat.web.server.database.couchdb, "connect", lambda: database)
+  return database
+
+def create_session(database, sid, age):
+  created = datetime.datetime.utcnow() - age
+  database.documents[sid] = {"_id": sid, "_rev": "1-x", "type": "session", "created": created.isoformat(), "creator": "alice", "groups": [], "sessions": []}
+
+def test_sessions_are_loaded_once(database):
+  create_session(database, "a", datetime.timedelta(minutes=1))
+  table = slycat.web.server.sessions.SessionTable(timeout=datetime.timedelta(hours=1))
+
+  # Before, every authenticated request read its session from the database.
+  for i in range(100):
+    session = table.get("a")
+    table.touch("a")
+  assert session["creator"] == "alice"
+  assert database.requests == 1
+
+  # Activity is written back in bulk, with a single request.
+  assert table.flush(database) == 1
+  assert database.requests == 2
+  assert "last-active" in database.documents["a"]
+  assert table.flush(database) == 0
+
+  with pytest.raises(cherrypy.HTTPError):
+    table.get("b")
+
+def test_saved_sessions_keep_activity(database):
+  table = slycat.web.server.sessions.SessionTable(timeout=datetime.timedelta(hours=1))
+  table.save({"_id": "a", "type": "session", "created": datetime.datetime.utcnow().isoformat(), "creator": "alice", "groups": [], "sessions": []})
+  table.touch("a")
+  table.flush(database)
+
+  # A copy of the session, read before the flush, can still be saved.
+  session = table.get("a")
+  table.touch("a")
+  session["sessions"].append({"sid": "s", "hostname": "localhost", "username": "alice"})
+  table.save(session)
+  assert database.documents["a"]["sessions"] == session["sessions"]
+  assert "last-active" in database.documents["a"]
+  assert table.get("a")["_rev"] == database.documents["a"]["_rev"]
+
+def test_deleted_sessions_are_forgotten(database):
+  create_session(database, "a", datetime.timedelta(minutes=1))
+  table = slycat.web.server.sessions.SessionTable(timeout=datetime.timedelta(hours=1))
+  table.get("a")
+  table.delete("a")
+  assert "a" not in database.documents
+  with pytest.raises(cherrypy.HTTPError):
+    table.get("a")
+
+def test_expired_sessions_are_deleted(database):
+  create_session(database, "old", datetime.timedelta(hours=2))
+  create_session(database, "new", datetime.timedelta(minutes=1))
+  table = slycat.web.server.sessions.SessionTable(timeout=datetime.timedelta(hours=1))
+
+  # The first pass loads every session, later passes only look at the heap.
+  assert table.expire(database) == 1
+  assert database.documents.keys() == ["new"]
+  requests = database.requests
+  assert table.expire(database) == 0
+  assert database.requests == requests
+
+  table = slycat.web.server.sessions.SessionTable(timeout=datetime.timedelta(0))
+  table.get("new")
+  assert table.expire(database) == 1
+  assert database.documents == {}
@@ -0,0 +1,157 @@
+import pytest
+import numpy
+import time
+import slycat.darray
+import slycat.hdf5
+import slycat.web.server.hdf5
+import slycat.web.server.sort_index
+
+@pytest.fixture
+def data_store(tmpdir):
+  slycat.web.server.hdf5.path.root = str(tmpdir.mkdir("data-store"))
+  yield str(tmpdir)
+  slycat.web.server.hdf5.pool.clear()
+  slycat.web.server.hdf5.path.root = None
+
+@pytest.fixture
+def store(tmpdir):
+  return slycat.web.server.sort_index.IndexStore(str(tmpdir.join("index")), memory_limit=1024 * 1024, disk_limit=1024 * 1024, delay=0, rebuild_window=60)
+
+def table():
+  x = numpy.array([2, 1, 2, numpy.nan, 1, 2, numpy.nan, 1], dtype="float64")
+  y = numpy.array(["b", "a", "a", "c", "b", "b", "a", "a"], dtype="object")
+  z = numpy.array([7, -3, 7, 7, 1000, -3, 5, 7], dtype="int32")
+  return slycat.darray.MemArray([dict(name="row", end=8)], [dict(name="x", type="float64"), dict(name="y", type="string"), dict(name="z", type="int32")], [x, y, z])
+
+def create_table(array):
+  source = table()
+  with slycat.web.server.hdf5.create(array) as file:
+    arrayset = slycat.hdf5.start_arrayset(file)
+    arrayset.start_array(0, source.dimensions, source.attributes)
+    for attribute in range(len(source.attributes)):
+      arrayset[0].set_data(attribute, slice(None), source.get_data(attribute)[...])
+
+def reference(array, sort):
+  # NaNs sort last, and rows that tie on every key keep their original order.
+  columns = [numpy.arange(array.shape[0]) if column >= len(array.attributes) else array.get_data(column)[...] for column, order in sort]
+  def key(row):
+    result = []
+    for (column, order), values in zip(sort, columns):
+      value = values[row]
+      nan = isinstance(value, float) and numpy.isnan(value)
+      rank = (1, 0) if nan else (0, value)
+      if order == "descending":
+        rank = (-rank[0], -rank[1] if not isinstance(rank[1], basestring) else [-ord(c) for c in rank[1]])
+      result.append(rank)
+    return result
+  return sorted(range(array.shape[0]), key=key)
+
+@pytest.mark.parametrize("sort", [
+  [(0, "ascending"), (1, "ascending")],
+  [(0, "descending"), (1, "ascending")],
+  [(1, "descending"), (0, "ascending")],
+  [(1, "ascending"), (3, "descending")],
+  [(0, "ascending"), (1, "descending"), (3, "descending")],
+  [(2, "descending"), (0, "ascending")],
+  [(1, "ascending"), (2, "ascending"), (3, "descending")],
+  ])
+def test_compute_multiple_columns(sort, monkeypatch):
+  array = table()
+  assert slycat.web.server.sort_index.compute(array, sort).tolist() == reference(array, sort)
+  # Keys that are too large to pack into an integer use numpy.lexsort() instead.
+  monkeypatch.setattr(slycat.web.server.sort_index, "_packed_key_limit", 1)
+  assert slycat.web.server.sort_index.compute(array, sort).tolist() == reference(array, sort)
+
+def test_compute_single_column_matches_argsort():
+  array = table()
+  ascending = numpy.argsort(array.get_data(0)[...], kind="mergesort")
+  numpy.testing.assert_array_equal(slycat.web.server.sort_index.compute(array, [(0, "ascending")]), ascending)
+  numpy.testing.assert_array_equal(slycat.web.server.sort_index.compute(array, [(0, "descending")]), ascending[::-1])
+
+def test_indexes_are_stored(data_store, store, monkeypatch):
+  create_table("aaaaaaaa")
+  computed = []
+  compute = slycat.web.server.sort_index.compute
+  monkeypatch.setattr(slycat.web.server.sort_index, "compute", lambda array, sort: computed.append(sort) or compute(array, sort))
+
+  with slycat.web.server.hdf5.pool.arrayset("aaaaaaaa") as arrayset:
+    first = store.get("aaaaaaaa", arrayset[0], 0, [(1, "ascending"), (0, "descending")])
+    second = store.get("aaaaaaaa", arrayset[0], 0, [(1, "ascending"), (0, "descending")])
+    descending = store.get("aaaaaaaa", arrayset[0], 0, [(0, "descending")])
+    ascending = store.get("aaaaaaaa", arrayset[0], 0, [(0, "ascending")])
+  numpy.testing.assert_array_equal(first, second)
+  numpy.testing.assert_array_equal(descending, ascending[::-1])
+  assert len(computed) == 2
+
+  # Writing the array changes its version, so stale indexes are never used.
+  with slycat.web.server.hdf5.pool.writer("aaaaaaaa") as file:
+    slycat.hdf5.ArraySet(file)[0].set_data(0, slice(None), numpy.arange(8, 0, -1, dtype="float64"))
+  with slycat.web.server.hdf5.pool.arrayset("aaaaaaaa") as arrayset:
+    assert store.get("aaaaaaaa", arrayset[0], 0, [(0, "ascending")]).tolist() == range(7, -1, -1)
+  assert len(computed) == 3
+
+def test_requested_indexes_are_rebuilt_in_background(data_store, store, monkeypatch):
+  create_table("aaaaaaaa")
+  computed = []
+  compute = slycat.web.server.sort_index.compute
+  monkeypatch.setattr(slycat.web.server.sort_index, "compute", lambda array, sort: computed.append(sort) or compute(array, sort))
+
+  # Arraysets that nobody has sorted aren't indexed.
+  store.schedule("aaaaaaaa")
+  time.sleep(0.2)
+  assert computed == []
+
+  with slycat.web.server.hdf5.pool.arrayset("aaaaaaaa") as arrayset:
+    store.get("aaaaaaaa", arrayset[0], 0, [(1, "descending")])
+  with slycat.web.server.hdf5.pool.writer("aaaaaaaa") as file:
+    slycat.hdf5.ArraySet(file)[0].set_data(0, slice(None), numpy.arange(8, 0, -1, dtype="float64"))
+  store.schedule("aaaaaaaa")
+
+  # Only the index that was requested is rebuilt for the new data.
+  with slycat.web.server.hdf5.pool.arrayset("aaaaaaaa") as arrayset:
+    key = ("sort-index", "aaaaaaaa", 0, arrayset[0].version, ((1, "ascending"),))
+  deadline = time.time() + 10
+  while key not in store.cache and time.time() < deadline:
+    time.sleep(0.05)
+  assert key in store.cache
+  time.sleep(0.2)
+  assert computed == [((1, "ascending"),)] * 2
+
+  # Indexes that haven't been requested within the window are forgotten.
+  store._rebuild_window = 0
+  store.build("aaaaaaaa")
+  assert store._requested == {}
+
+@pytest.mark.parametrize("sort", [
+  None,
+  [(0, "ascending")],
+  [(1, "descending")],
+  [(3, "descending")],
+  [(1, "ascending"), (0, "descending")],
+  [(2, "descending"), (1, "ascending"), (3, "ascending")],
+  ])
+def test_row_translation_matches_argsort(data_store, store, monkeypatch, sort):
+  import slycat.web.server.handlers
+  monkeypatch.setattr(slycat.web.server.sort_index, "store", store)
+  create_table("aaaaaaaa")
+  rows = numpy.array([7, 0, 3, 3, 5, 1])
+  with slycat.web.server.hdf5.pool.arrayset("aaaaaaaa") as arrayset:
+    metadata = slycat.web.server.handlers.get_table_metadata(arrayset, 0, "index")
+
+    # Translate rows the way the handlers used to, by sorting (and inverting the sort) on every request.
+    sort_index = numpy.arange(metadata["row-count"])
+    if sort is not None:
+      if len(sort) == 1:
+        column, order = sort[0]
+        if column != metadata["column-count"] - 1:
+          sort_index = numpy.argsort(arrayset[0].get_data(column)[...], kind="mergesort")
+        if order == "descending":
+          sort_index = sort_index[::-1]
+      else:
+        sort_index = numpy.array(reference(arrayset[0], sort))
+    unsorted = sort_index[rows]
+    sorted = numpy.argsort(sort_index, kind="mergesort")[rows]
+
+    for i in range(2):
+      numpy.testing.assert_array_equal(slycat.web.server.handlers.get_table_rows("aaaaaaaa", arrayset, metadata, 0, sort, "index", rows), unsorted)
+      numpy.testing.assert_array_equal(slycat.web.server.handlers.get_table_positions("aaaaaaaa", arrayset, metadata, 0, sort, "index", rows), sorted)
@@ -0,0 +1,153 @@
+import base64
+import datetime
+import paramiko
+import pytest
+import socket
+import threading
+import time
+import slycat.web.server.ssh_pool
+
+class Server(paramiko.ServerInterface):
+  """Stands in for sshd, accepting one password and echoing executed commands."""
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL if password == "secret" else paramiko.AUTH_FAILED
+
+  def get_allowed_auths(self, username):
+    return "password"
+
+  def check_channel_request(self, kind, chanid):
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_exec_request(self, channel, command):
+    def execute():
+      channel.sendall(command)
+      channel.send_exit_status(0)
+      channel.close()
+    # Output can only be sent once the request has been accepted.
+    threading.Timer(0.01, execute).start()
+    return True
+
+@pytest.fixture(scope="module")
+def host_key():
+  return paramiko.RSAKey.generate(1024)
+
+@pytest.fixture
+def server(host_key):
+  """Listens on a local port, counting the connections it accepts."""
+  listener = socket.socket()
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(10)
+  transports = []
+
+  def serve():
+    while True:
+      try:
+        client, address = listener.accept()
+      except Exception:
+        return
+      transport = paramiko.Transport(client)
+      transport.add_server_key(host_key)
+      transports.append(transport)
+      transport.start_server(event=threading.Event(), server=Server())
+
+  thread = threading.Thread(target=serve)
+  thread.daemon = True
+  thread.start()
+  yield listener.getsockname()[1], transports
+  listener.close()
+  for transport in transports:
+    transport.close()
+
+@pytest.fixture
+def pool(server):
+  port, transports = server
+
+  def connect(hostname, username, password):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname=hostname, port=port, username=username, password=password, look_for_keys=False, allow_agent=False)
+    return client
+  return slycat.web.server.ssh_pool.Pool(connect=connect, sessions=2, timeout=datetime.timedelta(minutes=5))
+
+def test_connections_are_shared(pool, server):
+  port, transports = server
+  a = pool.acquire("127.0.0.1", "alice", "secret")
+  b = pool.acquire("127.0.0.1", "alice", "secret")
+  assert a is b
+  stdin, stdout, stderr = a.exec_command("/bin/true")
+  assert stdout.read() == "/bin/true"
+
+  # Connections are limited to a number of sessions, and aren't shared between credentials.
+  c = pool.acquire("127.0.0.1", "alice", "secret")
+  assert c is not a
+  with pytest.raises(paramiko.AuthenticationException):
+    pool.acquire("127.0.0.1", "alice", "wrong")
+  assert len(transports) == 3
+
+  # Released connections are reused.
+  a.close()
+  assert pool.acquire("127.0.0.1", "alice", "secret") is a
+  assert len(transports) == 3
+
+def test_idle_connections_are_reaped(pool, server):
+  port, transports = server
+  connection = pool.acquire("127.0.0.1", "alice", "secret")
+  assert pool.reap() == 0
+  connection.close()
+  assert pool.reap() == 0
+  assert connection.healthy()
+
+  pool._timeout = datetime.timedelta(0)
+  assert pool.reap() == 1
+  assert not connection.healthy()
+
+def test_broken_connections_are_replaced(pool, server):
+  port, transports = server
+  connection = pool.acquire("127.0.0.1", "alice", "secret")
+  connection.close()
+  transports[0].close()
+  time.sleep(0.1)
+  replacement = pool.acquire("127.0.0.1", "alice", "secret")
+  assert replacement is not connection
+  stdin, stdout, stderr = replacement.exec_command("hostname")
+  assert stdout.read() == "hostname"
+
+def certificate(valid_before):
+  message = paramiko.Message()
+  message.add_string("ssh-rsa-cert-v01@openssh.com")
+  message.add_string("nonce")
+  message.add_mpint(65537)
+  message.add_mpint(12345)
+  message.add_int64(1)
+  message.add_int(1)
+  message.add_string("alice")
+  message.add_string("")
+  message.add_int64(0)
+  message.add_int64(valid_before)
+  return "ssh-rsa-cert-v01@openssh.com %s alice" % base64.b64encode(message.asbytes())
+
+def test_certificates_are_cached_until_they_expire():
+  cache = slycat.web.server.ssh_pool.CertificateCache()
+  signed = []
+
+  def sign(valid_before):
+    def implementation(public_key):
+      signed.append(public_key)
+      return certificate(valid_before)
+    return implementation
+
+  expiration = int(time.time()) + 3600
+  key, cert = cache.get("alice", sign(expiration), bits=1024)
+  assert slycat.web.server.ssh_pool.certificate_expiration(cert) == expiration
+  assert cache.get("alice", sign(0), bits=1024) == (key, cert)
+  assert signed == ["ssh-rsa " + key.get_base64()]
+
+  # Certificates that are about to expire, or were rejected, are replaced.
+  cache.get("bob", sign(int(time.time()) + 30), bits=1024)
+  cache.get("bob", sign(int(time.time()) + 30), bits=1024)
+  cache.discard("alice")
+  cache.get("alice", sign(int(time.time()) + 3600), bits=1024)
+  assert len(signed) == 4
+
+  # Certificates that can't be parsed aren't cached.
+  assert slycat.web.server.ssh_pool.certificate_expiration("ssh-rsa AAAA") is None
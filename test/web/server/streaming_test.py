@@ -1,2 +1,110 @@
+import cherrypy
+import cherrypy.lib.httputil
 import pytest
 import slycat.web.server.streaming
+
+@pytest.fixture
+def headers(monkeypatch):
+  """Replaces the request and response headers, returning the request headers."""
+  monkeypatch.setattr(cherrypy.request, "headers", cherrypy.lib.httputil.HeaderMap())
+  monkeypatch.setattr(cherrypy.response, "headers", cherrypy.lib.httputil.HeaderMap())
+  return cherrypy.request.headers
+
+content = "".join([chr(i % 256) for i in range(1000)])
+
+def read(offset, length):
+  return content[offset:offset + length]
+
+def test_parse_ranges():
+  parse = slycat.web.server.streaming.parse_ranges
+  assert parse("bytes=0-99", 1000) == [(0, 99)]
+  assert parse("bytes=900-", 1000) == [(900, 999)]
+  assert parse("bytes=-100", 1000) == [(900, 999)]
+  assert parse("bytes=0-99, 2000-3000", 1000) == [(0, 99)]
+  # Overlapping and adjacent ranges are merged.
+  assert parse("bytes=500-599,0-99,50-149,150-199", 1000) == [(0, 199), (500, 599)]
+  # Invalid headers are ignored.
+  for header in ["items=0-1", "bytes=5", "bytes=9-5", "bytes=a-b", "bytes=--5"]:
+    assert parse(header, 1000) is None
+
+def test_unsatisfiable_ranges(headers):
+  for header in ["bytes=1000-", "bytes=-0"]:
+    with pytest.raises(cherrypy.HTTPError) as e:
+      slycat.web.server.streaming.parse_ranges(header, 1000)
+    assert e.value.code == 416
+    assert cherrypy.response.headers["content-range"] == "bytes */1000"
+
+def serve(read, size, content_type):
+  return "".join(slycat.web.server.streaming.serve_ranges(read, size, content_type))
+
+def test_serve_ranges(headers):
+  assert serve(read, 1000, "video/mp4") == content
+  assert cherrypy.response.status == "200"
+
+  headers["range"] = "bytes=100-199"
+  assert serve(read, 1000, "video/mp4") == content[100:200]
+  assert cherrypy.response.status == "206"
+  assert cherrypy.response.headers["content-range"] == "bytes 100-199/1000"
+
+  headers["range"] = "bytes=0-9,-10"
+  body = serve(read, 1000, "video/mp4")
+  assert cherrypy.response.headers["content-type"].startswith("multipart/byteranges; boundary=")
+  boundary = cherrypy.response.headers["content-type"].split("=")[1]
+  parts = body.split("--%s" % boundary)
+  assert parts[-1] == "--\r\n"
+  assert parts[1].endswith("content-range: bytes 0-9/1000\r\n\r\n%s\r\n" % content[:10])
+  assert parts[2].endswith("content-range: bytes 990-999/1000\r\n\r\n%s\r\n" % content[990:])
+
+  headers["range"] = "bytes=10-5"
+  assert serve(read, 1000, "video/mp4") == content
+
+def test_open_ended_ranges_are_read_in_blocks(headers):
+  reads = []
+  def counted(offset, length):
+    reads.append((offset, length))
+    return read(offset, length)
+
+  headers["range"] = "bytes=150-"
+  body = slycat.web.server.streaming.serve_ranges(counted, 1000, "video/mp4", block_size=300)
+  assert cherrypy.response.headers["content-length"] == 850
+  # Nothing is read until the response is sent.
+  assert reads == []
+  assert body.next() == content[150:300]
+  assert reads == [(150, 150)]
+  assert "".join(body) == content[300:]
+  assert reads[1:] == [(300, 300), (600, 300), (900, 100)]
+
+def test_block_cache():
+  cache = slycat.web.server.streaming.BlockCache(block_size=100, capacity=3)
+  reads = []
+  def counted(offset, length):
+    reads.append((offset, length))
+    return read(offset, length)
+
+  assert cache.read("a", 1000, counted, 150, 100) == content[150:250]
+  assert reads == [(100, 200)]
+  assert cache.read("a", 1000, counted, 120, 160) == content[120:280]
+  assert reads == [(100, 200)]
+  # Missing blocks are read together, and the least recently used blocks are evicted.
+  assert cache.read("a", 1000, counted, 950, 100) == content[950:]
+  assert reads[-1] == (900, 100)
+  assert cache.read("a", 1000, counted, 100, 1) == content[100]
+  assert len(reads) == 2
+  assert cache.read("a", 1000, counted, 550, 10) == content[550:560]
+  assert cache.read("a", 1000, counted, 250, 10) == content[250:260]
+  assert reads[2:] == [(500, 100), (200, 100)]
+  # Blocks aren't shared between keys.
+  assert cache.read("b", 1000, counted, 100, 1) == content[100]
+  assert len(reads) == 5
+  # Reads larger than the cache bypass it, leaving the cached blocks alone.
+  assert cache.read("a", 1000, counted, 0, 1000) == content
+  assert reads[-1] == (0, 1000)
+  assert cache.read("b", 1000, counted, 100, 1) == content[100]
+  assert len(reads) == 6
+
+def test_serve_reads_whole_streams(headers):
+  import StringIO
+  stream = StringIO.StringIO(content + "next")
+  headers["range"] = "bytes=10-19"
+  assert "".join(slycat.web.server.streaming.serve(stream, 1000, "video/mp4")) == content[10:20]
+  assert stream.read() == "next"
@@ -1,2 +1,110 @@
+import cherrypy
+import datetime
 import pytest
+import time
+import slycat.web.server.hdf5
+import slycat.web.server.plugin
 import slycat.web.server.upload
+
+@pytest.fixture
+def parts(tmpdir):
+  paths = []
+  for index, content in enumerate(["a,b\n1,", "2\n3,4", "\n", "", "5,6"]):
+    paths.append(str(tmpdir.join("part-%s" % index)))
+    with open(paths[-1], "wb") as file:
+      file.write(content)
+  return paths
+
+def test_part_stream_reads_parts_in_order(parts):
+  stream = slycat.web.server.upload.PartStream(parts)
+  assert stream.size == 15
+  assert stream.read(3) == "a,b"
+  assert stream.read(5) == "\n1,2\n"
+  assert stream.read() == "3,4\n5,6"
+  assert stream.read() == ""
+  stream.seek(0)
+  assert stream.read(3) == "a,b"
+  assert slycat.web.server.upload.PartStream(parts).read() == "a,b\n1,2\n3,4\n5,6"
+
+def test_part_stream_lines_span_parts(parts):
+  with slycat.web.server.upload.PartStream(parts) as stream:
+    assert list(stream) == ["a,b\n", "1,2\n", "3,4\n", "5,6"]
+  assert slycat.web.server.upload.PartStream(parts).readline(2) == "a,"
+
+def test_parsers_receive_the_files_they_asked_for(parts):
+  received = []
+  def parse(database, model, input, files, aids, **kwargs):
+    received.append([file if isinstance(file, basestring) else file.read() for file in files] + [file.__class__.__name__ for file in files])
+
+  manager = slycat.web.server.plugin.Manager()
+  manager.register_parser("bytes", "Bytes", [], parse)
+  manager.register_parser("stream", "Stream", [], parse, stream=True)
+  for parser in ["bytes", "stream"]:
+    manager.parsers[parser]["parse"](None, None, True, [slycat.web.server.upload.PartStream(parts), "x"], ["a", "b"])
+  assert received == [
+    ["a,b\n1,2\n3,4\n5,6", "x", "str", "str"],
+    ["a,b\n1,2\n3,4\n5,6", "x", "PartStream", "StringIO"],
+    ]
+
+def prepare(input, file, fail=None):
+  # Finish the files in reverse order.
+  content = file.read()
+  time.sleep({"a": 0.4, "b": 0.2}.get(content, 0))
+  if content == fail:
+    raise Exception("Couldn't parse %s." % content)
+  return "storage-%s" % content
+
+@pytest.fixture
+def workers(monkeypatch):
+  monkeypatch.setattr(slycat.web.server.plugin.parser_processes, "count", 3)
+  monkeypatch.setattr(slycat.web.server.plugin.parser_timeout, "timeout", datetime.timedelta(minutes=1))
+  slycat.web.server.plugin.start_workers()
+  yield slycat.web.server.plugin.start_workers.pool
+  slycat.web.server.plugin.stop_workers()
+
+def test_files_are_prepared_in_parallel_and_parsed_in_order(monkeypatch, workers):
+  deleted = []
+  monkeypatch.setattr(slycat.web.server.hdf5, "delete", deleted.append)
+  received = []
+  manager = slycat.web.server.plugin.Manager()
+  manager.register_parser("parallel", "Parallel", [], lambda database, model, input, files, aids, **kwargs: received.append(files), stream=True, prepare=prepare)
+
+  start = time.time()
+  manager.parsers["parallel"]["parse"](None, None, True, ["a", "b", "c"], ["x", "y", "z"])
+  assert time.time() - start < 0.6
+  assert received == [["storage-a", "storage-b", "storage-c"]]
+
+  # One failed file fails the whole upload, and the others are discarded.
+  with pytest.raises(Exception) as e:
+    manager.parsers["parallel"]["parse"](None, None, True, ["a", "b", "c"], ["x", "y", "z"], fail="b")
+  assert str(e.value) == "Couldn't parse b."
+  assert len(received) == 1
+  time.sleep(0.5)
+  assert sorted(deleted) == ["storage-a", "storage-c"]
+
+  # So are files that are still being prepared when the upload times out.
+  del deleted[:]
+  monkeypatch.setattr(slycat.web.server.plugin.parser_timeout, "timeout", datetime.timedelta(seconds=0.1))
+  with pytest.raises(Exception) as e:
+    manager.parsers["parallel"]["parse"](None, None, True, ["a", "b", "c"], ["x", "y", "z"])
+  assert str(e.value).startswith("Files weren't prepared within")
+  time.sleep(0.5)
+  assert sorted(deleted) == ["storage-a", "storage-b", "storage-c"]
+
+def test_files_are_prepared_without_workers(monkeypatch):
+  monkeypatch.setattr(slycat.web.server.plugin.start_workers, "pool", None)
+  received = []
+  manager = slycat.web.server.plugin.Manager()
+  manager.register_parser("parallel", "Parallel", [], lambda database, model, input, files, aids, **kwargs: received.append(files), stream=True, prepare=prepare)
+  manager.parsers["parallel"]["parse"](None, None, True, ["a", "b"], ["x", "y"])
+  assert received == [["storage-a", "storage-b"]]
+
+def test_parsing_errors_are_reported_when_the_session_is_deleted(monkeypatch, tmpdir):
+  monkeypatch.setattr(slycat.web.server.upload.root, "path", str(tmpdir))
+  session = slycat.web.server.upload.Session("u", "127.0.0.1", "m", True, "parallel", ["x"], {})
+  session._parsing_error = Exception("Couldn't parse b.")
+  monkeypatch.setitem(slycat.web.server.upload.session_cache, "u", session)
+  with pytest.raises(cherrypy.HTTPError) as e:
+    slycat.web.server.upload.delete_session("u")
+  assert e.value.code == 400
+  assert "u" not in slycat.web.server.upload.session_cache
@@ -400,6 +400,10 @@ define("slycat_file_uploader_factory",["slycat-web-client"], function(client)
 
           window.setTimeout(deleteUpload.bind(null, pid, mid, uid, fileObject, progress_increment_used), 3000);
         }
+        else if(fileObject.error)
+        {
+          fileObject.error();
+        }
       }
     });
   }
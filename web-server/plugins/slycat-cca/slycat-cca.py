@@ -87,7 +87,7 @@ def register_slycat_plugin(context):
       slycat.web.server.update_model(database, model, state="finished", result="succeeded", finished=datetime.datetime.utcnow().isoformat(), progress=1.0, message="")
       end  = time.time()
       model["analysis_computation_time"] = (end - start)
-      database.save(model)
+      slycat.web.server.update_model(database, model)
     except:
       cherrypy.log.error("%s" % traceback.format_exc())
 
@@ -1,92 +1,260 @@
 import csv
+import itertools
 import time
 import numpy
 import slycat.email
+import slycat.hdf5
 import slycat.web.server
+import slycat.web.server.hdf5
 
 
-def parse_file(file):
+def _reader(lines):
     """
-  parses out a csv file into numpy array by column (data), the dimension meta data(dimensions),
-  and sets attributes (attributes)
-  :param file: csv file to be parsed
-  :returns: attributes, dimensions, data
-  """
-    import cherrypy
-    def isfloat(value):
-        try:
-            float(value)
-            return True
-        except ValueError:
-            return False
+    creates a csv reader over lines, skipping blank lines
+    :param lines: iterable of lines, including their line endings
+    :returns: iterator over rows, each a list of strings
+    """
+    reader = csv.reader(lines, delimiter=",", doublequote=True, escapechar=None, quotechar='"',
+                        quoting=csv.QUOTE_MINIMAL, skipinitialspace=True)
+    return itertools.ifilter(None, reader)
+
+
+def _blocks(file, size):
+    """
+    rewinds a file-like object and reads it in large blocks, split into complete lines
+    :param file: file-like object to be read, must support seek(0)
+    :param size: number of bytes to read at a time
+    :returns: iterator over lists of lines, including their line endings
+    """
+    file.seek(0)
+    remainder = ""
+    for block in iter(lambda: file.read(size), ""):
+        lines = (remainder + block).splitlines(True)
+        # The last line may continue in the next block.
+        remainder = "" if lines[-1].endswith("\n") else lines.pop()
+        if lines:
+            yield lines
+    if remainder:
+        yield [remainder]
+
+
+def _header(file, size):
+    """
+    parses the first non-blank line of a csv file
+    :returns: list of column names, or None if the file is blank
+    """
+    for lines in _blocks(file, size):
+        for line in lines:
+            if line.strip("\r\n"):
+                return next(_reader([line]))
+    return None
+
+
+def _data_blocks(file, size):
+    """
+    reads a csv file in blocks of complete lines, like _blocks(), skipping the header
+    """
+    blocks = _blocks(file, size)
+    for lines in blocks:
+        for index, line in enumerate(lines):
+            if line.strip("\r\n"):
+                yield lines[index + 1:]
+                for lines in blocks:
+                    yield lines
+                return
+
+
+def _columns(rows, width):
+    """
+    transposes a block of rows into columns, padding short rows with empty values and truncating long ones
+    :param rows: list of rows
+    :param width: number of columns
+    :returns: list of columns, each a sequence of strings
+    """
+    if set(map(len, rows)) != set([width]):
+        rows = [(row + [""] * width)[:width] for row in rows]
+    return zip(*rows)
+
+
+def _split(lines, width):
+    """
+    splits a block of lines into columns without the csv module, which is only possible for lines
+    without quotes or spaces that all have the same number of values
+    :returns: list of columns, each a sequence of strings, or None if the block needs the csv module
+    """
+    text = "".join(lines)
+    if '"' in text or " " in text:
+        return None
+    rows = text.splitlines()
+    if "" in rows:
+        rows = filter(None, rows)
+    values = ",".join(rows).split(",")
+    if len(values) != len(rows) * width:
+        return None
+    return [values[index::width] for index in range(width)]
+
 
+def _chunks(file, width, size):
+    """
+    iterates over the data rows of a csv file in chunks of about size bytes, transposed into columns
+    :returns: iterator over lists of columns, each a sequence of strings
+    """
+    blocks = _data_blocks(file, size)
+    for lines in blocks:
+        if '"' in "".join(lines):
+            # Quoted values can span lines, and so blocks, so use the csv module for the rest of the file.
+            rows = _reader(itertools.chain(lines, itertools.chain.from_iterable(blocks)))
+            for chunk in iter(lambda: list(itertools.islice(rows, len(lines))), []):
+                yield _columns(chunk, width)
+            return
+        columns = _split(lines, width)
+        if columns is None:
+            chunk = list(_reader(lines))
+            if not chunk:
+                continue
+            columns = _columns(chunk, width)
+        if columns[0]:
+            yield columns
+
+
+def _float_column(values):
+    """
+    converts a column of strings to float64, treating empty values as NaN
+    :param values: sequence of strings
+    :returns: numpy array, or None if a value isn't a number
+    """
+    try:
+        return numpy.array(values, dtype="float64")
+    except ValueError:
+        pass
+    try:
+        return numpy.array(["NaN" if value == "" else value for value in values], dtype="float64")
+    except ValueError:
+        return None
+
+
+def parse_file(file, start, chunk_size=4 * 1024 * 1024, sample_size=1000):
+    """
+    parses a csv file in chunks, converting each chunk straight to typed numpy arrays and appending it
+    to the array before reading the next, so memory use depends on the chunk size rather than the file
+    size.  Column types are inferred from a sample of the first rows.  If a later chunk has non-numeric
+    values in a float64 column, only that column becomes a string column, and its earlier rows are read
+    again once the rest of the file has been stored.  Columns that are empty throughout the file are
+    stored as strings.
+    :param file: file-like object containing the csv file to be parsed, must support seek(0)
+    :param start: called with the attributes of the array before any data is stored, returning a writer
+      like slycat.hdf5.RowWriter whose append() is called with a list of numpy arrays containing each
+      chunk's data for each column, and whose retype() and fill() are called when a column type changes
+    :param chunk_size: approximate number of bytes to convert and store at a time
+    :param sample_size: number of rows used to infer column types
+    :returns: attributes, dimensions
+    """
+    import cherrypy
     cherrypy.log.error("parsing:::::::")
-    rows = [row for row in
-            csv.reader(file.splitlines(), delimiter=",", doublequote=True, escapechar=None, quotechar='"',
-                       quoting=csv.QUOTE_MINIMAL, skipinitialspace=True)]
-    if len(rows) < 2:
+
+    header = _header(file, chunk_size)
+    width = len(header) if header is not None else 0
+    sample = [[] for index in range(width)]
+    for columns in _chunks(file, width, chunk_size):
+        for values, column in zip(sample, columns):
+            values.extend(column[:sample_size - len(values)])
+        if len(sample[0]) == sample_size:
+            break
+    if not sample or not sample[0]:
         slycat.email.send_error("slycat-csv-parser.py parse_file", "File must contain at least two rows.")
         raise Exception("File must contain at least two rows.")
+    types = ["float64" if _float_column(column) is not None else "string" for column in sample]
+    # Columns that are empty throughout the sample start as float64, in case numbers appear later.
+    empty = set([index for index, column in enumerate(sample) if not any(column)])
 
-    attributes = []
-    dimensions = [{"name": "row", "type": "int64", "begin": 0, "end": len(rows[1:])}]
-    data = []
-    # go through the csv by column
-    for column in zip(*rows):
-        column_has_floats = False
-
-        # start from 1 to avoid the column name
-        for value in column[1:]:
-            if isfloat(value):
-                column_has_floats = True
-                try:  # note NaN's are floats
-                    output_list = map(lambda x: 'NaN' if x == '' else x, column[1:])
-                    data.append(numpy.array(output_list).astype("float64"))
-                    attributes.append({"name": column[0], "type": "float64"})
-
-                # could not convert something to a float defaulting to string
-                except Exception as e:
-                    column_has_floats = False
-                    cherrypy.log.error("found floats but failed to convert, switching to string types Trace: %s" % e)
+    writer = start([{"name": name, "type": type} for name, type in zip(header, types)])
+    # Number of rows stored before each column that changed type became a string column.
+    retyped = {}
+    for columns in _chunks(file, width, chunk_size):
+        data = []
+        for index, (column, type) in enumerate(zip(columns, types)):
+            values = numpy.array(column) if type == "string" else _float_column(column)
+            if values is None:
+                cherrypy.log.error("Non-numeric values found in rows %s-%s, storing %s as strings." % (writer.rows, writer.rows + len(column), header[index]))
+                types[index] = "string"
+                writer.retype(index, "string")
+                retyped[index] = writer.rows
+                values = numpy.array(column)
+            data.append(values)
+        if empty:
+            empty -= set([index for index in empty if any(columns[index])])
+        writer.append(data)
+
+    for index in empty - set(retyped):
+        # Empty columns were stored as strings by the old parser.  Their values are already empty strings.
+        types[index] = "string"
+        writer.retype(index, "string")
+
+    if retyped:
+        rows = 0
+        for columns in _chunks(file, width, chunk_size):
+            if rows >= max(retyped.values()):
                 break
-        if not column_has_floats:
-            data.append(numpy.array(column[1:]))
-            attributes.append({"name": column[0], "type": "string"})
+            for index, end in retyped.items():
+                if rows < end:
+                    writer.fill(index, rows, numpy.array(columns[index][:end - rows]))
+            rows += len(columns[0])
 
-    if len(attributes) < 1:
-        slycat.email.send_error("slycat-csv-parser.py parse_file", "File must contain at least one column.")
-        raise Exception("File must contain at least one column.")
+    attributes = [{"name": name, "type": type} for name, type in zip(header, types)]
+    return attributes, [{"name": "row", "type": "int64", "begin": 0, "end": writer.rows}]
 
-    return attributes, dimensions, data
+
+def prepare(input, file, **kwargs):
+    """
+    parses a csv file into a new array set, in a worker process
+    :param input: boolean
+    :param file: file-like object to be parsed
+    :param kwargs:
+    :returns: storage id of the array set
+    """
+    array_index = int(kwargs.get("array", "0"))
+    storage = slycat.web.server.create_arrayset()
+    try:
+        with slycat.web.server.hdf5.open(storage, "r+") as hdf5_file:
+            arrayset = slycat.hdf5.ArraySet(hdf5_file)
+            parse_file(file, lambda attributes: arrayset.start_rows(array_index, attributes, slycat.web.server.hdf5.layout()))
+    except:
+        slycat.web.server.hdf5.delete(storage)
+        raise
+    return storage
 
 
 def parse(database, model, input, files, aids, **kwargs):
     """
-    parses a file as a csv and then uploads the parsed data to associated storage for a
-    model
+    stores the array sets parsed from csv files in a model
     :param database: slycat.web.server.database.couchdb.connect()
     :param model: database.get("model", self._mid)
     :param input: boolean
-    :param files: files to be parsed
+    :param files: storage ids returned by prepare(), in file order
     :param aids: artifact ID
     :param kwargs:
     """
     start = time.time()
     if len(files) != len(aids):
+        for storage in files:
+            slycat.web.server.hdf5.delete(storage)
         slycat.email.send_error("slycat-csv-parser.py parse", "Number of files and artifact IDs must match.")
         raise Exception("Number of files and artifact ids must match.")
 
-    parsed = [parse_file(file) for file in files]
-
-    array_index = int(kwargs.get("array", "0"))
-    for (attributes, dimensions, data), aid in zip(parsed, aids):
-        slycat.web.server.put_model_arrayset(database, model, aid, input)
-        slycat.web.server.put_model_array(database, model, aid, 0, attributes, dimensions)
-        slycat.web.server.put_model_arrayset_data(database, model, aid, "%s/.../..." % array_index, data)
+    for index, (storage, aid) in enumerate(zip(files, aids)):
+        try:
+            slycat.web.server.put_model_arrayset(database, model, aid, input, storage=storage)
+        except:
+            # Nothing else refers to the array sets that weren't attached to the model, so delete them.
+            if model.get("artifact:%s" % aid) != storage:
+                slycat.web.server.hdf5.delete(storage)
+            for unattached in files[index + 1:]:
+                slycat.web.server.hdf5.delete(unattached)
+            raise
     end = time.time()
     model["db_creation_time"] = (end - start)
-    database.save(model)
+    slycat.web.server.update_model(database, model)
 
 
 def register_slycat_plugin(context):
-    context.register_parser("slycat-csv-parser", "Comma separated values (CSV)", ["table"], parse)
+    context.register_parser("slycat-csv-parser", "Comma separated values (CSV)", ["table"], parse, stream=True, prepare=prepare)
@@ -1,14 +1,15 @@
 import numpy
+import slycat.hdf5
 import slycat.web.server
+import slycat.web.server.hdf5
 import slycat.email
-import StringIO
 
 
 def parse_file(file):
     """
     parses out a .dat file into numpy array by column (data), the dimension meta data(dimensions),
     and sets attributes (attributes)
-    :param file: dakota file to be parsed
+    :param file: file-like object containing the dakota file to be parsed
     :returns: attributes, dimensions, data
     """
     import cherrypy
@@ -20,7 +21,7 @@ def parse_file(file):
             return False
 
     cherrypy.log.error("parsing:::::::")
-    rows = [row.split() for row in StringIO.StringIO(file)]
+    rows = [row.split() for row in file]
     if len(rows) < 2:
         slycat.email.send_error("slycat-dakota-parser.py parse_file", "File must contain at least two rows.")
         raise Exception("File must contain at least two rows.")
@@ -57,19 +58,46 @@ def parse_file(file):
     return attributes, dimensions, data
 
 
+def prepare(input, file, **kwargs):
+    """
+    parses a dakota file into a new array set, in a worker process
+    :param input: boolean
+    :param file: file-like object to be parsed
+    :param kwargs:
+    :returns: storage id of the array set
+    """
+    attributes, dimensions, data = parse_file(file)
+    array_index = int(kwargs.get("array", "0"))
+    storage = slycat.web.server.create_arrayset()
+    try:
+        with slycat.web.server.hdf5.open(storage, "r+") as hdf5_file:
+            array = slycat.hdf5.ArraySet(hdf5_file).start_array(array_index, dimensions, attributes, slycat.web.server.hdf5.layout())
+            for attribute, values in enumerate(data):
+                array.set_data(attribute, Ellipsis, values)
+    except:
+        slycat.web.server.hdf5.delete(storage)
+        raise
+    return storage
+
+
 def parse(database, model, input, files, aids, **kwargs):
     if len(files) != len(aids):
+        for storage in files:
+            slycat.web.server.hdf5.delete(storage)
         slycat.email.send_error("slycat-dakota-parser.py parse", "Number of files and artifact IDs must match.")
         raise Exception("Number of files and artifact ids must match.")
 
-    parsed = [parse_file(file) for file in files]
-
-    array_index = int(kwargs.get("array", "0"))
-    for (attributes, dimensions, data), aid in zip(parsed, aids):
-        slycat.web.server.put_model_arrayset(database, model, aid, input)
-        slycat.web.server.put_model_array(database, model, aid, 0, attributes, dimensions)
-        slycat.web.server.put_model_arrayset_data(database, model, aid, "%s/.../..." % array_index, data)
+    for index, (storage, aid) in enumerate(zip(files, aids)):
+        try:
+            slycat.web.server.put_model_arrayset(database, model, aid, input, storage=storage)
+        except:
+            # Nothing else refers to the array sets that weren't attached to the model, so delete them.
+            if model.get("artifact:%s" % aid) != storage:
+                slycat.web.server.hdf5.delete(storage)
+            for unattached in files[index + 1:]:
+                slycat.web.server.hdf5.delete(unattached)
+            raise
 
 
 def register_slycat_plugin(context):
-    context.register_parser("slycat-dakota-parser", "Dakota tabular", ["table"], parse)
+    context.register_parser("slycat-dakota-parser", "Dakota tabular", ["table"], parse, stream=True, prepare=prepare)
@@ -11,6 +11,7 @@ def register_slycat_plugin(context):
     import cherrypy
     import datetime
     import slycat.web.server
+    import slycat.web.server.sessions
     import slycat.email
     import urlparse
 
@@ -41,10 +42,9 @@ def register_slycat_plugin(context):
         # See if the client already has a valid session.
         if "slycatauth" in cherrypy.request.cookie:
             sid = cherrypy.request.cookie["slycatauth"].value
-            couchdb = slycat.web.server.database.couchdb.connect()
             session = None
             try:
-                session = couchdb.get("session", sid)
+                session = slycat.web.server.sessions.table.get(sid)
                 started = session["created"]
                 user_name = session["creator"]
 
@@ -63,11 +63,13 @@ def register_slycat_plugin(context):
                 # cherrypy.log.error("%s" % (datetime.datetime.utcnow() - datetime.datetime.strptime(unicode(started), '%Y-%m-%dT%H:%M:%S.%f') > cherrypy.request.app.config["slycat"]["session-timeout"]))
                 if datetime.datetime.utcnow() - datetime.datetime.strptime(unicode(started), '%Y-%m-%dT%H:%M:%S.%f') > \
                         cherrypy.request.app.config["slycat"]["session-timeout"]:
-                    couchdb.delete(session)
+                    slycat.web.server.sessions.table.delete(sid)
                     # expire the old cookie
                     cherrypy.response.cookie["slycatauth"] = sid
                     cherrypy.response.cookie["slycatauth"]['expires'] = 0
                     session = None
+                else:
+                    slycat.web.server.sessions.table.touch(sid)
                 cherrypy.request.login = user_name
                 # Apply (optional) authentication rules.
             except Exception as e:
@@ -312,8 +312,7 @@ def register_slycat_plugin(context):
         """
         sid = None
         try:
-            database = slycat.web.server.database.couchdb.connect()
-            session = database.get("session", cherrypy.request.cookie["slycatauth"].value)
+            session = slycat.web.server.sessions.table.get(cherrypy.request.cookie["slycatauth"].value)
             for host_session in session["sessions"]:
                 if host_session["hostname"] == kwargs["hostname"]:
                     sid = host_session["sid"]
@@ -126,6 +126,23 @@ design = {
         }
         """,
       },
+    "project-acl": {
+      "map": """
+        function(doc)
+        {
+          if(doc["type"] != "project" || doc["acl"] == null)
+            return;
+
+          var roles = ["administrators", "writers", "readers"];
+          for(var i = 0; i != roles.length; ++i)
+          {
+            var members = doc["acl"][roles[i]] || [];
+            for(var j = 0; j != members.length; ++j)
+              emit(members[j]["user"], roles[i]);
+          }
+        }
+        """,
+      },
     "project-bookmarks": {
       "map": """
         function(doc)